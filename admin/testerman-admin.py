@@ -83,6 +83,16 @@ class IaClient(TestermanNodes.ConnectingNode):
 		else:
 			return None
 
+	def getChannels(self, timeout = 1.0):
+		self.start()
+		request = TestermanMessages.Request("GET-CHANNELS", "system:tacs", "Ia", "1.0")
+		response = self.executeRequest(0, request, responseTimeout = timeout)
+		self.stop()
+		if response and response.getStatusCode() == 200:
+			return response.getApplicationBody()
+		else:
+			return None
+
 
 def makedir(path):
 	if not os.path.exists(path):
@@ -119,6 +129,7 @@ class RootContext(SIS.CommandContext):
 		showTacsNode.addChoice("running-configuration", "show running configuration", showRunningConfigurationNode)
 		showTacsNode.addChoice("internal-variables", "show internal variables")
 		showTacsNode.addChoice("status", "show testerman agent controller server status")
+		showTacsNode.addChoice("channels", "show the Xa/Ia channels outbound queues")
 		
 		showNode = SIS.ChoiceNode()
 		showNode.addChoice("server", "show testerman server related info", showTsNode)
@@ -253,6 +264,25 @@ class RootContext(SIS.CommandContext):
 			return self.showInternalVariables(component = "tacs")
 		elif name == 'status':
 			return self.tacsStatus()
+		elif name == 'channels':
+			return self.showTacsChannels()
+
+	def showTacsChannels(self, order = "interface"):
+		"""
+		Displays the outbound queue depth and dropped messages for each TACS channel.
+		"""
+		headers = [
+			('interface', 'Interface'), ('channel', 'Channel'), ('uri', 'Agent'),
+			('queue-depth', 'Queue depth'), ('dropped', 'Dropped')
+		]
+		try:
+			ip, port = os.environ.get("TESTERMAN_TACS").split(':')
+			channels = IaClient((ip, int(port))).getChannels()
+		except Exception, e:
+			return self.error("Unable to contact the Testerman Agent Controller server at %s: %s" % (os.environ.get("TESTERMAN_TACS"), str(e)))
+		if channels is None:
+			return self.error("Unable to get channels from the Testerman Agent Controller server at %s" % os.environ.get("TESTERMAN_TACS"))
+		self.printTable(headers, channels, order = order)
 
 	def showRunningConfiguration(self, component, order = "key", display = "no-default"):
 		"""
@@ -158,18 +158,44 @@ class LogExpander:
 	A Raw log saver that follows include directives
 	to expand the logs inline.
 	
+	Template references (template-id attributes in template-match/mismatch
+	events) are also replaced with the templates they reference,
+	so that the expanded logs don't contain any template-defined events.
+	
 	Based on *string* parsing, not XML parsing, 
 	and assumes that <include> elements are on a single line.
 	"""
+	TEMPLATE_PATTERN = re.compile(r'(?P<defined><template-defined (?:[^>]* )?id="(?P<id>\d+)"[^>]*>(?P<template><template[ >].*?</template>)</template-defined>\n?)'
+		r'|(?P<tag><template-(?:match|mismatch) (?:[^>]* )?template-id="(?P<reference>\d+)"[^>]*>)(?P<body>.*?</template-(?:match|mismatch)>)', re.S)
+
 	def __init__(self, client):
 		self._client = client
 
 	def expand(self, rawLogs):
 		return '\n'.join(self._expand(rawLogs))
 	
+	def _resolveTemplates(self, rawLogs):
+		"""
+		Replaces template references with the referenced templates.
+		Template ids are only valid within a log file.
+		"""
+		templates = {}
+		def _resolve(m):
+			if m.group('defined'):
+				templates[m.group('id')] = m.group('template')
+				return ''
+			template = templates.get(m.group('reference'))
+			if template is None:
+				log("Warning: undefined template %s" % m.group('reference'))
+				return m.group(0)
+			return '%s%s' % (re.sub(r'\s*template-id="\d+"', '', m.group('tag')), m.group('body').replace('</message>', '</message>%s' % template, 1))
+		# Definitions and references are resolved in log order
+		return self.TEMPLATE_PATTERN.sub(_resolve, rawLogs)
+
 	def _expand(self, rawLogs):
 		ret = []
 
+		rawLogs = self._resolveTemplates(rawLogs)
 		for line in rawLogs.split('\n'):
 			if not line.startswith('<include '):
 				ret.append(line)
@@ -575,7 +601,7 @@ class TestermanCliClient:
 		expands include elements if expandLogs is set to True.
 		"""
 		try:
-			ret = self.__client.getJobLog(jobId)
+			ret = self._getJobLog(jobId)
 			if not ret:
 				raise Exception("No log available (job not started or delete logs)")
 		except Exception, e:
@@ -588,6 +614,24 @@ class TestermanCliClient:
 		else:
 			return ret
 
+	def _getJobLog(self, jobId):
+		"""
+		Retrieves the complete job log by chunks,
+		or at once if the server does not support it (Ws API < 1.9).
+		"""
+		try:
+			chunk = self.__client.getJobLogChunk(jobId, 0)
+		except Exception, e:
+			return self.__client.getJobLog(jobId)
+
+		events = []
+		while chunk is not None and chunk[0]:
+			events.append(chunk[0])
+			chunk = self.__client.getJobLogChunk(jobId, chunk[1])
+		if chunk is None and not events:
+			return None
+		return '<?xml version="1.0" encoding="utf-8" ?>\n<ats>\n%s</ats>' % ''.join(events)
+
 	def listDependencies(self, path, recursive = True):
 		"""
 		Prints the dependencies for a given file (module/ats/campaign)
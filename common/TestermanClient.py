@@ -155,7 +155,13 @@ class Client(Nodes.ConnectingNode):
 		self._localAddress = localAddress
 		self.__mutex = threading.RLock()
 		self.__channel = None
-		self.__localSubscriptions = {}
+		# The callbacks per subscribed uri or uri pattern
+		self.__localSubscriptions = Messages.UriIndex()
+		# The sequence number of the next log event expected per uri,
+		# to resume the subscriptions on reconnection or on missed events
+		self.__logSequences = {}
+		# The uris whose subscriptions are being resumed after missed events
+		self.__resumingUris = set()
 		self._serverUrl = None
 		self.__proxy = None
 		self.setServerUrl(serverUrl)
@@ -283,7 +289,7 @@ class Client(Nodes.ConnectingNode):
 		else:
 			return None
 
-	def scheduleAts(self, ats, atsId, username, session = {}, at = None, path = None, groups = None):
+	def scheduleAts(self, ats, atsId, username, session = {}, at = None, path = None, groups = None, logFormat = None):
 		"""
 		Schedules an ATS to be executed at 'at' time.
 		If 'at' is lower than the current server's time or None, an immediate execution occurs. 
@@ -306,6 +312,9 @@ class Client(Nodes.ConnectingNode):
 		@type  groups: list os unicode strings, or None
 		@param groups: a list of groups selected for this run. If set to None, all groups are considered
 		               (no particular selection)
+		@type  logFormat: string, or None
+		@param logFormat: the job log file format, 'xml' or 'binary' (server Ws API >= 1.9).
+		                  None to use the server default (xml).
 		
 		@throws Exception in case of a scheduling error.
 		
@@ -318,7 +327,10 @@ class Client(Nodes.ConnectingNode):
 				for (k, v) in session.items():
 					s[k.encode('utf-8')] = v.encode('utf-8')
 			
-			return self.__proxy.scheduleAts(ats, atsId.encode('utf-8'), username.encode('utf-8'), s, at, path, groups)
+			if logFormat is None:
+				# Compatible with servers that do not support it
+				return self.__proxy.scheduleAts(ats, atsId.encode('utf-8'), username.encode('utf-8'), s, at, path, groups)
+			return self.__proxy.scheduleAts(ats, atsId.encode('utf-8'), username.encode('utf-8'), s, at, path, groups, logFormat)
 		except xmlrpclib.Fault, e:
 			self.getLogger().error("ATS Scheduling fault: " + str(e))
 			raise Exception(e.faultString)
@@ -407,6 +419,39 @@ class Client(Nodes.ConnectingNode):
 			self.getLogger().debug("log decompressed")
 		return res
 
+	def getJobLogChunk(self, jobId, fromOffset, maxBytes = 1048576):
+		"""
+		Returns the complete log events logged by a job from fromOffset,
+		and the offset to use to get the next ones.
+		
+		Enables to retrieve the log of a running job incrementally,
+		without getting the full log each time.
+		
+		This client-side implementation always requests the log as
+		a compressed data (gziped + base64 encoding).
+		
+		@since: 1.9
+
+		@type  jobId: integer
+		@param jobId: the job ID
+		@type  fromOffset: integer
+		@param fromOffset: 0, or the next offset returned by the previous call
+		@type  maxBytes: integer
+		@param maxBytes: the max number of log bytes to retrieve
+		
+		@throws Exception in case of an error.
+		
+		@rtype: tuple (string (not unicode), integer), or None
+		@returns: (events, next offset), where events are XML log events
+		(utf-8, no prologue, no root element), possibly empty,
+		or None if the job was not found.
+		"""
+		self.getLogger().debug("getJobLogChunk...")
+		res = self.__proxy.getJobLogChunk(jobId, fromOffset, maxBytes, True)
+		if res is None:
+			return None
+		return (zlib.decompress(base64.decodestring(res['log'])), res['next-offset'])
+
 	def getJobDetails(self, jobId):
 		"""
 		Gets a specific job's details.
@@ -509,30 +554,38 @@ class Client(Nodes.ConnectingNode):
 		res = self.__proxy.getXcInterfaceAddress()
 		return res
 
-	def subscribe(self, uri, callback):
+	def subscribe(self, uri, callback, fromSequence = None):
 		"""
 		Subscribes to events related to the uri, so that incoming events are raised through callback.
 		Won't add a callback registration if it was already registered for this uri.
 		
+		The uri may be a pattern ending with a wildcard (for instance job:*
+		or filesystem:/repository/myproject/*) to receive the events of
+		any uri starting with the rest of it.
+		
 		@type  uri: string
-		@param uri: the uri showse events we want to subscribe to 
+		@param uri: the uri (or uri pattern) whose events we want to subscribe to 
 		@type  callback: callable(string, string, Event)
 		@param callback: the callback to call when receiving an event from uri
+		@type  fromSequence: integer, or None
+		@param fromSequence: if set, the log events of the uri (job:<id>) from this
+		sequence number (1: the first event of the job log) are received
+		before the new ones. Ignored if the uri was already subscribed.
 		
 		@rtype: None
 		@returns: None
 		"""	
 		self._lock()
-		if not self.__localSubscriptions.has_key(uri):
-			self.__localSubscriptions[uri] = []
-			self.__localSubscriptions[uri].append(callback)
+		if not self.__localSubscriptions.getValues(uri):
+			self.__localSubscriptions.add(uri, callback)
+			if fromSequence is not None:
+				self.__logSequences[uri] = fromSequence
 			self._unlock()
-			self.sendNotification(self.__channel, Messages.Notification("SUBSCRIBE", uri, "XC", "1.0"))
+			self.sendNotification(self.__channel, self._createSubscription(uri, fromSequence))
 			self.getLogger().debug("subscribed to URI %s, callback %s" % (uri, callback))
 			return
 
-		if not callback in self.__localSubscriptions[uri]:
-			self.__localSubscriptions[uri].append(callback)
+		if self.__localSubscriptions.add(uri, callback):
 			self.getLogger().debug("already subscribed to URI %s, added callback %s" % (uri, callback))
 
 		self._unlock()
@@ -559,19 +612,22 @@ class Client(Nodes.ConnectingNode):
 
 		self._lock()
 		# We only send an UNSUBSCRIBE if no registered callback remains.
-		if self.__localSubscriptions.has_key(uri):
+		if self.__localSubscriptions.getValues(uri):
 			if callback:
-				if callback in self.__localSubscriptions[uri]:
-					self.__localSubscriptions[uri].remove(callback)
-				if len(self.__localSubscriptions[uri]) == 0:
-					del self.__localSubscriptions[uri]
+				self.__localSubscriptions.remove(uri, callback)
+				if not self.__localSubscriptions.getValues(uri):
+					self.__logSequences.pop(uri, None)
+					self.__resumingUris.discard(uri)
 					self._unlock()
 					self.sendNotification(self.__channel, Messages.Notification("UNSUBSCRIBE", uri, "XC", "1.0"))
 					return
 
 			else:
 				# We remove all callbacks for this uri
-				del self.__localSubscriptions[uri]
+				for cb in self.__localSubscriptions.getValues(uri):
+					self.__localSubscriptions.remove(uri, cb)
+				self.__logSequences.pop(uri, None)
+				self.__resumingUris.discard(uri)
 				self._unlock()
 				self.sendNotification(self.__channel, Messages.Notification("UNSUBSCRIBE", uri, "XC", "1.0"))
 				return
@@ -594,20 +650,111 @@ class Client(Nodes.ConnectingNode):
 		"""
 		uri = str(notification.getUri())
 		
-		if self.__localSubscriptions.has_key(uri):
-			for callback in self.__localSubscriptions[uri]:
-				try:
-					callback(notification)
-				except:
-					pass
+		if notification.getMethod() == "LOG-REPLAY":
+			# Not delivered: only tells that a replay is truncated
+			self._onLogReplayTruncated(uri, notification.getHeader("Log-Sequence"))
+			return
+		
+		sequence = notification.getHeader("Log-Sequence")
+		if sequence is not None and not self._checkLogSequence(uri, notification, int(sequence)):
+			return
+		
+		for callback in self.__localSubscriptions.match(uri):
+			try:
+				callback(notification)
+			except:
+				pass
+
+	def _checkLogSequence(self, uri, notification, sequence):
+		"""
+		Keeps track of the next log event expected for a subscribed uri.
+		
+		When events are missing (the server dropped them because we were
+		too slow to consume them), the subscription is resumed from the first
+		missing event, and the notifications received until the
+		server replays the missing events are discarded.
+		
+		@rtype: bool
+		@returns: True if the notification must be delivered, False if it must
+		be discarded (already received, or received again in the replay)
+		"""
+		if notification.getMethod() == "LOG-BATCH":
+			count = len(notification.getHeader("Log-Classes").split(','))
+		else:
+			count = 1
+		resume = False
+		self._lock()
+		try:
+			if not self.__localSubscriptions.getValues(uri):
+				return True
+			expected = self.__logSequences.get(uri)
+			if notification.getHeader("Log-Replay"):
+				# A replay may not start with the expected event
+				# if the server does not have it anymore
+				self.__resumingUris.discard(uri)
+				if expected is not None and sequence > expected:
+					self.getLogger().warning("Log events %s to %s on %s are lost" % (expected, sequence - 1, uri))
+					expected = sequence
+			elif uri in self.__resumingUris:
+				# Will be received again in the replay
+				return False
+			if expected is not None:
+				if sequence + count <= expected:
+					return False
+				if sequence > expected:
+					self.__resumingUris.add(uri)
+					resume = True
+					return False
+			self.__logSequences[uri] = sequence + count
+			return True
+		finally:
+			self._unlock()
+			if resume:
+				self.getLogger().warning("Missed log events on %s (expected %s, received %s), resuming the subscription" % (uri, expected, sequence))
+				self.sendNotification(self.__channel, self._createSubscription(uri, expected))
+
+	def _onLogReplayTruncated(self, uri, sequence):
+		"""
+		The server cannot replay all the log events we resumed a subscription from:
+		the events before sequence (all the missing ones if None) are lost.
+		"""
+		self._lock()
+		try:
+			if not self.__localSubscriptions.getValues(uri):
+				return
+			self.__resumingUris.discard(uri)
+			expected = self.__logSequences.get(uri)
+			if sequence is None:
+				# We cannot tell the missing events from the next ones anymore
+				self.__logSequences.pop(uri, None)
+			elif expected is None or int(sequence) > expected:
+				self.__logSequences[uri] = int(sequence)
+		finally:
+			self._unlock()
+		if sequence is None:
+			self.getLogger().warning("Log events from %s on %s are lost (cannot be replayed)" % (expected, uri))
+		elif expected is not None and int(sequence) > expected:
+			self.getLogger().warning("Log events %s to %s on %s are lost (cannot be replayed)" % (expected, int(sequence) - 1, uri))
 
 	def onConnection(self, channel):
 		"""
 		Reimplemented from Nodes.ConnectingNode.
 		"""
 		self.__channel = channel
-		for uri in self.__localSubscriptions.keys():
-			self.sendNotification(self.__channel, Messages.Notification("SUBSCRIBE", uri, "XC", "1.0"))
+		# Resubscribe, resuming from the last received log events, if any,
+		# so that the events sent while we were disconnected are not lost
+		self._lock()
+		self.__resumingUris.clear()
+		subscriptions = [ (uri, self.__logSequences.get(uri)) for uri in self.__localSubscriptions.getUris() ]
+		self._unlock()
+		for (uri, fromSequence) in subscriptions:
+			self.sendNotification(self.__channel, self._createSubscription(uri, fromSequence))
+
+	def _createSubscription(self, uri, fromSequence = None):
+		notification = Messages.Notification("SUBSCRIBE", uri, "XC", "1.0")
+		if fromSequence is not None:
+			notification.setHeader("Log-Sequence", fromSequence)
+		return notification
 
 	##
 	# File management: core, web services methods
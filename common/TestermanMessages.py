@@ -27,12 +27,25 @@ import zlib
 import cPickle as pickle
 import JSON
 
+# A C-accelerated JSON implementation, when available.
+# Its output is the same as the bundled (pure python) JSON module,
+# so that it does not need to be negotiated with peers.
+try:
+	import json as FastJSON
+except ImportError:
+	try:
+		import simplejson as FastJSON
+	except ImportError:
+		FastJSON = JSON
+
 # Message separator.
 # On reference perf tests, 8% faster when using \n instead of \r\n.
 SEPARATOR = '\n'
 
-URI_REGEXP = re.compile(r'(?P<scheme>[a-z]+):((?P<user>[a-zA-Z0-9_\.-]+)@)?(?P<domain>[a-zA-Z0-9_\./%-]+)')
+# The domain may end with a wildcard (uri patterns, see UriIndex)
+URI_REGEXP = re.compile(r'(?P<scheme>[a-z]+):((?P<user>[a-zA-Z0-9_\.-]+)@)?(?P<domain>[a-zA-Z0-9_\./%-]+\*?|\*)')
 HEADERLINE_REGEXP = re.compile(r'(?P<header>[a-zA-Z0-9_-]+)\s*:\s*(?P<value>.*)')
+HEADERNAME_REGEXP = re.compile(r'[a-zA-Z0-9_-]+$')
 REQUESTLINE_REGEXP = re.compile(r'(?P<method>[a-zA-Z0-9_-]+)\s*(?P<uri>[^\s]*)\s*(?P<protocol>[a-zA-Z0-9_-]+)/(?P<version>[0-9\.]+)')
 STATUSLINE_REGEXP = re.compile(r'(?P<status>[0-9]+)\s*(?P<reason>.*)')
 
@@ -95,20 +108,31 @@ class Message(object):
 	ENCODING_BASE64 = "base64"
 	ENCODING_NONE = "none"
 	
-	CONTENT_TYPE_PYTHON_PICKLE = "application/x-python-pickle" # specific type
+	CONTENT_TYPE_PYTHON_PICKLE = "application/x-python-pickle" # specific type, protocol 0 (text)
+	# Highest pickle protocol (binary), base64 encoded so that it remains safe
+	# with any packet framing. Only used with peers that accept it.
+	CONTENT_TYPE_PYTHON_PICKLE_BINARY = "application/x-python-pickle-binary"
 	CONTENT_TYPE_JSON = "application/json" # Official one
 	CONTENT_TYPE_GZIP = "application/x-gzip"
 	
 	def __init__(self):
-		self.headers = {} # dict of str of unicode
+		self.headers = {} # dict of utf-8 encoded str
 		self.body = None # unicode or datastring
+		# The serialized headers, except the Transaction-Id,
+		# reset each time a header is modified (see _serialize())
+		self._headerBlock = None
 
 	def setHeader(self, header, value):
 		if value is None:
 			return
-		if not isinstance(value, basestring):
+		if isinstance(value, unicode):
+			value = value.encode('utf-8')
+		elif not isinstance(value, str):
 			value = str(value)
-		self.headers[header] = value.encode('utf-8')
+		if self.headers.get(header) != value:
+			self.headers[header] = value
+			if header != "Transaction-Id":
+				self._headerBlock = None
 	
 	def getHeader(self, header):
 		return self.headers.get(header, None)
@@ -125,13 +149,17 @@ class Message(object):
 		both Content-Encoding ad Content-Type as JSON or pickle encoding.
 		"""
 		if profile == self.CONTENT_TYPE_JSON:
-			self.body = JSON.dumps(body)
+			self.body = FastJSON.dumps(body)
 			self.setContentEncoding(self.ENCODING_UTF8)
 			self.setContentType(self.CONTENT_TYPE_JSON)
 		elif profile == self.CONTENT_TYPE_PYTHON_PICKLE:
 			self.body = pickle.dumps(body)
 			self.setContentEncoding(self.ENCODING_NONE)
 			self.setContentType(self.CONTENT_TYPE_PYTHON_PICKLE)
+		elif profile == self.CONTENT_TYPE_PYTHON_PICKLE_BINARY:
+			self.body = base64.b64encode(pickle.dumps(body, pickle.HIGHEST_PROTOCOL))
+			self.setContentEncoding(self.ENCODING_BASE64)
+			self.setContentType(self.CONTENT_TYPE_PYTHON_PICKLE_BINARY)
 		elif profile == self.CONTENT_TYPE_GZIP:
 			self.body = base64.encodestring(zlib.compress(body))
 			self.setContentEncoding(self.ENCODING_BASE64)
@@ -158,10 +186,29 @@ class Message(object):
 		return self.headers.get("Content-Type", None)
 
 	def setContentEncoding(self, encoding):
-		self.headers["Content-Encoding"] = encoding
+		self.setHeader("Content-Encoding", encoding)
 	
 	def setContentType(self, contentType):
-		self.headers["Content-Type"] = contentType
+		self.setHeader("Content-Type", contentType)
+
+	def _serialize(self, firstLine):
+		"""
+		Encodes a message to a utf-8 string.
+		
+		The serialized headers are kept until a header is modified,
+		so that a message sent to several peers (only their Transaction-Id
+		differs) is not re-serialized for each of them.
+		"""
+		if self._headerBlock is None:
+			self._headerBlock = ''.join([ '%s: %s%s' % (h, v, SEPARATOR) for (h, v) in self.headers.items() if h != "Transaction-Id" ])
+		ret = [ firstLine, SEPARATOR, self._headerBlock ]
+		transactionId = self.headers.get("Transaction-Id")
+		if transactionId is not None:
+			ret.append('Transaction-Id: %s%s' % (transactionId, SEPARATOR))
+		if self.body:
+			ret.append(SEPARATOR)
+			ret.append(self.body)
+		return ''.join(ret)
 
 	def getApplicationBody(self):
 		"""
@@ -182,11 +229,14 @@ class Message(object):
 		
 		# Then turn the content type into something higher level
 		if contentType == self.CONTENT_TYPE_JSON:
-			ret = JSON.loads(self.getBody())
+			ret = FastJSON.loads(self.getBody())
 			return ret
 		elif contentType == self.CONTENT_TYPE_PYTHON_PICKLE:
 			ret = pickle.loads(self.getBody())
 			return ret
+		elif contentType == self.CONTENT_TYPE_PYTHON_PICKLE_BINARY:
+			ret = pickle.loads(body)
+			return ret
 		elif contentType == self.CONTENT_TYPE_GZIP:
 			ret = zlib.decompress(body)
 			return ret
@@ -221,16 +271,7 @@ class Request(Message):
 		Encodes a message to a utf-8 string.
 		The final \00 is not part of the message, but just a transport separator.
 		"""
-		ret = [ "%s %s %s/%s" % (self.method, str(self.uri), self.protocol, self.version) ]
-		for (h, v) in self.headers.items():
-			ret.append("%s: %s" % (h, v.encode('utf-8')))
-		ret.append('')
-		if self.body:
-			if self.getContentEncoding() == self.ENCODING_UTF8:
-				ret.append(self.body) #.encode('utf-8')
-			else:
-				ret.append(self.body)
-		return SEPARATOR.join(ret)
+		return self._serialize("%s %s %s/%s" % (self.method, str(self.uri), self.protocol, self.version))
 
 	def getUri(self):
 		return self.uri
@@ -273,16 +314,7 @@ class Response(Message):
 		Encodes a message to a utf-8 string.
 		The final \00 is not part of the message, but just a transport separator.
 		"""
-		ret = [ "%s %s" % (str(self.statusCode), str(self.reasonPhrase)) ]
-		for (h, v) in self.headers.items():
-			ret.append("%s: %s" % (h, v.encode('utf-8')))
-		ret.append("")
-		if self.body:
-			if self.getContentEncoding() == self.ENCODING_UTF8:
-				ret.append(self.body) #.encode('utf-8')
-			else:
-				ret.append(self.body)
-		return SEPARATOR.join(ret)
+		return self._serialize("%s %s" % (str(self.statusCode), str(self.reasonPhrase)))
 
 	def getStatusCode(self):
 		return self.statusCode
@@ -293,16 +325,231 @@ class Response(Message):
 	def isResponse(self):
 		return True
 
+##
+# Application body profiles negotiation
+##
+
+# The profiles we can decode, in our preference order.
+# Advertised to peers in Accept headers.
+SUPPORTED_PROFILES = [ Message.CONTENT_TYPE_PYTHON_PICKLE_BINARY, Message.CONTENT_TYPE_PYTHON_PICKLE, Message.CONTENT_TYPE_JSON ]
+
+def getAcceptedProfiles():
+	"""
+	Returns the value of the Accept header to send to a peer
+	so that it can select a profile we support.
+	
+	@rtype: string
+	@returns: a comma-separated list of content types
+	"""
+	return ','.join(SUPPORTED_PROFILES)
+
+def selectProfile(accept, default = Message.CONTENT_TYPE_PYTHON_PICKLE):
+	"""
+	Selects the application body profile to use when sending to a peer,
+	according to the profiles it accepts.
+	
+	Older peers do not advertise anything: the default (legacy) profile
+	is used in this case.
+	
+	@type  accept: string, or None
+	@param accept: the Accept header value sent by the peer (comma-separated content types)
+	@type  default: string
+	@param default: the profile to use if the peer does not accept any profile we prefer
+	
+	@rtype: string
+	@returns: a profile, as one of the Message.CONTENT_TYPE_* values
+	"""
+	if not accept:
+		return default
+	accepted = [ x.strip() for x in accept.split(',') ]
+	for profile in SUPPORTED_PROFILES:
+		if profile in accepted:
+			return profile
+	return default
+
+
+##
+# Uri patterns
+##
+
+# A uri ending with this wildcard is a pattern matching any uri
+# starting with the rest of it (job:*, filesystem:/repository/myproject/*, ...)
+URI_WILDCARD = '*'
+
+def isUriPattern(uri):
+	"""
+	@type  uri: string
+	"""
+	return uri.endswith(URI_WILDCARD)
+
+class UriIndex(object):
+	"""
+	Values (typically subscribers) indexed by uri or uri pattern.
+	
+	Patterns are also indexed by prefix, together with the sorted distinct
+	prefix lengths, so that matching a uri costs one dict lookup per
+	prefix length, whatever the number of indexed uris and patterns.
+	
+	Updates must be serialized by the caller. Lookups (getValues, match,
+	hasMatch) may be performed concurrently without locking: the values
+	are immutable tuples, replaced on update.
+	"""
+	def __init__(self):
+		# dict[uri or pattern] = tuple of values
+		self._values = {}
+		# dict[pattern prefix] = tuple of values
+		self._prefixes = {}
+		self._prefixLengths = ()
+	
+	def add(self, uri, value):
+		"""
+		@rtype: bool
+		@returns: False if the value was already indexed for this uri
+		"""
+		values = self._values.get(uri, ())
+		if value in values:
+			return False
+		values += (value, )
+		self._values[uri] = values
+		if isUriPattern(uri):
+			self._setPrefix(uri[:-len(URI_WILDCARD)], values)
+		return True
+	
+	def remove(self, uri, value):
+		"""
+		@rtype: bool
+		@returns: False if the value was not indexed for this uri
+		"""
+		values = self._values.get(uri, ())
+		if not value in values:
+			return False
+		values = tuple([ x for x in values if x != value ])
+		if values:
+			self._values[uri] = values
+		else:
+			del self._values[uri]
+		if isUriPattern(uri):
+			self._setPrefix(uri[:-len(URI_WILDCARD)], values)
+		return True
+
+	def removeValue(self, value):
+		"""
+		Removes a value for all the uris it is indexed for.
+		
+		@rtype: list of strings
+		@returns: the uris (and patterns) the value was removed from
+		"""
+		ret = []
+		for (uri, values) in self._values.items():
+			if value in values:
+				self.remove(uri, value)
+				ret.append(uri)
+		return ret
+	
+	def _setPrefix(self, prefix, values):
+		if values:
+			self._prefixes[prefix] = values
+		elif self._prefixes.has_key(prefix):
+			del self._prefixes[prefix]
+		lengths = {}
+		for p in self._prefixes.keys():
+			lengths[len(p)] = None
+		self._prefixLengths = tuple(sorted(lengths.keys()))
+
+	def getValues(self, uri):
+		"""
+		@rtype: tuple
+		@returns: the values indexed for this exact uri (or pattern)
+		"""
+		return self._values.get(uri, ())
+	
+	def getUris(self):
+		"""
+		@rtype: list of strings
+		@returns: the indexed uris and patterns
+		"""
+		return self._values.keys()
+	
+	def match(self, uri):
+		"""
+		@rtype: tuple
+		@returns: the values indexed for this uri or for a pattern matching it,
+		without duplicates (exact uri values first)
+		"""
+		values = self._values.get(uri, ())
+		lengths = self._prefixLengths
+		if not lengths:
+			return values
+		prefixes = self._prefixes
+		ret = None
+		for length in lengths:
+			if length > len(uri):
+				break
+			matched = prefixes.get(uri[:length])
+			if matched:
+				if ret is None:
+					ret = list(values)
+				for value in matched:
+					if not value in ret:
+						ret.append(value)
+		if ret is None:
+			return values
+		return tuple(ret)
+
+	def hasMatch(self, uri):
+		"""
+		@rtype: bool
+		@returns: True if some values are indexed for this uri or for a pattern matching it
+		"""
+		if self._values.has_key(uri):
+			return True
+		prefixes = self._prefixes
+		for length in self._prefixLengths:
+			if length > len(uri):
+				break
+			if prefixes.has_key(uri[:length]):
+				return True
+		return False
+
+
 ##
 # Main message creator from data
 ##
 
+# Header names already parsed, interned.
+# Known names do not need to be validated again.
+_HeaderNames = {}
+MAX_HEADER_NAMES = 1024
+
+def _getHeaderName(name):
+	"""
+	Returns the interned header name, or None if this is not a valid name.
+	"""
+	ret = _HeaderNames.get(name)
+	if ret is None:
+		if not HEADERNAME_REGEXP.match(name):
+			return None
+		ret = intern(name)
+		if len(_HeaderNames) < MAX_HEADER_NAMES:
+			_HeaderNames[ret] = ret
+	return ret
+
 def parse(data):
 	"""
 	Parses data into a Message (either a Notification, Request, Response, actually).
 	Raises an exception in case of an invalid message.
+	
+	Only the header block is split into lines,
+	the body is taken as a single slice of data.
 	"""
-	lines = data.split(SEPARATOR)
+	# The header block ends with the first empty line
+	end = data.find(SEPARATOR + SEPARATOR)
+	if end < 0:
+		lines = data.split(SEPARATOR)
+		body = ''
+	else:
+		lines = data[:end].split(SEPARATOR)
+		body = data[end+2:]
 
 	# request line, for request and notifications
 	m = REQUESTLINE_REGEXP.match(lines[0])
@@ -317,22 +564,100 @@ def parse(data):
 		# This is a response
 		message = Response(statusCode = m.group('status'), reasonPhrase = m.group('reason'))
 
-	# Common part: headers parsing, body parsing.
-	i = 1
+	# Common part: headers parsing
+	headers = message.headers
 	for header in lines[1:]:
-		i += 1
-		l = header.strip()
 		if not header:
-			break # reached body
-		m = HEADERLINE_REGEXP.match(l)
-		if m:
-			message.setHeader(m.group('header'), m.group('value').decode('utf-8'))
-		else:
-			raise Exception("Invalid header in message (%s)" % str(l))
+			break # reached the end of data without a body
+		(name, sep, value) = header.strip().partition(':')
+		name = _getHeaderName(name.rstrip())
+		if not sep or name is None:
+			raise Exception("Invalid header in message (%s)" % header.strip())
+		# Values are kept utf-8 encoded, as set by Message.setHeader()
+		headers[name] = value.lstrip()
 	
 	# Body - raw, no additional decoding or interpretation.
 	# use getApplicationBody() for that.
-	message.setBody(SEPARATOR.join(lines[i:]))
+	message.setBody(body)
 
 	# OK, we're done.
 	return message
+
+
+################################################################################
+# Application body profiles benchmark
+################################################################################
+
+def _benchmarkProfile(payload, profile, count):
+	"""
+	Returns (encoding duration, decoding duration, size) for count messages,
+	or None if the payload cannot be encoded with this profile.
+	"""
+	import time
+
+	notification = Notification("TRI-ENQUEUE-MSG", "probe:sip@agent", "Xa", "1.0")
+	try:
+		notification.setApplicationBody(payload, profile)
+	except Exception:
+		return None
+
+	start = time.time()
+	for i in xrange(count):
+		notification = Notification("TRI-ENQUEUE-MSG", "probe:sip@agent", "Xa", "1.0")
+		notification.setApplicationBody(payload, profile)
+		data = str(notification)
+	encoding = time.time() - start
+
+	start = time.time()
+	for i in xrange(count):
+		parse(data).getApplicationBody()
+	decoding = time.time() - start
+
+	assert parse(data).getApplicationBody() == payload
+	return (encoding, decoding, len(data))
+
+def benchmark(count = 5000):
+	"""
+	Compares the application body profiles on typical probe payloads:
+	a decoded SIP INVITE as sent/received by a SIP probe,
+	and an RTP event carrying a binary voice frame.
+	"""
+	import random
+
+	sdp = "v=0\r\no=user1 53655765 2353687637 IN IP4 192.168.1.10\r\ns=-\r\nc=IN IP4 192.168.1.10\r\nt=0 0\r\nm=audio 6000 RTP/AVP 0 8 101\r\na=rtpmap:0 PCMU/8000\r\na=rtpmap:8 PCMA/8000\r\na=rtpmap:101 telephone-event/8000\r\n"
+	sip = {
+		'method': 'INVITE',
+		'uri': 'sip:bob@example.com',
+		'version': 'SIP/2.0',
+		'headers': {
+			'via': 'SIP/2.0/UDP 192.168.1.10:5060;branch=z9hG4bK776asdhds',
+			'max-forwards': '70',
+			'to': 'Bob <sip:bob@example.com>',
+			'from': 'Alice <sip:alice@example.com>;tag=1928301774',
+			'call-id': 'a84b4c76e66710@192.168.1.10',
+			'cseq': '314159 INVITE',
+			'contact': '<sip:alice@192.168.1.10>',
+			'content-type': 'application/sdp',
+			'content-length': str(len(sdp)),
+		},
+		'body': sdp,
+	}
+	random.seed(0)
+	rtp = {
+		'version': 2, 'padding': False, 'extension': False, 'marker': False,
+		'payloadType': 8, 'sequenceNumber': 12345, 'timestamp': 160000, 'ssrc': 0x1234abcd,
+		'payload': ''.join([ chr(random.randint(0, 255)) for i in range(160) ]),
+	}
+
+	for (name, payload) in [ ('SIP INVITE', sip), ('RTP event', rtp) ]:
+		print "%s, %s messages:" % (name, count)
+		for profile in SUPPORTED_PROFILES:
+			ret = _benchmarkProfile(payload, profile, count)
+			if ret is None:
+				print "  %-36s not applicable" % profile
+			else:
+				(encoding, decoding, size) = ret
+				print "  %-36s encoding %6.1f us, decoding %6.1f us, %5d bytes" % (profile, encoding * 1000000.0 / count, decoding * 1000000.0 / count, size)
+
+if __name__ == '__main__':
+	benchmark()
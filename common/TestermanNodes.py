@@ -26,7 +26,8 @@
 #
 # Layered structures:
 # Network level:
-# - send/receive packets (stream + packetizer)
+# - send/receive packets (stream + packetizer), terminated or length-prefixed
+#   (negotiated on connection)
 # - passive keep-alive mechanism (regularly send a KA packet, incoming 
 #   inactivity timeout to detect dropped connections)
 # - provided by TcpPacketizerServerThread and TcpPacketizerClientThread.
@@ -41,7 +42,8 @@
 # - able to encode/decode Testerman Messages, managing transaction Ids,
 #   retransmissions (when they are implemented), etc
 # - provides high level function to send/receive messages and
-#   execute synchronous requests on a remote node.
+#   execute synchronous requests on a remote node, or asynchronous ones
+#   (several requests in flight, responses returned as futures).
 # - implemented in class BaseNode
 # - plugged on a Connector (in fact, we plug a connector to it).
 # - thread switcher ensuring that low levels are never blocked,
@@ -56,6 +58,7 @@
 
 import TestermanMessages as Messages
 
+import heapq
 import threading
 import select
 import socket
@@ -63,6 +66,7 @@ import Queue
 import SocketServer
 import time
 import os
+import struct
 import sys
 import traceback
 import StringIO
@@ -81,6 +85,189 @@ def getBacktrace():
 	return ret
 
 
+################################################################################
+# Packet framing
+################################################################################
+
+# Legacy packets are delimited by a terminator character (a null character),
+# and thus cannot contain it.
+#
+# Length-prefixed frames are made of FRAME_MARKER, the payload length
+# (32-bit, big endian), then the payload. They can contain any data,
+# and are received without searching for a terminator.
+#
+# A connecting peer proposes the length-prefixed framing by sending
+# FRAMING_LENGTH_PDU as its first (legacy) packet. A listening peer
+# that supports it sends FRAMING_LENGTH_PDU back, then both peers
+# send length-prefixed frames only.
+# Older peers ignore this proposal (this is not a valid message),
+# so that they keep using legacy packets.
+# Both framings are always accepted on reception, since a legacy packet
+# cannot start with FRAME_MARKER.
+FRAME_MARKER = '\x01'
+FRAMING_LENGTH_PDU = 'FRAMING length'
+
+_FrameLength = struct.Struct('>I')
+
+# Queued packets are coalesced into a single send, up to this size (bytes)
+MAX_COALESCED_SEND_SIZE = 262144
+
+def encodePacket(packet, terminator, lengthFraming):
+	"""
+	Returns the chunks to send for a packet.
+	
+	@type  lengthFraming: bool
+	@param lengthFraming: True to use a length-prefixed frame,
+	False to use a legacy, terminated packet
+	
+	@rtype: tuple of strings
+	"""
+	if lengthFraming:
+		return (FRAME_MARKER + _FrameLength.pack(len(packet)), packet)
+	else:
+		return (packet, terminator)
+
+def getQueuedData(queue):
+	"""
+	Gets the data to send for the next packets in queue,
+	coalesced up to MAX_COALESCED_SEND_SIZE so that they are sent
+	with a single system call.
+	
+	@type  queue: Queue.Queue of tuples of strings (see encodePacket())
+	
+	@raises Queue.Empty: if the queue is empty
+	@rtype: string
+	"""
+	chunks = list(queue.get(False))
+	size = sum([ len(x) for x in chunks ])
+	try:
+		while size < MAX_COALESCED_SEND_SIZE:
+			packet = tuple(queue.get(False))
+			chunks.extend(packet)
+			size += sum([ len(x) for x in packet ])
+	except Queue.Empty:
+		pass
+	return ''.join(chunks)
+
+
+
+################################################################################
+# Outbound queues
+################################################################################
+
+# On a listening server, the packets to send to each connected peer are
+# queued, then written by the thread handling the peer connection.
+# These queues may be bounded (see ListeningNode.initialize()); when a queue
+# is full, the server applies one of these policies:
+QUEUE_FULL_BLOCK = 'block' # wait for the queue to be consumed
+QUEUE_FULL_DROP_OLDEST = 'drop-oldest' # drop the oldest queued packets
+QUEUE_FULL_DISCONNECT = 'disconnect' # disconnect the peer, dropping the packet
+
+QUEUE_FULL_POLICIES = [ QUEUE_FULL_BLOCK, QUEUE_FULL_DROP_OLDEST, QUEUE_FULL_DISCONNECT ]
+
+class _ReliablePacket(tuple):
+	"""
+	A queued packet that is never dropped nor delayed by the queue full
+	policy (the chunks to send, see encodePacket()), typically a packet
+	the peer cannot recover if lost.
+	"""
+	pass
+
+class _CoalescingPacket:
+	"""
+	A queued packet sent with a coalescing key: until it is dequeued,
+	a packet sent with the same key replaces its data, keeping its
+	position in the queue (typically, a state notification for which only
+	the latest value matters).
+	
+	Iterated (as the tuple of strings to send, see encodePacket())
+	when dequeued.
+	"""
+	def __init__(self, handler, key, data):
+		self.handler = handler
+		self.key = key
+		self.data = data
+	
+	def __iter__(self):
+		self.handler.queue_condition.acquire()
+		try:
+			self.forget()
+			return iter(self.data)
+		finally:
+			self.handler.queue_condition.release()
+	
+	def forget(self):
+		"""
+		Called with the handler queue_condition held.
+		The packet cannot be replaced anymore.
+		"""
+		if self.handler.coalescing.get(self.key) is self:
+			del self.handler.coalescing[self.key]
+
+
+class PacketDecoder:
+	"""
+	Splits an incoming stream into packets, either length-prefixed
+	frames or legacy terminated packets.
+	
+	Received data are appended to a bytearray, consumed from a read offset.
+	The buffer is only compacted when a large part of it was consumed,
+	and the terminator search resumes where the previous one stopped,
+	so that decoding remains linear even with large packets received
+	in many chunks.
+	"""
+	COMPACT_THRESHOLD = 65536
+	
+	def __init__(self, terminator):
+		self._terminator = terminator
+		self._buffer = bytearray()
+		self._offset = 0
+		self._searchFrom = 0
+
+	def feed(self, data):
+		"""
+		@type  data: string
+		@param data: received data
+		
+		@rtype: list of strings
+		@returns: the packets completed by these data
+		"""
+		buf = self._buffer
+		buf.extend(data)
+		length = len(buf)
+		offset = self._offset
+		marker = ord(FRAME_MARKER)
+		packets = []
+		while offset < length:
+			if buf[offset] == marker:
+				if length < offset + 5:
+					break
+				(size, ) = _FrameLength.unpack_from(buf, offset + 1)
+				end = offset + 5 + size
+				if end > length:
+					break
+				packets.append(str(buffer(buf, offset + 5, size)))
+				offset = end
+			else:
+				end = buf.find(self._terminator, max(offset, self._searchFrom))
+				if end < 0:
+					self._searchFrom = length
+					break
+				packets.append(str(buffer(buf, offset, end - offset)))
+				offset = end + 1
+
+		if offset == length:
+			del buf[:]
+			offset = 0
+			self._searchFrom = 0
+		elif offset > self.COMPACT_THRESHOLD and offset * 2 > length:
+			del buf[:offset]
+			self._searchFrom = max(0, self._searchFrom - offset)
+			offset = 0
+		self._offset = offset
+		return packets
+
+
 ################################################################################
 # Reusable Tcp client class
 ################################################################################
@@ -90,6 +277,8 @@ class TcpPacketizerClientThread(threading.Thread):
 	Simple TCP client that keeps reconnecting to a server.
 	It also sends "packets" separated with a single terminator character, 
 	and packetizes incoming stream, too.
+	If propose_length_framing is set, it proposes to use length-prefixed
+	frames instead (see FRAMING_LENGTH_PDU).
 	
 	Once constructed, you may use:
 		start()
@@ -104,6 +293,7 @@ class TcpPacketizerClientThread(threading.Thread):
 	"""
 
 	terminator = '\x00'
+	propose_length_framing = True
 
 	def __init__(self, server_address, local_address = ('', 0), reconnection_interval = 1.0, inactivity_timeout = 30.0, keep_alive_interval = 20.0):
 		"""
@@ -116,7 +306,8 @@ class TcpPacketizerClientThread(threading.Thread):
 		self.stopEvent = threading.Event()
 		self.reconnectInterval = reconnection_interval
 		self.socket = None
-		self.buf = ''
+		self.decoder = PacketDecoder(self.terminator)
+		self.length_framing = False
 		self.queue = Queue.Queue(0)
 		self.connected = False
 		self.inactivity_timeout = inactivity_timeout
@@ -140,7 +331,8 @@ class TcpPacketizerClientThread(threading.Thread):
 		self.trace("Tcp client started, connecting from %s to %s" % (str(self.localAddress), str(self.serverAddress)))
 		while not self.stopEvent.isSet():
 			try:
-				self.buf = ''
+				self.decoder = PacketDecoder(self.terminator)
+				self.length_framing = False
 				# Keep connected
 				self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 				self.socket.bind(self.localAddress)
@@ -172,6 +364,9 @@ class TcpPacketizerClientThread(threading.Thread):
 				# OK, we are connected. Let's raise our connection callback.
 				self.trace("Connected.")
 				self.connected = True
+				if self.propose_length_framing:
+					# Must be our first packet
+					self.send_packet(FRAMING_LENGTH_PDU)
 				self.on_connection()
 				# Polling loop
 				self.__main_receive_send_loop()
@@ -238,8 +433,7 @@ class TcpPacketizerClientThread(threading.Thread):
 					if not read:
 						raise EOFError("Nothing to read on read event: disconnecting")
 					self.last_activity_timestamp = current_time
-					self.buf = ''.join([self.buf, read]) # faster than += r
-					self.__on_incoming_data()
+					self.__on_incoming_data(read)
 
 				# select timeout - we post a keep_alive right now
 				if not r and not w and not e:
@@ -275,8 +469,7 @@ class TcpPacketizerClientThread(threading.Thread):
 							raise EOFError("Socket select error when sending a message: disconnecting")
 						elif self.socket in ready:
 							try:
-								message = self.queue.get(False)
-								self.socket.sendall(message)
+								self.socket.sendall(getQueuedData(self.queue))
 							except Queue.Empty:
 								pass
 							except Exception, e:
@@ -294,8 +487,7 @@ class TcpPacketizerClientThread(threading.Thread):
 				if self.socket in w:
 					while not self.queue.empty():
 						try:
-							message = self.queue.get(False)
-							self.socket.sendall(message)
+							self.socket.sendall(getQueuedData(self.queue))
 						except Queue.Empty:
 							pass
 						except Exception, e:
@@ -349,8 +541,7 @@ class TcpPacketizerClientThread(threading.Thread):
 					if not read:
 						raise EOFError("Nothing to read on read event: disconnecting")
 					self.last_activity_timestamp = time.time()
-					self.buf = ''.join([self.buf, read]) # faster than += r
-					self.__on_incoming_data()
+					self.__on_incoming_data(read)
 
 				# Check inactivity timeout 
 				elif self.inactivity_timeout:
@@ -372,8 +563,7 @@ class TcpPacketizerClientThread(threading.Thread):
 						raise EOFError("Socket select error when sending a message: disconnecting")
 					elif self.socket in w:	
 						try:
-							message = self.queue.get(False)
-							self.socket.sendall(message)
+							self.socket.sendall(getQueuedData(self.queue))
 						except Queue.Empty:
 							pass
 						except Exception, e:
@@ -394,14 +584,15 @@ class TcpPacketizerClientThread(threading.Thread):
 				self.trace("Exception in main pool for incoming data: " + str(e))
 				pass
 
-	def __on_incoming_data(self):
-		pdus = self.buf.split(self.terminator)
-		for pdu in pdus[:-1]:
-			if not pdu == KEEP_ALIVE_PDU:
-				self.handle_packet(pdu)
-			else:
+	def __on_incoming_data(self, data):
+		for pdu in self.decoder.feed(data):
+			if pdu == KEEP_ALIVE_PDU:
 				self.trace("Received Keep Alive")
-		self.buf = pdus[-1]
+			elif pdu == FRAMING_LENGTH_PDU:
+				self.trace("Length-prefixed framing accepted by the server")
+				self.length_framing = True
+			else:
+				self.handle_packet(pdu)
 
 	def stop(self):
 		self.stopEvent.set()
@@ -411,7 +602,7 @@ class TcpPacketizerClientThread(threading.Thread):
 		self.join()
 
 	def send_packet(self, packet):
-		self.queue.put(packet + self.terminator)
+		self.queue.put(encodePacket(packet, self.terminator, self.length_framing))
 		if not self._windowsPlatform:
 			os.write(self.control_write, 'a')
 	
@@ -484,13 +675,16 @@ class TcpPacketizerServerThread(threading.Thread):
 		allow_reuse_address = True
 
 		terminator = '\x00'
-		def __init__(self, listening_address, request_handler, manager, inactivity_timeout = 30.0, keep_alive_interval = 20.0):
+		def __init__(self, listening_address, request_handler, manager, inactivity_timeout = 30.0, keep_alive_interval = 20.0, max_queue_size = 0, queue_full_policy = QUEUE_FULL_BLOCK):
 			SocketServer.TCPServer.__init__(self, listening_address, request_handler)
 			self.manager = manager
 			self.mutex = threading.RLock()
 			self.clients = {} # client object per client_address
 			self.inactivity_timeout = inactivity_timeout
 			self.keep_alive_interval = keep_alive_interval
+			# Outbound queue bound per client, in packets (0: unbounded)
+			self.max_queue_size = max_queue_size
+			self.queue_full_policy = queue_full_policy
 		
 		def handle_packet(self, client, packet):
 			self.manager.handle_packet(client.client_address, packet)
@@ -512,7 +706,7 @@ class TcpPacketizerServerThread(threading.Thread):
 			self.mutex.release()
 			self.manager.on_disconnection(client.client_address)
 		
-		def send_packet(self, client_address, packet):
+		def send_packet(self, client_address, packet, coalesce_key = None, reliable = False):
 #			self.trace("[DEBUG] sending packet to client: " + str(client_address))
 			self.mutex.acquire()
 			if self.clients.has_key(client_address):
@@ -522,7 +716,35 @@ class TcpPacketizerServerThread(threading.Thread):
 			self.mutex.release()
 			if client:
 #				self.trace("[DEBUG] client found for: " + str(client_address))
-				client.send_packet(packet)
+				client.send_packet(packet, coalesce_key = coalesce_key, reliable = reliable)
+		
+		def wait_queue_depth(self, client_address, max_depth, timeout):
+			"""
+			Waits until at most max_depth packets are queued for a client.
+			
+			@rtype: bool
+			@returns: True if at most max_depth packets are queued, False
+			on timeout or if the client is not connected (anymore)
+			"""
+			self.mutex.acquire()
+			client = self.clients.get(client_address)
+			self.mutex.release()
+			if not client:
+				return False
+			return client.wait_queue_depth(max_depth, timeout)
+		
+		def get_channel_stats(self):
+			"""
+			Returns the outbound queue depth (in packets), the number
+			of dropped packets and the number of packets replaced by a more
+			recent one (coalesced) for each connected client.
+			
+			@rtype: list of dict(address, queue-depth, dropped, coalesced)
+			"""
+			self.mutex.acquire()
+			clients = self.clients.items()
+			self.mutex.release()
+			return [ { 'address': address, 'queue-depth': client.queue.qsize(), 'dropped': client.dropped_count, 'coalesced': client.coalesced_count } for (address, client) in clients ]
 		
 		def trace(self, txt):
 			self.manager.trace(txt)
@@ -546,7 +768,8 @@ class TcpPacketizerServerThread(threading.Thread):
 	class TcpPacketizerRequestHandler(SocketServer.BaseRequestHandler):
 		"""
 		This request handler is able to de-packetize incoming stream according to
-		a single byte packet limiter character.
+		a single byte packet limiter character, or length-prefixed frames once
+		proposed by the client (see FRAMING_LENGTH_PDU).
 		For each packet, will raise a handle_packet(packet).
 		You may send packets using send_packet(packet).
 		
@@ -558,8 +781,19 @@ class TcpPacketizerServerThread(threading.Thread):
 
 		def __init__(self, request, client_address, server):
 			self.stopEvent = threading.Event()
-			self.buf = ''
+			self.decoder = PacketDecoder(self.terminator)
+			self.length_framing = False
 			self.queue = Queue.Queue(0)
+			# Protects the wakeup flag and the drop counter,
+			# and signals the consumption of the queue (QUEUE_FULL_BLOCK)
+			self.queue_condition = threading.Condition(threading.Lock())
+			self.wakeup_pending = False
+			self.dropped_count = 0
+			# The number of threads waiting for the queue to be consumed (wait_queue_depth)
+			self.depth_waiters = 0
+			# The queued packets that may still be replaced, per coalescing key
+			self.coalescing = {}
+			self.coalesced_count = 0
 			self.socket = None
 			self.last_activity_timestamp = time.time()
 			self.last_keep_alive_timestamp = time.time()
@@ -632,8 +866,7 @@ class TcpPacketizerServerThread(threading.Thread):
 					if not read:
 						raise EOFError("Nothing to read on read event: disconnecting")
 					self.last_activity_timestamp = current_time
-					self.buf = ''.join([self.buf, read]) # faster than += r
-					self.__on_incoming_data()
+					self.__on_incoming_data(read)
 
 				if not r and not w and not e:
 					# Check inactivity timeout 
@@ -646,7 +879,7 @@ class TcpPacketizerServerThread(threading.Thread):
 						if current_time - self.last_keep_alive_timestamp > self.server.keep_alive_interval:
 							self.last_keep_alive_timestamp = current_time
 							self.trace("Sending Keep Alive")
-							self.send_packet(KEEP_ALIVE_PDU)
+							self.send_packet(KEEP_ALIVE_PDU, control = True)
 							# Make sure the KA will be sent during this iteration
 							if not self.control_read in r:
 								r.append(self.control_read)
@@ -654,7 +887,11 @@ class TcpPacketizerServerThread(threading.Thread):
 				# Received a send or stop notification from the higher level layers
 				if self.control_read in r:
 					# Consume the notification(s), if any, to avoid a pipe overflow.
+					# Packets queued from now on will need a new notification.
+					self.queue_condition.acquire()
 					os.read(self.control_read, 10000)
+					self.wakeup_pending = False
+					self.queue_condition.release()
 					# If the queue is not empty, we assume this is a send notification.
 					# In this case, we first try to send messages now, not waiting for the next loop iteration
 					# This way, we avoid leaving some important messages in the sending queue while
@@ -668,8 +905,8 @@ class TcpPacketizerServerThread(threading.Thread):
 							raise EOFError("Socket select error when sending a message: disconnecting")
 						elif self.socket in ready:
 							try:
-								message = self.queue.get(False)
-								self.socket.sendall(message)
+								self.socket.sendall(getQueuedData(self.queue))
+								self.__on_queue_consumed()
 							except Queue.Empty:
 								pass
 							except Exception, e:
@@ -687,8 +924,8 @@ class TcpPacketizerServerThread(threading.Thread):
 				if self.socket in w:
 					while not self.queue.empty():
 						try:
-							message = self.queue.get(False)
-							self.socket.sendall(message)
+							self.socket.sendall(getQueuedData(self.queue))
+							self.__on_queue_consumed()
 						except Queue.Empty:
 							pass
 						except IOError, e:
@@ -716,28 +953,162 @@ class TcpPacketizerServerThread(threading.Thread):
 						timeout = next_ka_in
 
 	
-		def __on_incoming_data(self):
+		def __on_incoming_data(self, data):
 			"""
 			New internal method.
 			"""
-			# self.buf contains all received data.
-			# Let's check if we can consume them, i.e. PDUs/packets are available.
-			pdus = self.buf.split(self.terminator)
-			for pdu in pdus[:-1]:
-				if not pdu == KEEP_ALIVE_PDU:
-					self.handle_packet(pdu)
-				else:
+			for pdu in self.decoder.feed(data):
+				if pdu == KEEP_ALIVE_PDU:
 					self.trace("Received Keep Alive")
-			self.buf = pdus[-1]
+				elif pdu == FRAMING_LENGTH_PDU:
+					# Acknowledge (as a legacy packet), then switch to length-prefixed frames
+					self.trace("Switching to length-prefixed framing")
+					self.send_packet(FRAMING_LENGTH_PDU, control = True)
+					self.length_framing = True
+				else:
+					self.handle_packet(pdu)
 
-		def send_packet(self, packet):
+		def send_packet(self, packet, control = False, coalesce_key = None, reliable = False):
 			"""
 			New method.
 			Sends a packet with the terminator.
+			
+			If the outbound queue is full (see ListeningServer.max_queue_size),
+			the server queue full policy is applied first, unless this is
+			a control packet sent by the handler itself (keep alive, framing)
+			or a reliable packet.
+			
+			If a coalesce_key is provided and a packet with the same key
+			is still queued, this packet replaces it instead of being queued.
+			
+			A reliable packet is queued even if the queue is full, and
+			is never dropped to make room for other packets.
 			"""
 			# Asynchronous send.
-			self.queue.put(packet + self.terminator)
-			os.write(self.control_write, 'a')
+			data = encodePacket(packet, self.terminator, self.length_framing)
+			if reliable:
+				data = _ReliablePacket(data)
+				coalesce_key = None
+			if coalesce_key is not None:
+				self.queue_condition.acquire()
+				try:
+					queued = self.coalescing.get(coalesce_key)
+					if queued is not None:
+						queued.data = data
+						self.coalesced_count += 1
+						return
+				finally:
+					self.queue_condition.release()
+			max_size = self.server.max_queue_size
+			if max_size and not control and not reliable and self.queue.qsize() >= max_size:
+				if not self.__make_room(max_size):
+					return
+			if coalesce_key is not None:
+				self.queue_condition.acquire()
+				data = _CoalescingPacket(self, coalesce_key, data)
+				self.coalescing[coalesce_key] = data
+				self.queue.put(data)
+				self.queue_condition.release()
+			else:
+				self.queue.put(data)
+			# Only notify the handler once until it consumes the notification,
+			# so that the control pipe cannot fill up (and block us)
+			self.queue_condition.acquire()
+			notify = not self.wakeup_pending
+			self.wakeup_pending = True
+			self.queue_condition.release()
+			if notify:
+				os.write(self.control_write, 'a')
+
+		def __make_room(self, max_size):
+			"""
+			Applies the queue full policy.
+			
+			@rtype: bool
+			@returns: True if the packet can be queued, False if it must be dropped
+			"""
+			policy = self.server.queue_full_policy
+			self.queue_condition.acquire()
+			try:
+				if policy == QUEUE_FULL_DROP_OLDEST:
+					return self.__drop_oldest(max_size)
+				elif policy == QUEUE_FULL_DISCONNECT:
+					self.dropped_count += 1
+					self.trace("Outbound queue full (%s packets) - disconnecting" % max_size)
+					self.stop()
+					return False
+				else:
+					while self.queue.qsize() >= max_size and not self.stopEvent.isSet():
+						self.queue_condition.wait(1.0)
+					if self.stopEvent.isSet():
+						self.dropped_count += 1
+						return False
+					return True
+			finally:
+				self.queue_condition.release()
+
+		def __drop_oldest(self, max_size):
+			"""
+			Drops the oldest queued packets, skipping the reliable ones,
+			until there is some room in the queue.
+			Called with the queue_condition held.
+			
+			@rtype: bool
+			@returns: True if the packet can be queued, False if it must
+			be dropped (the queue only contains reliable packets)
+			"""
+			self.queue.mutex.acquire()
+			try:
+				packets = self.queue.queue
+				i = 0
+				while len(packets) >= max_size and i < len(packets):
+					if isinstance(packets[i], _ReliablePacket):
+						i += 1
+						continue
+					dropped = packets[i]
+					del packets[i]
+					if isinstance(dropped, _CoalescingPacket):
+						dropped.forget()
+					self.dropped_count += 1
+				if len(packets) < max_size:
+					return True
+				self.dropped_count += 1
+				return False
+			finally:
+				self.queue.mutex.release()
+
+		def wait_queue_depth(self, max_depth, timeout):
+			"""
+			New method.
+			Waits until at most max_depth packets are queued,
+			so that a sender can pace itself on the client consumption.
+			
+			@rtype: bool
+			@returns: True if at most max_depth packets are queued, False
+			on timeout or if the client is disconnected
+			"""
+			deadline = time.time() + timeout
+			self.queue_condition.acquire()
+			self.depth_waiters += 1
+			try:
+				while self.queue.qsize() > max_depth and not self.stopEvent.isSet():
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						return False
+					self.queue_condition.wait(min(remaining, 1.0))
+				return not self.stopEvent.isSet()
+			finally:
+				self.depth_waiters -= 1
+				self.queue_condition.release()
+
+		def __on_queue_consumed(self):
+			"""
+			Wakes up the senders waiting for some room in the queue, if any.
+			"""
+			if self.depth_waiters or (self.server.max_queue_size and self.server.queue_full_policy == QUEUE_FULL_BLOCK):
+				self.queue_condition.acquire()
+				self.queue_condition.notifyAll()
+				self.queue_condition.release()
 
 		def handle_packet(self, packet):
 			"""
@@ -765,11 +1136,11 @@ class TcpPacketizerServerThread(threading.Thread):
 			self.server.trace("[tcphandler] %s %s" % (str(self.client_address), txt))
 
 
-	def __init__(self, listening_address, inactivity_timeout = 30.0, keep_alive_interval = 20.0):
+	def __init__(self, listening_address, inactivity_timeout = 30.0, keep_alive_interval = 20.0, max_queue_size = 0, queue_full_policy = QUEUE_FULL_BLOCK):
 		threading.Thread.__init__(self)
 		self.stopEvent = threading.Event()
 		self.listening_address = listening_address
-		self.server = self.ListeningServer(self.listening_address, self.TcpPacketizerRequestHandler, self, inactivity_timeout, keep_alive_interval)
+		self.server = self.ListeningServer(self.listening_address, self.TcpPacketizerRequestHandler, self, inactivity_timeout, keep_alive_interval, max_queue_size, queue_full_policy)
 
 	def run(self):
 		self.trace("Tcp server started, listening on %s" % (str(self.listening_address)))
@@ -781,8 +1152,14 @@ class TcpPacketizerServerThread(threading.Thread):
 		self.stopEvent.set()
 		self.join()
 	
-	def send_packet(self, client_address, packet):
-		self.server.send_packet(client_address, packet)
+	def send_packet(self, client_address, packet, coalesce_key = None, reliable = False):
+		self.server.send_packet(client_address, packet, coalesce_key, reliable)
+	
+	def wait_queue_depth(self, client_address, max_depth, timeout):
+		return self.server.wait_queue_depth(client_address, max_depth, timeout)
+	
+	def get_channel_stats(self):
+		return self.server.get_channel_stats()
 	
 	##
 	# To reimplement
@@ -867,12 +1244,18 @@ class IConnector:
 		"""
 		self._onTraceCallback = callback
 
-	def sendMessage(self, channel, message):
+	def sendMessage(self, channel, message, coalesceKey = None, reliable = False):
 		"""
 		Call this when you want to send a message (packet) through a (connected) channel.
 		
 		@type  message: string/buffer
 		@param message: the raw message/packet to send.
+		@type  coalesceKey: any hashable, or None
+		@param coalesceKey: if provided, the message replaces any message
+		with the same key that is still queued for this channel (if supported)
+		@type  reliable: bool
+		@param reliable: if True, the message is never dropped because
+		the channel outbound queue is full (if supported)
 		"""
 		pass
 		
@@ -899,8 +1282,8 @@ class ListeningConnectorThread(TcpPacketizerServerThread, IConnector):
 	 setMessageCallback(cb(channel, TestermanMessages.Message))
 	 setTracer(cb(string))
 	"""	
-	def __init__(self, listeningAddress, inactivityTimeout = 30.0):
-		TcpPacketizerServerThread.__init__(self, listeningAddress, inactivityTimeout)
+	def __init__(self, listeningAddress, inactivityTimeout = 30.0, maxQueueSize = 0, queueFullPolicy = QUEUE_FULL_BLOCK):
+		TcpPacketizerServerThread.__init__(self, listeningAddress, inactivityTimeout, max_queue_size = maxQueueSize, queue_full_policy = queueFullPolicy)
 		IConnector.__init__(self)
 		self._contact = listeningAddress
 
@@ -939,11 +1322,11 @@ class ListeningConnectorThread(TcpPacketizerServerThread, IConnector):
 		if self._onTraceCallback:
 			self._onTraceCallback(txt)
 
-	def sendMessage(self, channel, message):
+	def sendMessage(self, channel, message, coalesceKey = None, reliable = False):
 		"""
 		Reimplemented for IConnector
 		"""
-		self.send_packet(channel, str(message))
+		self.send_packet(channel, str(message), coalesceKey, reliable)
 
 # TODO
 #	def disconnect(self, channel):
@@ -952,6 +1335,24 @@ class ListeningConnectorThread(TcpPacketizerServerThread, IConnector):
 	def getLocalAddress(self):
 		return self._contact
 	
+	def waitQueueDepth(self, channel, maxDepth, timeout):
+		"""
+		@rtype: bool
+		@returns: True once at most maxDepth messages are waiting to be sent
+		to channel, False on timeout or if the channel is disconnected
+		"""
+		return self.wait_queue_depth(channel, maxDepth, timeout)
+	
+	def getChannelStats(self):
+		"""
+		@rtype: list of dict(channel, queue-depth, dropped, coalesced)
+		@returns: the outbound queue statistics for each connected channel
+		"""
+		ret = []
+		for stats in self.get_channel_stats():
+			ret.append({ 'channel': stats['address'], 'queue-depth': stats['queue-depth'], 'dropped': stats['dropped'], 'coalesced': stats['coalesced'] })
+		return ret
+	
 
 class ConnectingConnectorThread(TcpPacketizerClientThread, IConnector):
 	"""
@@ -1003,9 +1404,11 @@ class ConnectingConnectorThread(TcpPacketizerClientThread, IConnector):
 		if self._onTraceCallback:
 			self._onTraceCallback(txt)
 
-	def sendMessage(self, channel, message):
+	def sendMessage(self, channel, message, coalesceKey = None, reliable = False):
 		"""
 		Reimplemented for IConnector
+		(the coalescing key and the reliable flag are ignored: connecting
+		connectors have no bounded queue)
 		"""
 		self.trace("sendMessage from ConnectingThread")
 		self.send_packet(str(message))
@@ -1031,6 +1434,88 @@ class ConnectingConnectorThread(TcpPacketizerClientThread, IConnector):
 # The Peer Node.
 ################################################################################
 
+class ResponseFuture(object):
+	"""
+	The pending response to a request sent with BaseNode.executeRequestAsync().
+	
+	The future is completed with the response when it is received,
+	or with None when the request timed out (or the node was stopped).
+	"""
+	def __init__(self, transactionId):
+		self._transactionId = transactionId
+		self._response = None
+		self._mutex = threading.Lock()
+		self._completed = False
+		# Held until the future is completed, so that waiting
+		# for the response is a simple blocking acquire
+		self._completionLock = threading.Lock()
+		self._completionLock.acquire()
+		self._callbacks = []
+	
+	def getTransactionId(self):
+		return self._transactionId
+	
+	def isDone(self):
+		"""
+		@rtype: bool
+		@returns: True if the response was received, or the request timed out
+		"""
+		return self._completed
+	
+	def getResponse(self):
+		"""
+		Waits for the future completion.
+		
+		@rtype: Messages.Response, or None
+		@returns: the response, or None if the request timed out
+		"""
+		self._completionLock.acquire()
+		self._completionLock.release()
+		return self._response
+
+	def addCallback(self, callback):
+		"""
+		Registers a callback to call with the response (or None)
+		once the future is completed, immediately if it is already done.
+		
+		The callback is called from a network or timeout thread:
+		it must not block (in particular, it must not execute requests).
+		
+		@type  callback: callable(Messages.Response or None)
+		"""
+		self._mutex.acquire()
+		if not self._completed:
+			self._callbacks.append(callback)
+			self._mutex.release()
+			return
+		self._mutex.release()
+		callback(self._response)
+
+	def _complete(self, response):
+		"""
+		Completes the future. Only the first completion is taken into account.
+		
+		@rtype: bool
+		@returns: True if the future was completed by this call
+		"""
+		self._mutex.acquire()
+		if self._completed:
+			self._mutex.release()
+			return False
+		self._response = response
+		self._completed = True
+		self._completionLock.release()
+		callbacks = self._callbacks
+		self._callbacks = []
+		self._mutex.release()
+		for callback in callbacks:
+			try:
+				callback(response)
+			except Exception:
+				pass
+		return True
+
+
 class BaseNode(object):
 	"""
 	A Transaction Manager.
@@ -1048,6 +1533,7 @@ class BaseNode(object):
 	getNodeName()
 	getUserAgent()
 	executeRequest()
+	executeRequestAsync()
 	sendRequest()
 	sendNotification()
 	sendResponse()
@@ -1095,6 +1581,57 @@ class BaseNode(object):
 			self.postCallback(self._stop)
 			self.join()
 	
+	class ResponseTimeoutThread(threading.Thread):
+		"""
+		Calls onTimeout(transactionId) for each outgoing transaction
+		whose response timeout expired.
+		
+		The transactions are not unscheduled when their response is received:
+		onTimeout() is expected to ignore the already completed ones.
+		"""
+		def __init__(self, onTimeout):
+			threading.Thread.__init__(self)
+			self.setDaemon(True)
+			self._onTimeout = onTimeout
+			self._condition = threading.Condition(threading.Lock())
+			self._heap = [] # (expiry, transactionId)
+			self._running = False
+
+		def schedule(self, transactionId, expiry):
+			self._condition.acquire()
+			heapq.heappush(self._heap, (expiry, transactionId))
+			if self._heap[0][1] == transactionId:
+				self._condition.notify()
+			self._condition.release()
+
+		def run(self):
+			self._running = True
+			self._condition.acquire()
+			try:
+				while self._running:
+					if not self._heap:
+						self._condition.wait()
+						continue
+					delay = self._heap[0][0] - time.time()
+					if delay > 0:
+						self._condition.wait(delay)
+						continue
+					(expiry, transactionId) = heapq.heappop(self._heap)
+					self._condition.release()
+					try:
+						self._onTimeout(transactionId)
+					finally:
+						self._condition.acquire()
+			finally:
+				self._condition.release()
+
+		def stop(self):
+			self._condition.acquire()
+			self._running = False
+			self._condition.notify()
+			self._condition.release()
+			self.join()
+	
 	def __init__(self, name, userAgent):
 		"""
 		@type  connector: Connector
@@ -1104,13 +1641,14 @@ class BaseNode(object):
 		self.__name = name
 		self.__mutex = threading.RLock()
 		self.__transactionId = 0
-		self.__outgoingTransactions = {} # transactionId: { request, timestamp, channel, callback }
+		self.__outgoingTransactions = {} # transactionId: { request, timestamp, channel, future }
 		self.__incomingTransactions = {} # transactionId: { request, timestamp, channel, callback }
 		if self.__name is None:
 			# Generates a unique name
 			self.__name = "%d.%s" % (os.getpid(), socket.getfqdn())
 		self.__adapterThread = None
 		self.__adapterThread2 = None
+		self.__timeoutThread = None
 		self.__started = False
 	
 	def __trace(self, txt):
@@ -1161,19 +1699,15 @@ class BaseNode(object):
 			transactionId = message.getTransactionId()
 			self.__mutex.acquire()
 			if self.__outgoingTransactions.has_key(transactionId):
-				entry = self.__outgoingTransactions[transactionId]
-				# Synchronous call ?
-				if entry['event']:
-					# Yes: notify the caller, let him purge the transaction with the response.
-					self.__outgoingTransactions[transactionId]['response'] = message
-					entry['event'].set()
-				else:
-					# No: purge the transaction, then call onResponse()
-					del self.__outgoingTransactions[transactionId]
+				entry = self.__outgoingTransactions.pop(transactionId)
 				self.__mutex.release()
 				self.__trace("%d <-- received response - took %fs" % (transactionId, time.time() - entry['timestamp']))
 				self.__trace("\n" + repr(message))
-				if not entry['event']:
+				# Request executed with a future: complete it,
+				# otherwise call onResponse()
+				if entry['future']:
+					entry['future']._complete(message)
+				else:
 					self.__onResponse(channel, transactionId, message)
 			else:
 				self.__mutex.release()
@@ -1183,6 +1717,18 @@ class BaseNode(object):
 		else:
 			self.__trace("Got an unknown message type - nothing to do")
 	
+	def __onResponseTimeout(self, transactionId):
+		self.__mutex.acquire()
+		entry = self.__outgoingTransactions.get(transactionId)
+		if entry and entry['future']:
+			del self.__outgoingTransactions[transactionId]
+		else:
+			entry = None
+		self.__mutex.release()
+		if entry:
+			self.__trace("%d === timeout on request, purging" % transactionId)
+			entry['future']._complete(None)
+	
 	##
 	# Protected
 	##
@@ -1212,6 +1758,8 @@ class BaseNode(object):
 			self.__adapterThread.start()
 			self.__adapterThread2 = self.AdapterThread()
 			self.__adapterThread2.start()
+			self.__timeoutThread = self.ResponseTimeoutThread(self.__onResponseTimeout)
+			self.__timeoutThread.start()
 			self._connector.start()
 			self.__started = True
 	
@@ -1219,9 +1767,18 @@ class BaseNode(object):
 		if self.__started:
 			self.trace("Stopping node %s..." % self.getNodeName())
 			self._connector.stop()
+			self.__timeoutThread.stop()
 			self.__adapterThread2.stop()
 			self.__adapterThread.stop()
 			self.__started = False
+			# No response can be received anymore
+			self.__mutex.acquire()
+			pending = [ (transactionId, entry) for (transactionId, entry) in self.__outgoingTransactions.items() if entry['future'] ]
+			for (transactionId, entry) in pending:
+				del self.__outgoingTransactions[transactionId]
+			self.__mutex.release()
+			for (transactionId, entry) in pending:
+				entry['future']._complete(None)
 
 	def sendRequest(self, channel, request):
 		"""
@@ -1242,7 +1799,7 @@ class BaseNode(object):
 		request.setHeader("Contact", self.getContact())
 		# Register the request
 		self.__mutex.acquire()
-		self.__outgoingTransactions[transactionId] = { 'request': request, 'timestamp': time.time(), 'channel': channel, 'event': None }
+		self.__outgoingTransactions[transactionId] = { 'request': request, 'timestamp': time.time(), 'channel': channel, 'future': None }
 		self.__mutex.release()
 		# Send the message
 		self.__trace("%d --> sending request" % (transactionId))
@@ -1253,8 +1810,32 @@ class BaseNode(object):
 	def executeRequest(self, channel, request, responseTimeout = 10.00):
 		"""
 		Synchronous request execution.
-		During this execution, all incoming requests or responses are deferred
-		until the request is complete (or timed out).
+		Blocks until the response is received, or the request timed out.
+		Other requests may be in progress on the same channel at the same time.
+		
+		@type  request: Messages.Request
+		@param request: the request object to send
+		@type  responseTimeout: float
+		@param responseTimeout: the max time to wait for the response, in s
+		
+		@rtype: Messages.Response, or None
+		@returns: the response, or None in case of a timeout
+		"""
+		return self.executeRequestAsync(channel, request, responseTimeout).getResponse()
+
+	def executeRequestAsync(self, channel, request, responseTimeout = 10.00):
+		"""
+		Asynchronous request execution: sends the request and returns immediately.
+		Several requests can be sent this way before waiting for their responses
+		(pipelining).
+		
+		@type  request: Messages.Request
+		@param request: the request object to send
+		@type  responseTimeout: float
+		@param responseTimeout: the max time to wait for the response, in s
+		
+		@rtype: ResponseFuture
+		@returns: the future response, completed with None in case of a timeout
 		"""
 		self.__trace("--> preparing request")
 		# Generate a req ID
@@ -1262,60 +1843,39 @@ class BaseNode(object):
 		request.setHeader("Transaction-Id", transactionId)
 		request.setHeader("User-Agent", self.getUserAgent())
 		request.setHeader("Contact", self.getContact())
-		event = threading.Event()
+		future = ResponseFuture(transactionId)
+		if not self.isStarted():
+			self.__trace("%d === node not started, cannot send request" % transactionId)
+			future._complete(None)
+			return future
 		startTime = time.time()
 		# Register the request
 		self.__mutex.acquire()
-		self.__outgoingTransactions[transactionId] = { 'request': request, 'timestamp': startTime, 'channel': channel, 'event': event }
+		self.__outgoingTransactions[transactionId] = { 'request': request, 'timestamp': startTime, 'channel': channel, 'future': future }
 		self.__mutex.release()
+		self.__timeoutThread.schedule(transactionId, startTime + responseTimeout)
 		# Send the message
 		self.__trace("%d --> sending request" % (transactionId))
 		self.__trace("\n" + str(request))
 		self._connector.sendMessage(channel, request)
 		self.__trace("%d --> sent request" % (transactionId))
-		# Now, wait for the response.		
-
-		# I tried several implementation here.
-		
-		# Implementation #1: clean event.wait(): ref test (perf_test.ats): 25s
-		# event.wait(responseTimeout)
-		# if event.isSet():
-		
-		# Implementation #2: using a dedicated reply queue instead of an event.
-		# The response is directly posted in the queue - even not a need for
-		# locking the outgoingTransactions map to retrieve it.
-		# Yet, this is about 25s on perf_test.ats.
-
-		# Implementation #3: ugly loop, waiting for the event: ref test (perf_test.ats): 20s
-		timeout = False
-		while (not event.isSet()) and (not timeout):
-			time.sleep(0.00001)
-			if (time.time() - startTime) >= responseTimeout:
-				timeout = True
-		if not timeout:
-			self.__trace("%d --- response received" % (transactionId))
-			self.__mutex.acquire()
-			response = self.__outgoingTransactions[transactionId]['response']
-			ts = self.__outgoingTransactions[transactionId]['timestamp']
-			del self.__outgoingTransactions[transactionId]
-			self.__mutex.release()
-			self.__trace("%d === response received on time on synchronous request (took %fs)" % (transactionId, time.time() - ts))
-			return response
-		else:
-			# Purge the transaction
-			self.__mutex.acquire()
-			del self.__outgoingTransactions[transactionId]
-			self.__mutex.release()
-			self.__trace("%d === timeout on synchronous request, purging" % transactionId)
-			return None
+		return future
 
 	def isStarted(self):
 		# To mutex-protect
 		return self.__started
 
-	def sendNotification(self, channel, notification):
+	def sendNotification(self, channel, notification, coalesceKey = None, reliable = False):
 		"""
 		Sends a notification.
+		
+		@type  coalesceKey: any hashable, or None
+		@param coalesceKey: if provided, the notification replaces any
+		notification sent with the same key that is still queued for this
+		channel (listening nodes only), for instance a state notification
+		@type  reliable: bool
+		@param reliable: if True, the notification is never dropped
+		because the channel outbound queue is full (listening nodes only)
 		"""
 		if not self.isStarted():
 			return
@@ -1329,7 +1889,7 @@ class BaseNode(object):
 		# Send the message
 		self.__trace("%d --> sending notification" % (transactionId))
 		self.__trace("\n" + repr(notification))
-		self._connector.sendMessage(channel, notification)
+		self._connector.sendMessage(channel, notification, coalesceKey, reliable)
 	
 	def sendResponse(self, channel, transactionId, response):
 		"""
@@ -1440,8 +2000,93 @@ class ListeningNode(BaseNode):
 	def __init__(self, name, userAgent): # also manages protocol ?
 		BaseNode.__init__(self, name, userAgent)
 	
-	def initialize(self, listeningAddress):
+	def initialize(self, listeningAddress, maxQueueSize = 0, queueFullPolicy = QUEUE_FULL_BLOCK):
+		"""
+		@type  maxQueueSize: integer
+		@param maxQueueSize: the max number of messages waiting to be sent to
+		a connected peer, 0 for no limit
+		@type  queueFullPolicy: string in QUEUE_FULL_POLICIES
+		@param queueFullPolicy: what to do when sending to a peer whose queue is full
+		"""
 		self.trace("Initializing listening node %s on %s..." % (self.getNodeName(), listeningAddress))
-		connector = ListeningConnectorThread(listeningAddress)
+		connector = ListeningConnectorThread(listeningAddress, maxQueueSize = maxQueueSize, queueFullPolicy = queueFullPolicy)
 		self._setConnector(connector)
 		BaseNode.initialize(self)
+
+	def getChannelStats(self):
+		"""
+		@rtype: list of dict(channel, queue-depth, dropped, coalesced)
+		@returns: the outbound queue statistics for each connected channel
+		"""
+		return self._connector.getChannelStats()
+
+	def waitQueueDepth(self, channel, maxDepth, timeout):
+		"""
+		Waits until at most maxDepth messages are waiting to be sent
+		to a connected peer, so that a bulk sender does not fill its queue.
+		
+		@type  timeout: float
+		@param timeout: the max duration of the wait, in s
+		
+		@rtype: bool
+		@returns: True if at most maxDepth messages are queued, False
+		on timeout or if the peer is disconnected
+		"""
+		return self._connector.waitQueueDepth(channel, maxDepth, timeout)
+
+
+################################################################################
+# Standalone benchmark
+################################################################################
+
+def benchmark(count = 5000, window = 50, address = ('127.0.0.1', 49999)):
+	"""
+	Measures the request/response throughput over loopback,
+	with sequential executeRequest() calls, then with up to window
+	requests in flight (executeRequestAsync()).
+	"""
+	class EchoServer(ListeningNode):
+		def onRequest(self, channel, transactionId, request):
+			self.sendResponse(channel, transactionId, Messages.Response(200, "OK"))
+
+	class Client(ConnectingNode):
+		def __init__(self):
+			ConnectingNode.__init__(self, "benchmark client", "Benchmark/1.0")
+			self.connected = threading.Event()
+		def onConnection(self, channel):
+			self.connected.set()
+
+	server = EchoServer("benchmark server", "Benchmark/1.0")
+	server.initialize(address)
+	server.start()
+	client = Client()
+	client.initialize(address)
+	client.start()
+	client.connected.wait(5.0)
+
+	try:
+		_benchmarkRequests(client, count, window)
+	finally:
+		client.stop()
+		server.stop()
+
+def _benchmarkRequests(client, count, window):
+	start = time.time()
+	for i in range(count):
+		assert client.executeRequest(0, Messages.Request("PING", "system:benchmark", "BENCH", "1.0")).getStatusCode() == 200
+	duration = time.time() - start
+	print "executeRequest: %d requests in %.3fs (%.0f requests/s)" % (count, duration, count / duration)
+
+	start = time.time()
+	futures = []
+	for i in range(count):
+		futures.append(client.executeRequestAsync(0, Messages.Request("PING", "system:benchmark", "BENCH", "1.0")))
+		if len(futures) >= window:
+			assert futures.pop(0).getResponse().getStatusCode() == 200
+	for future in futures:
+		assert future.getResponse().getStatusCode() == 200
+	duration = time.time() - start
+	print "executeRequestAsync, %d in flight: %d requests in %.3fs (%.0f requests/s)" % (window, count, duration, count / duration)
+
+if __name__ == '__main__':
+	benchmark()
@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+##
+# This file is part of Testerman, a test automation system.
+# Copyright (c) 2008,2009,2010 Sebastien Lefevre and other contributors
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+##
+
+##
+# Compact binary log format, as an alternative to the XML log events.
+#
+# A log file is a sequence of log events. Each event is either:
+# - an XML event, usually on a single line (the usual log format),
+# - or a binary record:
+#   RECORD_MARKER (1 byte) + payload length (4 bytes, big endian) + payload
+#
+# Both may be mixed in the same log file (for instance, the server
+# may add XML events to a job log written in binary by the TE).
+#
+# A binary record payload is a sequence of 4 typed values:
+# element name, attributes (list of [name, value]), body type, body.
+# The body is either None, a text, a CDATA text, or a list
+# of [element name, value] fields whose values are Testerman structures.
+#
+# Typed values are encoded as a 1-byte tag followed by:
+#   'N', 'T', 'F': None, True, False (nothing else)
+#   'k': integer, 1 byte (signed)
+#   'i': integer, 8 bytes (big endian, signed)
+#   'l': other integer, as a decimal string (4-byte length + data)
+#   'd': float, 8 bytes (big endian, IEEE 754)
+#   'u': unicode string, 4-byte length + utf-8 data
+#   's': octetstring, 4-byte length + raw data (no base64)
+#   'L': list, 4-byte count + values
+#   'R': record (dict), 4-byte count + (field name value, field value)
+#   'C': choice (couple), name value + value
+#   'E': invalid choice (tuple whose length is not 2)
+# 'a', 'b', 'm', 'r' are the same as 'u', 's', 'L', 'R'
+# with a 1-byte length/count, for short values.
+#
+# The XML representation of a binary event is the one the TE would have
+# logged with the XML format (record fields may be in a different order).
+#
+##
+
+import re
+import struct
+import StringIO
+
+
+RECORD_MARKER = '\x00'
+# The MIME type used to transport binary records over Il
+CONTENT_TYPE = 'application/x-testerman-binary-log'
+
+BODY_NONE = 0
+BODY_TEXT = 1
+BODY_CDATA = 2
+BODY_FIELDS = 3
+
+_Int64 = struct.Struct('>q')
+_Float = struct.Struct('>d')
+_Length = struct.Struct('>I')
+_ShortInt = struct.Struct('>b')
+
+_MinInt64 = -(1 << 63)
+_MaxInt64 = (1 << 63) - 1
+
+
+class DecodingError(Exception):
+	pass
+
+
+################################################################################
+# Encoding
+################################################################################
+
+def _encodeValue(obj, out):
+	"""
+	Appends the encoded obj to out (a list of strings).
+	"""
+	# Tries to apply the 'to message' transformation (useful for template proxies),
+	# as the XML serializer does
+	try:
+		obj = obj.toMessage()
+	except:
+		pass
+
+	if obj is None:
+		out.append('N')
+	elif obj is True:
+		out.append('T')
+	elif obj is False:
+		out.append('F')
+	elif isinstance(obj, unicode):
+		data = obj.encode('utf-8')
+		if len(data) < 256:
+			out.append('a' + chr(len(data)))
+		else:
+			out.append('u')
+			out.append(_Length.pack(len(data)))
+		out.append(data)
+	elif isinstance(obj, str):
+		if len(obj) < 256:
+			out.append('b' + chr(len(obj)))
+		else:
+			out.append('s')
+			out.append(_Length.pack(len(obj)))
+		out.append(obj)
+	elif isinstance(obj, (int, long)) and not isinstance(obj, bool):
+		if -128 <= obj <= 127:
+			out.append('k')
+			out.append(_ShortInt.pack(obj))
+		elif _MinInt64 <= obj <= _MaxInt64:
+			out.append('i')
+			out.append(_Int64.pack(obj))
+		else:
+			data = str(obj)
+			out.append('l')
+			out.append(_Length.pack(len(data)))
+			out.append(data)
+	elif isinstance(obj, float):
+		out.append('d')
+		out.append(_Float.pack(obj))
+	elif isinstance(obj, list):
+		if len(obj) < 256:
+			out.append('m' + chr(len(obj)))
+		else:
+			out.append('L')
+			out.append(_Length.pack(len(obj)))
+		for item in obj:
+			_encodeValue(item, out)
+	elif isinstance(obj, dict):
+		if len(obj) < 256:
+			out.append('r' + chr(len(obj)))
+		else:
+			out.append('R')
+			out.append(_Length.pack(len(obj)))
+		for (fieldName, fieldValue) in obj.items():
+			_encodeValue(fieldName, out)
+			_encodeValue(fieldValue, out)
+	elif isinstance(obj, tuple):
+		if len(obj) == 2:
+			out.append('C')
+			_encodeValue(obj[0], out)
+			_encodeValue(obj[1], out)
+		else:
+			out.append('E')
+	else:
+		# Other objects are logged with their unicode representation
+		try:
+			_encodeValue(unicode(obj), out)
+		except UnicodeDecodeError:
+			_encodeValue(str(obj), out)
+
+def encodeEvent(element, attributes, text = None, cdata = None, fields = None):
+	"""
+	Encodes a log event into a binary record.
+
+	@type  element: string
+	@param element: the event element name (ats-started, message-sent, ...)
+	@type  attributes: list of (string, object)
+	@param attributes: the event attributes (class, timestamp, ...), in XML order.
+	Their values are rendered with str() in XML.
+	@type  text: unicode, or None
+	@param text: the event text value, if any (escaped in XML)
+	@type  cdata: unicode, or None
+	@param cdata: the event CDATA value, if any
+	@type  fields: list of (string, object), or None
+	@param fields: the event structured values, as (element name, Testerman structure)
+
+	@rtype: string
+	@returns: the binary record, including its marker and length
+	"""
+	out = []
+	_encodeValue(element, out)
+	_encodeValue([ list(a) for a in attributes ], out)
+	if fields is not None:
+		_encodeValue(BODY_FIELDS, out)
+		_encodeValue([ list(f) for f in fields ], out)
+	elif cdata is not None:
+		_encodeValue(BODY_CDATA, out)
+		_encodeValue(cdata, out)
+	elif text is not None:
+		_encodeValue(BODY_TEXT, out)
+		_encodeValue(text, out)
+	else:
+		_encodeValue(BODY_NONE, out)
+		_encodeValue(None, out)
+	payload = ''.join(out)
+	return RECORD_MARKER + _Length.pack(len(payload)) + payload
+
+
+################################################################################
+# Decoding
+################################################################################
+
+def _decodeValue(data, offset):
+	"""
+	@rtype: tuple (object, integer)
+	@returns: the decoded value, and the offset of the next value in data
+	"""
+	tag = data[offset]
+	offset += 1
+	if tag == 'a':
+		length = ord(data[offset])
+		offset += 1
+		return (data[offset:offset+length].decode('utf-8'), offset + length)
+	elif tag == 'b':
+		length = ord(data[offset])
+		offset += 1
+		return (data[offset:offset+length], offset + length)
+	elif tag == 'r' or tag == 'R':
+		if tag == 'r':
+			count = ord(data[offset])
+			offset += 1
+		else:
+			(count, ) = _Length.unpack_from(data, offset)
+			offset += 4
+		ret = {}
+		for i in xrange(count):
+			(fieldName, offset) = _decodeValue(data, offset)
+			(ret[fieldName], offset) = _decodeValue(data, offset)
+		return (ret, offset)
+	elif tag == 'm' or tag == 'L':
+		if tag == 'm':
+			count = ord(data[offset])
+			offset += 1
+		else:
+			(count, ) = _Length.unpack_from(data, offset)
+			offset += 4
+		ret = []
+		for i in xrange(count):
+			(item, offset) = _decodeValue(data, offset)
+			ret.append(item)
+		return (ret, offset)
+	elif tag == 'k':
+		return (_ShortInt.unpack_from(data, offset)[0], offset + 1)
+	elif tag == 'i':
+		return (_Int64.unpack_from(data, offset)[0], offset + 8)
+	elif tag == 'u':
+		(length, ) = _Length.unpack_from(data, offset)
+		offset += 4
+		return (data[offset:offset+length].decode('utf-8'), offset + length)
+	elif tag == 's':
+		(length, ) = _Length.unpack_from(data, offset)
+		offset += 4
+		return (data[offset:offset+length], offset + length)
+	elif tag == 'd':
+		return (_Float.unpack_from(data, offset)[0], offset + 8)
+	elif tag == 'C':
+		(choiceName, offset) = _decodeValue(data, offset)
+		(choiceValue, offset) = _decodeValue(data, offset)
+		return ((choiceName, choiceValue), offset)
+	elif tag == 'N':
+		return (None, offset)
+	elif tag == 'T':
+		return (True, offset)
+	elif tag == 'F':
+		return (False, offset)
+	elif tag == 'l':
+		(length, ) = _Length.unpack_from(data, offset)
+		offset += 4
+		return (long(data[offset:offset+length]), offset + length)
+	elif tag == 'E':
+		return ((), offset)
+	raise DecodingError("Invalid value tag %r at offset %s" % (tag, offset - 1))
+
+
+class Event:
+	"""
+	A decoded binary log event.
+	"""
+	def __init__(self, element, attributes, text = None, cdata = None, fields = None):
+		self.element = element
+		self.attributes = attributes
+		self.text = text
+		self.cdata = cdata
+		self.fields = fields
+
+	def getAttribute(self, name, default = None):
+		for (n, v) in self.attributes:
+			if n == name:
+				return v
+		return default
+
+	def toXml(self):
+		"""
+		@rtype: unicode
+		@returns: the event as an XML element, as it would have been logged
+		with the XML log format.
+		"""
+		# Imported here since TestermanTCI uses this module to encode events
+		import TestermanTCI
+		return TestermanTCI.eventToXml(self.element, self.attributes, self.text, self.cdata, self.fields)
+
+def decodeEvent(payload):
+	"""
+	Decodes a binary record payload (without the marker and the length).
+
+	@rtype: Event
+	"""
+	try:
+		(element, offset) = _decodeValue(payload, 0)
+		(attributes, offset) = _decodeValue(payload, offset)
+		(bodyType, offset) = _decodeValue(payload, offset)
+		(body, offset) = _decodeValue(payload, offset)
+	except (IndexError, struct.error, UnicodeDecodeError, ValueError), e:
+		raise DecodingError("Invalid binary log event: %s" % str(e))
+	if bodyType == BODY_FIELDS:
+		return Event(element, attributes, fields = body)
+	elif bodyType == BODY_CDATA:
+		return Event(element, attributes, cdata = body)
+	elif bodyType == BODY_TEXT:
+		return Event(element, attributes, text = body)
+	return Event(element, attributes)
+
+def decodeRecord(record):
+	"""
+	Decodes a complete binary record, as returned by encodeEvent().
+
+	@rtype: Event
+	"""
+	return decodeEvent(record[5:])
+
+def getRecordElement(record):
+	"""
+	Returns the element name of an event, without decoding it completely.
+
+	@type  record: string
+	@param record: a complete binary record, including its marker and length
+
+	@rtype: unicode
+	"""
+	return _decodeValue(record, 5)[0]
+
+
+################################################################################
+# Streaming reader
+################################################################################
+
+class LogReader:
+	"""
+	Reads the events of a log file, as a stream.
+
+	Iterating over a LogReader returns, for each event:
+	- a string (utf-8 XML, without the trailing newline) for XML events,
+	- an Event for binary events.
+
+	Incomplete trailing records (file still being written)
+	are not returned.
+	"""
+	def __init__(self, f, chunkSize = 65536):
+		"""
+		@type  f: file-like object
+		@param f: the log file, opened in binary mode
+		"""
+		self._file = f
+		self._chunkSize = chunkSize
+		self._buffer = ''
+		self._offset = 0
+		self._eof = False
+
+	def __iter__(self):
+		return self
+
+	def _fill(self, size):
+		"""
+		Makes sure at least size bytes are available in the buffer, if possible.
+
+		@rtype: bool
+		@returns: True if size bytes are available.
+		"""
+		while len(self._buffer) - self._offset < size and not self._eof:
+			data = self._file.read(max(self._chunkSize, size))
+			if not data:
+				self._eof = True
+			else:
+				self._buffer = self._buffer[self._offset:] + data
+				self._offset = 0
+		return len(self._buffer) - self._offset >= size
+
+	def next(self):
+		while True:
+			if not self._fill(1):
+				raise StopIteration()
+			if self._buffer[self._offset] == RECORD_MARKER:
+				if not self._fill(5):
+					raise StopIteration()
+				(length, ) = _Length.unpack_from(self._buffer, self._offset + 1)
+				if not self._fill(5 + length):
+					raise StopIteration()
+				start = self._offset + 5
+				self._offset = start + length
+				return decodeEvent(self._buffer[start:self._offset])
+			else:
+				# XML event line
+				end = self._buffer.find('\n', self._offset)
+				while end < 0 and not self._eof:
+					searchFrom = len(self._buffer) - self._offset
+					self._fill(len(self._buffer) - self._offset + self._chunkSize)
+					end = self._buffer.find('\n', self._offset + searchFrom)
+				if end < 0:
+					end = len(self._buffer)
+				line = self._buffer[self._offset:end]
+				self._offset = end + 1
+				if line.strip():
+					return line
+
+
+################################################################################
+# Event boundaries
+################################################################################
+
+_XmlStartTagPattern = re.compile(r'<([^\s/>]+)')
+
+def _getEventEnd(data, offset):
+	"""
+	Returns the offset following the event starting at offset in data,
+	or None if this event is not complete in data.
+	"""
+	if data[offset] == RECORD_MARKER:
+		if len(data) < offset + 5:
+			return None
+		(length, ) = _Length.unpack_from(data, offset + 1)
+		end = offset + 5 + length
+		if end > len(data):
+			return None
+		return end
+
+	m = _XmlStartTagPattern.match(data, offset)
+	if not m:
+		# Not an XML event: up to the end of the line
+		end = data.find('\n', offset)
+		if end < 0:
+			return None
+		return end + 1
+	tagEnd = data.find('>', m.end())
+	if tagEnd < 0:
+		return None
+	if data[tagEnd - 1] == '/':
+		end = tagEnd + 1
+	else:
+		# XML events may span several lines: look for the closing tag,
+		# ignoring the CDATA sections
+		closingTag = '</%s>' % m.group(1)
+		position = tagEnd + 1
+		while True:
+			end = data.find(closingTag, position)
+			if end < 0:
+				return None
+			cdata = data.find('<![CDATA[', position, end)
+			if cdata < 0:
+				end += len(closingTag)
+				break
+			position = data.find(']]>', cdata + 9)
+			if position < 0:
+				return None
+			position += 3
+	if data[end:end+1] == '\n':
+		end += 1
+	return end
+
+def splitEvents(data):
+	"""
+	Splits data, a part of a log file starting on an event boundary,
+	into complete events.
+
+	@type  data: string
+	@param data: log file data
+
+	@rtype: tuple (list of strings, integer)
+	@returns: the complete events (XML events, including their trailing
+	newline, or binary records), and the length of data they span.
+	Trailing incomplete events are not returned.
+	"""
+	events = []
+	offset = 0
+	length = len(data)
+	while offset < length:
+		if data[offset] in '\r\n':
+			offset += 1
+			continue
+		end = _getEventEnd(data, offset)
+		if end is None:
+			break
+		events.append(data[offset:end])
+		offset = end
+	return (events, offset)
+
+
+################################################################################
+# Converter
+################################################################################
+
+def isBinaryLog(data):
+	"""
+	Returns True if data (the beginning of a log file, or a complete log file)
+	contains at least a binary record.
+	"""
+	# The record marker cannot appear in XML events
+	return RECORD_MARKER in data
+
+def convertToXml(f, output):
+	"""
+	Converts a log file, possibly containing binary events,
+	to the XML log format.
+
+	Binary events that cannot be converted (invalid structures) are ignored.
+
+	@type  f: file-like object
+	@param f: the log file to convert
+	@type  output: file-like object
+	@param output: the file to write the XML events to, one per line (utf-8)
+	"""
+	for event in LogReader(f):
+		if isinstance(event, Event):
+			try:
+				event = event.toXml().encode('utf-8')
+			except Exception:
+				continue
+		output.write('%s\n' % event)
+
+def convertDataToXml(data):
+	"""
+	Converts a complete log file contents to the XML log format.
+
+	@type  data: string
+	@param data: the log file contents
+
+	@rtype: string
+	@returns: the XML events, one per line, utf-8 encoded
+	"""
+	if not isBinaryLog(data):
+		return data
+	output = StringIO.StringIO()
+	convertToXml(StringIO.StringIO(data), output)
+	return output.getvalue()
+
+
+if __name__ == '__main__':
+	import sys
+	if len(sys.argv) != 2:
+		print "Usage: %s <log filename>" % sys.argv[0]
+		print "Converts a Testerman log file to the XML log format, on stdout"
+		sys.exit(1)
+	f = open(sys.argv[1], 'rb')
+	convertToXml(f, sys.stdout)
+	f.close()
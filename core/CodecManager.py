@@ -30,6 +30,7 @@ class CodecNotFoundException(Exception): pass
 ##
 # Utilities
 ##
+import threading
 import traceback
 import StringIO
 def getBacktrace():
@@ -125,17 +126,20 @@ class Codec:
 		"""
 		return self._properties.get(name, None)
 	
-	def log(self, message):
+	def log(self, message, *args):
 		"""
 		Call this function to log something.
 		Depending on the codec adapter, leads to different log traces.
 		- agent logger when the codec is used in a pyagent,
 		- tli logger as "internal" class level when used in a TE
 		
+		If args are provided, the message is formatted (message % args)
+		only if the logs are actually enabled in the target context.
+		
 		@type  message: string/unicode
 		@param message: the message to log
 		"""
-		instance().log(message)
+		instance().log(message, *args)
 
 	def incrementalDecode(self, data, complete):
 		"""
@@ -304,23 +308,52 @@ class CodecManager(object):
 	A CodecManager is adapted according to the
 	target context (a TE or a PyAgent) via the following methods:
 	- setLogCallback(): enables to implement logging according to the target context
+	
+	Configured codec instances are cached per thread (so that they
+	can be used in parallel without locking), per codec/alias name and
+	call properties. The caches are invalidated whenever a codec is
+	registered or aliased.
 	"""
+	# Max number of cached instances per codec/alias name and call properties, per thread.
+	# More than one instance is only needed when a codec is re-entered
+	# (i.e. used to encode/decode a part of its own message).
+	MAX_CACHED_INSTANCES = 4
+
 	def __init__(self):
 		#: dict[codec/aliasname] = (codec class, params)
 		self._codecs = {}
 		self._logCallback = None
+		self._isLogEnabledCallback = None
+		# Incremented on each codec registry change, invalidating the cached instances
+		self._registryGeneration = 0
+		# .instances: dict[(codec/alias name, call properties)] = list of available codec instances
+		# .generation: the registry generation the instances were created for
+		self._local = threading.local()
 	
-	def log(self, txt):
+	def log(self, txt, *args):
 		if self._logCallback:
+			if self._isLogEnabledCallback and not self._isLogEnabledCallback():
+				return
+			if args:
+				txt = txt % args
 			self._logCallback(txt)
 	
-	def setLogCallback(self, cb):
+	def setLogCallback(self, cb, isEnabledCb = None):
+		"""
+		@type  cb: callable(txt)
+		@param cb: the function to call to log a message
+		@type  isEnabledCb: callable() -> bool, or None
+		@param isEnabledCb: if provided, a fast check called before
+		formatting and logging anything. Returns False to discard the logs.
+		"""
 		self._logCallback = cb
+		self._isLogEnabledCallback = isEnabledCb
 	
 	def registerCodecClass(self, name, class_):
 		if not self._codecs.has_key(name):
 			self._codecs[name] = (class_, {})
-			self.log("Codec class %s registered as codec %s" % (class_.__name__, name))
+			self._registryGeneration += 1
+			self.log("Codec class %s registered as codec %s", class_.__name__, name)
 	
 	def alias(self, name, codec, **kwargs):
 		"""
@@ -338,6 +371,7 @@ class CodecManager(object):
 		for n, p in kwargs.items():
 			mergedProperties[n] = p
 		self._codecs[name] = (codecClass, mergedProperties)
+		self._registryGeneration += 1
 
 	def _getCodecInstance(self, name):
 		"""
@@ -352,36 +386,94 @@ class CodecManager(object):
 				c._setProperty(n, p)
 			return c
 	
-	def encode(self, name, template, **properties):
-		# NB: we instantiate a codec each type to be thread safe and parallel.
-		# This is not optimized, we may use a TLS one day.
+	def _acquireCodecInstance(self, name, properties):
+		"""
+		Returns a configured codec instance, with the additional call properties,
+		from the current thread cache if available.
+		The instance is removed from the cache until it is released
+		with _releaseCodecInstance(), so that a codec re-entering itself
+		does not use the same instance.
+		
+		@rtype: tuple (Codec instance, cache key)
+		@returns: the codec instance (None if the codec is not registered),
+		and the key to release it with (None if the instance cannot be cached)
+		"""
+		local = self._local
+		generation = self._registryGeneration
+		if getattr(local, 'generation', None) != generation:
+			local.instances = {}
+			local.generation = generation
+
+		if properties:
+			key = (name, tuple(sorted(properties.items())))
+			try:
+				hash(key)
+			except TypeError:
+				# Unhashable property values: cannot be cached
+				key = None
+		else:
+			key = name
+		
+		if key is not None:
+			available = local.instances.get(key)
+			if available:
+				return (available.pop(), (generation, key))
+
 		codec = self._getCodecInstance(name)
 		if codec:
 			for k, v in properties.items():
 				codec._setProperty(k, v)
-			return codec.encode(template)
+		if key is None:
+			return (codec, None)
+		return (codec, (generation, key))
+	
+	def _releaseCodecInstance(self, codec, cacheKey):
+		"""
+		Puts back a codec instance acquired with _acquireCodecInstance()
+		into the current thread cache.
+		"""
+		if cacheKey is None:
+			return
+		(generation, key) = cacheKey
+		local = self._local
+		if local.generation != generation or generation != self._registryGeneration:
+			# The codec registry changed in the meantime: this instance may not be up to date
+			return
+		available = local.instances.get(key)
+		if available is None:
+			local.instances[key] = [ codec ]
+		elif len(available) < self.MAX_CACHED_INSTANCES:
+			available.append(codec)
+
+	def encode(self, name, template, **properties):
+		(codec, cacheKey) = self._acquireCodecInstance(name, properties)
+		if codec:
+			try:
+				return codec.encode(template)
+			finally:
+				self._releaseCodecInstance(codec, cacheKey)
 		else:
 			# Unable to find the codec
 			raise CodecNotFoundException("Codec '%s' not found" % name)
 
 	def decode(self, name, data,  **properties):
-		# NB: we instantiate a codec each type to be thread safe and parallel
-		codec = self._getCodecInstance(name)
+		(codec, cacheKey) = self._acquireCodecInstance(name, properties)
 		if codec:
-			for k, v in properties.items():
-				codec._setProperty(k, v)
-			return codec.decode(data)
+			try:
+				return codec.decode(data)
+			finally:
+				self._releaseCodecInstance(codec, cacheKey)
 		else:
 			# Unable to find the codec
 			raise CodecNotFoundException("Codec '%s' not found" % name)
 
 	def incrementalDecode(self, name, data, complete, **properties):
-		# NB: we instantiate a codec each type to be thread safe and parallel
-		codec = self._getCodecInstance(name)
+		(codec, cacheKey) = self._acquireCodecInstance(name, properties)
 		if codec:
-			for k, v in properties.items():
-				codec._setProperty(k, v)
-			(ret, a, b, c) = codec.incrementalDecode(data, complete)
+			try:
+				(ret, a, b, c) = codec.incrementalDecode(data, complete)
+			finally:
+				self._releaseCodecInstance(codec, cacheKey)
 			# If the codec expects more data and we can't provide mode: decoding error
 			if ret == codec.DECODING_NEED_MORE_DATA and complete:
 				ret = codec.DECODING_ERROR
@@ -22,14 +22,23 @@
 #
 ##
 
+import BinaryLog
 import ConfigManager
 import CounterManager
+import LogWriter
 import TestermanMessages as Messages
 import TestermanNodes as Nodes
 import Versions
 
+import bisect
+import collections
+import fcntl
 import logging
+import os
+import re
+import sys
 import threading
+import time
 
 cm = ConfigManager.instance()
 
@@ -43,10 +52,12 @@ class XcException(Exception):
 		self.reason = reason
 
 class XcServer(Nodes.ListeningNode):
-	def __init__(self, manager, xcAddress):
+	def __init__(self, manager, xcAddress, maxQueueSize = 0):
 		Nodes.ListeningNode.__init__(self, "TS/Xc", "XcServer/%s" % Versions.getServerVersion())
 		self._manager = manager
-		self.initialize(xcAddress)
+		# A slow Xc client loses its oldest events rather than slowing down the dispatching
+		# (but not the replayed ones, see EventManager._replayLogEvents())
+		self.initialize(xcAddress, maxQueueSize, Nodes.QUEUE_FULL_DROP_OLDEST)
 
 	def getLogger(self):
 		return logging.getLogger('TS.XcServer')
@@ -59,7 +70,16 @@ class XcServer(Nodes.ListeningNode):
 		method = notification.getMethod()
 		uri = notification.getUri()
 		if method == "SUBSCRIBE":
-			self._manager.subscribe(channel, uri)
+			supported = [ x.strip() for x in (notification.getHeader("Supported") or '').split(',') ]
+			# Resuming a subscription: the log events from this sequence number are replayed first
+			fromSequence = notification.getHeader("Log-Sequence")
+			if fromSequence is not None:
+				try:
+					fromSequence = int(fromSequence)
+				except ValueError:
+					self.getLogger().warning("Invalid Log-Sequence (%s) in SUBSCRIBE, ignoring it" % fromSequence)
+					fromSequence = None
+			self._manager.subscribe(channel, uri, logBatch = 'log-batch' in supported, fromSequence = fromSequence)
 		elif method == "UNSUBSCRIBE":
 			self._manager.unsubscribe(channel, uri)
 		elif method == "MESSAGE":
@@ -104,6 +124,165 @@ class IlServer(Nodes.ListeningNode):
 
 	
 
+################################################################################
+# Log journals
+################################################################################
+
+# The class attribute of an XML log event
+_XmlClassPattern = re.compile(r'<[^>]*\sclass="([^"]*)"')
+
+# The max number of bytes read at once from a log file
+LOG_READ_SIZE = 256 * 1024
+
+def _toXmlEvent(event):
+	"""
+	Converts a log file event (XML event or binary record) to an XML event,
+	utf-8 encoded, without trailing newline.
+	"""
+	if event.startswith(BinaryLog.RECORD_MARKER):
+		return BinaryLog.decodeRecord(event).toXml().encode('utf-8')
+	return event.rstrip('\r\n')
+
+def _iterLogChunks(filename, fromOffset, toOffset = None):
+	"""
+	Reads the events of a log file offset range, LOG_READ_SIZE bytes
+	at a time, so that a large range is never held in memory at once.
+	
+	The file is only locked while reading each chunk.
+	
+	@type  toOffset: integer, or None
+	@param toOffset: the end of the range (an event boundary), None for the end of file
+	
+	@rtype: generator of tuple (integer, list of strings)
+	@returns: the file offset of the first event of each chunk, and the
+	complete events of the chunk (XML events or binary records).
+	Trailing incomplete events are not returned.
+	"""
+	f = open(filename, 'rb')
+	try:
+		offset = fromOffset
+		data = ''
+		while toOffset is None or offset + len(data) < toOffset:
+			size = LOG_READ_SIZE
+			if toOffset is not None:
+				size = min(size, toOffset - offset - len(data))
+			fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+			try:
+				f.seek(offset + len(data))
+				chunk = f.read(size)
+			finally:
+				fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+			if not chunk:
+				break
+			data += chunk
+			(events, length) = BinaryLog.splitEvents(data)
+			if events:
+				yield (offset, events)
+			offset += length
+			data = data[length:]
+	finally:
+		f.close()
+
+class LogJournal:
+	"""
+	Keeps track of the log events received on Il for a job (uri),
+	so that an Xc client can resume a subscription from a sequence number.
+	
+	Each event is given a sequence number, its rank in the job log file
+	(starting at 1).
+	The most recent events are kept in a bounded ring, as received
+	(chunks of log file data), and converted to XML only when replayed.
+	Older events are read back from the log file, from the closest
+	checkpoint (a sequence number and its file offset) recorded when
+	they left the ring.
+	
+	Called with the Manager journal mutex held.
+	"""
+	# Min number of events between two file checkpoints
+	CHECKPOINT_INTERVAL = 1000
+	
+	def __init__(self, filename, maxEvents):
+		self.filename = filename
+		self.maxEvents = maxEvents
+		self.nextSequence = 1
+		# The log file offset of the next event
+		self.offset = 0
+		# (first sequence, file offset, log classes, timestamp, data) per received chunk
+		self.ring = collections.deque()
+		self.ringEvents = 0
+		# (sequence, file offset) of some events no longer in the ring, sorted
+		self.checkpoints = [ (1, 0) ]
+		self.lastUpdate = time.time()
+
+	def append(self, logClasses, timestamp, data):
+		"""
+		Records a chunk of events, as written to the log file.
+		
+		@type  logClasses: list of strings
+		@param logClasses: the log class of each event
+		@type  data: string
+		@param data: the events, as written to the log file
+		
+		@rtype: integer
+		@returns: the sequence number of the first event
+		"""
+		sequence = self.nextSequence
+		self.ring.append((sequence, self.offset, logClasses, timestamp, data))
+		self.ringEvents += len(logClasses)
+		self.nextSequence += len(logClasses)
+		self.offset += len(data)
+		self.lastUpdate = time.time()
+		while self.ringEvents > self.maxEvents:
+			self._evict()
+		return sequence
+	
+	def _evict(self):
+		(sequence, offset, logClasses, timestamp, data) = self.ring.popleft()
+		self.ringEvents -= len(logClasses)
+		if sequence - self.checkpoints[-1][0] >= self.CHECKPOINT_INTERVAL:
+			self.checkpoints.append((sequence, offset))
+	
+	def clearRing(self):
+		"""
+		Frees the ring once the job is complete.
+		Its events will be read back from the log file, if needed.
+		"""
+		while self.ring:
+			self._evict()
+	
+	def getRingStart(self):
+		"""
+		@rtype: tuple (integer, integer)
+		@returns: the sequence number and file offset of the first event in the ring
+		(of the next event if the ring is empty)
+		"""
+		if self.ring:
+			return self.ring[0][:2]
+		return (self.nextSequence, self.offset)
+
+	def getCheckpoint(self, sequence):
+		"""
+		@rtype: tuple (integer, integer)
+		@returns: the closest checkpoint (sequence number, file offset) before sequence
+		"""
+		return self.checkpoints[bisect.bisect_right(self.checkpoints, (sequence, sys.maxint)) - 1]
+
+	def getRingEvents(self, fromSequence):
+		"""
+		@rtype: list of tuple (integer, string, string, string)
+		@returns: the events in the ring from sequence fromSequence,
+		as (sequence number, log class, timestamp, XML event)
+		"""
+		ret = []
+		for (sequence, offset, logClasses, timestamp, data) in self.ring:
+			if sequence + len(logClasses) <= fromSequence:
+				continue
+			events = BinaryLog.splitEvents(data)[0]
+			for i in range(max(0, fromSequence - sequence), min(len(logClasses), len(events))):
+				ret.append((sequence + i, logClasses[i], timestamp, _toXmlEvent(events[i])))
+		return ret
+
+
 ################################################################################
 # TL dispatcher
 # Keep tracks of currently registered Xc clients and forward them
@@ -114,15 +293,66 @@ class Manager:
 	"""
 	The Manager manages the subscriptions.
 	It is interfaces through the WebServices.
+	
+	Channels may subscribe to uris or uri patterns (job:*, filesystem:/repository/myproject/*),
+	indexed in a TestermanMessages.UriIndex.
+	Notifications are dispatched without locking: the mutex only serializes
+	subscription updates, and the subscribing channels are immutable
+	tuples replaced on update.
+	Each Xc channel has its own bounded outbound queue (ts.xc.queue_size):
+	the oldest notifications are dropped when it is full, and state-only
+	notifications (JOB-EVENT) still queued are replaced by the latest ones.
+	A channel that keeps lagging (queue at least half full or dropping
+	notifications) for more than ts.xc.slow_consumer_timeout seconds
+	is unsubscribed from all its uris.
+	
+	Il-received log events are numbered per job (Log-Sequence header)
+	and journaled, so that a subscription can resume from a sequence number
+	(see LogJournal). A resuming subscription is replayed from its own thread,
+	at the pace of the channel, up to ts.tl.max_replay_events events.
 	"""
+	# Min interval, in s, between two checks of the Xc channel queues
+	LAG_CHECK_INTERVAL = 1.0
+	# Max number of log journals (the least recently updated ones are discarded)
+	MAX_JOURNALS = 256
+	# Max number of events per replayed LOG-BATCH notification
+	MAX_REPLAY_BATCH_EVENTS = 1000
+	
 	def __init__(self, xcAddress, ilAddress):
 		self._mutex = threading.RLock()
-		self._xcServer = XcServer(self, xcAddress)
+		self._xcQueueSize = cm.get("ts.xc.queue_size")
+		self._xcServer = XcServer(self, xcAddress, self._xcQueueSize)
 		self._ilServer = IlServer(self, ilAddress)
 	
-		# The subscription mapping is a list of Xc channels objects per uri (jobid:<id>, system:jobs, ...).
-		self._subscriptions = {}
+		# The subscribing Xc channels objects per uri or uri pattern (jobid:<id>, system:jobs, job:*, ...).
+		self._subscriptions = Messages.UriIndex()
 		self._xcClients = []
+		# The Xc channels that declared they support LOG-BATCH notifications
+		# (Supported: log-batch). Other channels receive one LOG notification per event.
+		self._logBatchChannels = ()
+		
+		# Slow consumer detection:
+		# dict[channel] = dict(since: first lagging timestamp, or None, dropped, coalesced,
+		# unsubscribed: True if unsubscribed as a slow consumer, until it subscribes again)
+		self._lagStats = {}
+		self._nextLagCheck = 0
+		
+		# Log journals per job uri (see LogJournal).
+		# The journal mutex serializes the Il-received events handling
+		# (sequence numbering, writing, dispatching) and the subscription replays.
+		self._journals = {}
+		self._journalMutex = threading.RLock()
+		# The journals being rebuilt from their log file: dict[uri] = Event set once done
+		self._loadingJournals = {}
+		# The ongoing replays: dict[(channel, uri)] = Event set to cancel the replay
+		self._replays = {}
+		
+		# Il-received logs are written asynchronously
+		self._logWriter = LogWriter.LogWriter(
+			flushInterval = cm.get("ts.tl.flush_interval") / 1000.0,
+			flushSize = cm.get("ts.tl.flush_size"),
+			maxOpenFiles = cm.get("ts.tl.max_open_files"),
+			errorCallback = lambda filename, e: self.getLogger().error("Unable to write log to %s: %s" % (filename, str(e))))
 		
 	def _lock(self):
 		self._mutex.acquire()
@@ -138,6 +368,7 @@ class Manager:
 
 	def start(self):
 		self.getLogger().info("Starting...")
+		self._logWriter.start()
 		self._xcServer.start()
 		self._ilServer.start()
 		self.getLogger().info("Started")
@@ -148,37 +379,290 @@ class Manager:
 		self._xcServer.finalize()
 		self._ilServer.stop()
 		self._ilServer.finalize()
+		self._logWriter.stop()
 		self.getLogger().info("Stopped")
 	
-	def subscribe(self, channel, uri):
+	def subscribe(self, channel, uri, logBatch = False, fromSequence = None):
+		"""
+		@type  logBatch: bool
+		@param logBatch: if True, the channel accepts LOG-BATCH notifications
+		(for all its subscriptions)
+		@type  fromSequence: integer, or None
+		@param fromSequence: if set, the log events of the uri from this
+		sequence number are sent to the channel before the new ones
+		(resuming a subscription), from a dedicated thread: the subscription
+		is only effective once they are sent. Ignored for uri patterns.
+		"""
 		uri = str(uri) # make sure we deal with URI strings, not URI objects
+		if fromSequence is not None and not Messages.isUriPattern(uri):
+			self._startReplay(channel, uri, logBatch, fromSequence)
+			return
 		self._lock()
-		if not self._subscriptions.has_key(uri):
-			self._subscriptions[uri] = [ channel ]
-		else:
-			if channel not in self._subscriptions[uri]:
-				self._subscriptions[uri].append(channel)
+		self._addSubscription(channel, uri, logBatch)
 		self._unlock()
 		self.getLogger().info("channel %s subscribed to uri %s" % (str(channel), uri))
 	
+	def _addSubscription(self, channel, uri, logBatch):
+		"""
+		Called with the mutex held.
+		"""
+		self._subscriptions.add(uri, channel)
+		if logBatch and channel not in self._logBatchChannels:
+			self._logBatchChannels += (channel, )
+		if self._lagStats.has_key(channel):
+			self._lagStats[channel]['unsubscribed'] = False
+	
+	def _startReplay(self, channel, uri, logBatch, fromSequence):
+		"""
+		Starts a thread replaying the log events of uri to channel,
+		then subscribing it (see _subscribeFrom).
+		
+		The replay is cancelled if the channel unsubscribes from uri
+		or disconnects meanwhile, or resumes the same subscription again.
+		"""
+		cancelled = threading.Event()
+		self._lock()
+		previous = self._replays.get((channel, uri))
+		if previous:
+			previous.set()
+		self._replays[(channel, uri)] = cancelled
+		self._unlock()
+		
+		def replay():
+			try:
+				self._subscribeFrom(channel, uri, logBatch, fromSequence, cancelled)
+			except Exception, e:
+				self.getLogger().error("Unable to replay log events on %s to channel %s: %s" % (uri, str(channel), str(e)))
+			self._lock()
+			if self._replays.get((channel, uri)) is cancelled:
+				del self._replays[(channel, uri)]
+			self._unlock()
+		
+		thread = threading.Thread(target = replay)
+		thread.setDaemon(True)
+		thread.start()
+	
+	def _cancelReplays(self, channel, uri = None):
+		"""
+		Cancels the replays to channel (on uri only, if provided).
+		Called with the mutex held.
+		"""
+		for (key, cancelled) in self._replays.items():
+			if key[0] == channel and (uri is None or key[1] == uri):
+				cancelled.set()
+				del self._replays[key]
+
+	def _subscribeFrom(self, channel, uri, logBatch, fromSequence, cancelled):
+		"""
+		Replays the log events from fromSequence, then subscribes,
+		so that the channel does not miss or get duplicated events.
+		
+		The events that are no longer in the journal ring are streamed from
+		the log file without holding the journal mutex, as long as the ring
+		keeps moving on, paced by the channel queue depth (see _replayLogEvents).
+		
+		The client is told about the events that cannot be replayed with
+		a LOG-REPLAY notification (see _sendReplayTruncated):
+		- the events older than the last ts.tl.max_replay_events ones,
+		- the remaining events of the log file if the channel does not
+		  consume them for ts.xc.slow_consumer_timeout,
+		- all of them if the job is unknown (no journal, no log file).
+		"""
+		fromSequence = max(1, fromSequence)
+		filename = None
+		started = False
+		while not cancelled.isSet():
+			journal = self._journals.get(uri)
+			if journal is None:
+				# Evicted journal, or server restart: rebuilt from the job log file
+				filename = filename or self._getJobLogFilename(uri)
+				if filename and os.path.exists(filename):
+					journal = self._loadJournal(uri, filename)
+			
+			self._journalMutex.acquire()
+			try:
+				if self._journals.get(uri) is not journal:
+					# Evicted meanwhile
+					continue
+				if journal is None:
+					self._sendReplayTruncated(channel, uri, None, "unknown job")
+					self._subscribeReplayed(channel, uri, logBatch, cancelled)
+					return
+				
+				maxEvents = cm.get("ts.tl.max_replay_events")
+				if maxEvents and journal.nextSequence - fromSequence > maxEvents:
+					fromSequence = journal.nextSequence - maxEvents
+					self._sendReplayTruncated(channel, uri, fromSequence, "more than %s events" % maxEvents)
+				if not started:
+					self.getLogger().info("Replaying log events on %s from sequence %s (up to %s) to channel %s" % (uri, fromSequence, journal.nextSequence - 1, str(channel)))
+					started = True
+				(ringSequence, ringOffset) = journal.getRingStart()
+				if fromSequence >= ringSequence or not journal.filename:
+					if fromSequence < ringSequence:
+						# No log file to read the oldest events from
+						fromSequence = ringSequence
+						self._sendReplayTruncated(channel, uri, fromSequence, "no log file")
+					# The ring is bounded (ts.tl.replay_ring_size): it is sent at once
+					self._replayLogEvents(channel, uri, journal.getRingEvents(fromSequence), logBatch)
+					self._subscribeReplayed(channel, uri, logBatch, cancelled)
+					return
+				filename = journal.filename
+				(checkpointSequence, checkpointOffset) = journal.getCheckpoint(fromSequence)
+			finally:
+				self._journalMutex.release()
+			
+			try:
+				if not self._replayLogFile(channel, uri, logBatch, filename, checkpointOffset, ringOffset, checkpointSequence, fromSequence, cancelled):
+					if cancelled.isSet():
+						return
+					self._sendReplayTruncated(channel, uri, ringSequence, "the channel does not consume them")
+			except Exception, e:
+				self._sendReplayTruncated(channel, uri, ringSequence, "unable to read them from %s: %s" % (filename, str(e)))
+			fromSequence = ringSequence
+
+	def _subscribeReplayed(self, channel, uri, logBatch, cancelled):
+		"""
+		Subscribes channel once its replay is complete, unless it was cancelled.
+		Called with the journal mutex held.
+		"""
+		self._lock()
+		try:
+			if cancelled.isSet():
+				return
+			self._addSubscription(channel, uri, logBatch)
+		finally:
+			self._unlock()
+		self.getLogger().info("channel %s subscribed to uri %s" % (str(channel), uri))
+
+	def _replayLogFile(self, channel, uri, logBatch, filename, fromOffset, toOffset, firstSequence, fromSequence, cancelled):
+		"""
+		Replays the log events from a log file offset range.
+		
+		@type  firstSequence: integer
+		@param firstSequence: the sequence number of the event at fromOffset
+		@type  fromSequence: integer
+		@param fromSequence: the first event to replay
+		
+		@rtype: bool
+		@returns: True if all the events were sent, False if the replay
+		was cancelled or the channel did not consume them
+		"""
+		self.flushLog(filename)
+		sequence = firstSequence
+		for (offset, events) in _iterLogChunks(filename, fromOffset, toOffset):
+			replayed = []
+			for i in range(max(0, fromSequence - sequence), len(events)):
+				event = _toXmlEvent(events[i])
+				m = _XmlClassPattern.match(event)
+				# The timestamp is not available from the log file
+				replayed.append((sequence + i, m and m.group(1) or 'event', None, event))
+			sequence += len(events)
+			if not self._replayLogEvents(channel, uri, replayed, logBatch, cancelled):
+				return False
+		return True
+
+	def _replayLogEvents(self, channel, uri, events, logBatch, cancelled = None):
+		"""
+		Sends replayed log events to a channel, as LOG-BATCH notifications
+		if it supports them, as LOG notifications otherwise.
+		
+		These notifications are not subject to the Xc queue drop-oldest
+		policy: a client resuming a subscription would miss them again.
+		They are marked with a Log-Replay header, so that the client knows
+		that the events before the first replayed one cannot be replayed
+		anymore if it does not start with the requested sequence number.
+		
+		If cancelled is provided (the journal mutex is not held), the sender
+		waits for the channel to consume its queue before each notification
+		batch, so that the replayed events never fill more than half of it.
+		
+		@rtype: bool
+		@returns: True if the events were sent, False if the replay was
+		cancelled or the channel did not consume them for ts.xc.slow_consumer_timeout
+		"""
+		# Paced batches must fit in a quarter of the queue, sent when it is at most a quarter full
+		batchSize = self.MAX_REPLAY_BATCH_EVENTS
+		if cancelled is not None and self._xcQueueSize:
+			batchSize = max(1, min(batchSize, self._xcQueueSize / 4))
+		for i in range(0, len(events), batchSize):
+			batch = events[i:i + batchSize]
+			notification = Messages.Notification("LOG-BATCH", uri, "Il", "1.0")
+			notification.setHeader("Log-Classes", ','.join([ logClass for (sequence, logClass, timestamp, event) in batch ]))
+			notification.setHeader("Log-Timestamp", batch[-1][2] or time.time())
+			notification.setHeader("Log-Sequence", batch[0][0])
+			notification.setHeader("Log-Replay", "true")
+			notification.setContentEncoding(notification.ENCODING_UTF8)
+			notification.setContentType("application/xml")
+			xmlEvents = [ event for (sequence, logClass, timestamp, event) in batch ]
+			notification.setBody(''.join([ '%s\n' % event for event in xmlEvents ]))
+			if logBatch:
+				notifications = [ notification ]
+			else:
+				notifications = self._splitLogBatch(notification, xmlEvents)
+			if cancelled is not None and self._xcQueueSize and not self._waitQueueDepth(channel, max(0, self._xcQueueSize / 4 - 1), cancelled):
+				return False
+			try:
+				for n in notifications:
+					self._xcServer.sendNotification(channel, n, reliable = True)
+			except:
+				self.getLogger().warning("Unable to send replayed events to a client")
+				return False
+		return True
+
+	def _waitQueueDepth(self, channel, maxDepth, cancelled):
+		"""
+		Waits until at most maxDepth notifications are queued for channel.
+		
+		@rtype: bool
+		@returns: False if the replay was cancelled meanwhile, or if the channel
+		did not consume its queue for ts.xc.slow_consumer_timeout (if set)
+		"""
+		timeout = cm.get("ts.xc.slow_consumer_timeout")
+		deadline = time.time() + timeout
+		while not cancelled.isSet():
+			if self._xcServer.waitQueueDepth(channel, maxDepth, 1.0):
+				return True
+			if timeout and time.time() > deadline:
+				return False
+		return False
+
+	def _sendReplayTruncated(self, channel, uri, sequence, reason):
+		"""
+		Tells a resuming channel that the log events it asked for cannot all be replayed:
+		the events before sequence, or all the events if sequence is None,
+		are lost for it.
+		"""
+		if sequence is None:
+			self.getLogger().warning("Unable to replay the log events on %s to channel %s: %s" % (uri, str(channel), reason))
+		else:
+			self.getLogger().warning("Unable to replay the log events on %s before sequence %s to channel %s: %s" % (uri, sequence, str(channel), reason))
+		notification = Messages.Notification("LOG-REPLAY", uri, "Il", "1.0")
+		if sequence is None:
+			notification.setHeader("Log-Replay", "unavailable")
+		else:
+			notification.setHeader("Log-Replay", "truncated")
+			notification.setHeader("Log-Sequence", sequence)
+		try:
+			self._xcServer.sendNotification(channel, notification, reliable = True)
+		except:
+			self.getLogger().warning("Unable to send event to a client")
+
 	def unsubscribe(self, channel, uri):
 		uri = str(uri) # make sure we deal with URI strings, not URI objects
 		self._lock()
-		if not self._subscriptions.has_key(uri):
+		self._cancelReplays(channel, uri)
+		if not self._subscriptions.getValues(uri):
 			self._unlock()
 			self.getLogger().warning("Unsubscription attempt for an unknown uri (%s). Discarding." % uri)
 			return
 
-		if channel in self._subscriptions[uri]:
-			self._subscriptions[uri].remove(channel)
+		self._subscriptions.remove(uri, channel)
 
 		self.getLogger().info("channel %s unsubscribed from uri %s" % (str(channel), uri))
 		
-		# Garbage collecting:
 		# The uri may be watched by anybody else
-		if len(self._subscriptions[uri]) == 0:
-			self.getLogger().info("No other subscription on uri %s, garbage collecting it..." % uri)
-			del self._subscriptions[uri]
+		if not self._subscriptions.getValues(uri):
+			self.getLogger().info("No other subscription on uri %s" % uri)
 
 		self._unlock()
 
@@ -192,18 +676,36 @@ class Manager:
 	def unregisterXcClient(self, channel):
 		self.getLogger().info("Client %s disconnected from Xc" % str(channel))
 		self._lock()
-		for (uri, clients) in self._subscriptions.items():
-			if channel in clients:
-				clients.remove(channel)
-			# Garbage collection
-			if len(clients) == 0:
-				del self._subscriptions[uri]
+		self._unsubscribeAll(channel)
 		if channel in self._xcClients:
 			self._xcClients.remove(channel)
+		self._lagStats.pop(channel, None)
 		self._unlock()
 		self.getLogger().debug("Client %s purged from Xc registered clients" % str(channel))
 		CounterManager.instance().dec("server.ts.xcchannels.current")
 
+	def _unsubscribeAll(self, channel):
+		"""
+		Called with the mutex held.
+		"""
+		self._cancelReplays(channel)
+		self._subscriptions.removeValue(channel)
+		if channel in self._logBatchChannels:
+			self._logBatchChannels = tuple([ x for x in self._logBatchChannels if x != channel ])
+
+	def _getCoalescingKey(self, notification):
+		"""
+		Returns the key identifying the state carried by a state-only
+		notification (only the latest one is worth sending to a lagging client),
+		or None if the notification must not be coalesced.
+		"""
+		if notification.getMethod() == "JOB-EVENT":
+			try:
+				return ("JOB-EVENT", str(notification.getUri()), notification.getApplicationBody()['id'])
+			except Exception:
+				pass
+		return None
+
 	def dispatchNotification(self, notification):
 		"""
 		Forwards the notification to all subscribing clients.
@@ -214,40 +716,344 @@ class Manager:
 		uri = str(notification.getUri()) # make sure we deal with URI strings, not URI objects
 		self.getLogger().debug("Dispatching notification on Xc for %s..." % uri)
 		nbClients = 0
-		self._lock()
-		if not self._subscriptions.has_key(uri):
-			self._unlock()
+		# Lock-free: the subscribing channels are an immutable tuple
+		channels = self._subscriptions.match(uri)
+		if not channels:
 			return
-		for channel in self._subscriptions[uri]:
+		coalesceKey = self._getCoalescingKey(notification)
+		for channel in channels:
 			try:
-				self._xcServer.sendNotification(channel, notification)
+				self._xcServer.sendNotification(channel, notification, coalesceKey)
 				nbClients += 1
 			except:
 				self.getLogger().warning("Unable to send event to a client")
-		self._unlock()
 		self.getLogger().debug("Notification dispatched to %d Xc clients" % nbClients)
+		self._checkSlowConsumers()
+
+	def _checkSlowConsumers(self):
+		"""
+		Accounts for the Xc channels lagging behind the dispatched notifications,
+		and unsubscribes the ones that lag for too long.
+		
+		Only performed every LAG_CHECK_INTERVAL.
+		"""
+		now = time.time()
+		if now < self._nextLagCheck:
+			return
+		self._lock()
+		try:
+			if now < self._nextLagCheck:
+				return
+			self._nextLagCheck = now + self.LAG_CHECK_INTERVAL
+			timeout = cm.get("ts.xc.slow_consumer_timeout")
+			counters = CounterManager.instance()
+			for stats in self._xcServer.getChannelStats():
+				channel = stats['channel']
+				previous = self._lagStats.get(channel)
+				if previous is None:
+					previous = { 'since': None, 'dropped': 0, 'coalesced': 0, 'unsubscribed': False }
+					self._lagStats[channel] = previous
+				dropped = stats['dropped'] - previous['dropped']
+				if dropped:
+					counters.inc("server.ts.xc.dropped", dropped)
+				if stats['coalesced'] > previous['coalesced']:
+					counters.inc("server.ts.xc.coalesced", stats['coalesced'] - previous['coalesced'])
+				previous['dropped'] = stats['dropped']
+				previous['coalesced'] = stats['coalesced']
+
+				if previous['unsubscribed'] or (not dropped and stats['queue-depth'] * 2 < self._xcQueueSize):
+					previous['since'] = None
+				elif previous['since'] is None:
+					previous['since'] = now
+					self.getLogger().warning("Xc client %s is lagging: %s queued notifications, %s dropped since the last check" % (str(channel), stats['queue-depth'], dropped))
+				elif timeout and now - previous['since'] > timeout:
+					self.getLogger().warning("Xc client %s has been lagging for more than %ss (%s notifications dropped so far): unsubscribing it from all uris" % (str(channel), timeout, stats['dropped']))
+					self._unsubscribeAll(channel)
+					previous['since'] = None
+					previous['unsubscribed'] = True
+					counters.inc("server.ts.xc.slowconsumers")
+		finally:
+			self._unlock()
+	
+	def dispatchLogBatch(self, notification, events):
+		"""
+		Forwards a LOG-BATCH notification to all subscribing clients:
+		as is to the clients that support it, as one LOG notification
+		per event to the other ones.
+		
+		@type  notification: Notification message
+		@param notification: the LOG-BATCH notification, with an XML body
+		@type  events: list of strings
+		@param events: the XML events contained in the batch, utf-8 encoded, without their trailing newline
+		"""
+		uri = str(notification.getUri())
+		self.getLogger().debug("Dispatching log batch on Xc for %s..." % uri)
+		# Lock-free: the subscribing channels are an immutable tuple
+		channels = self._subscriptions.match(uri)
+		if not channels:
+			return
+		
+		logBatchChannels = self._logBatchChannels
+		notifications = None
+		for channel in channels:
+			if channel in logBatchChannels:
+				channelNotifications = [ notification ]
+			else:
+				if notifications is None:
+					notifications = self._splitLogBatch(notification, events)
+				channelNotifications = notifications
+			try:
+				for n in channelNotifications:
+					self._xcServer.sendNotification(channel, n)
+			except:
+				self.getLogger().warning("Unable to send event to a client")
+		self._checkSlowConsumers()
+
+	def _splitLogBatch(self, notification, events):
+		"""
+		Creates the LOG notifications corresponding to the events of a LOG-BATCH notification.
+		"""
+		ret = []
+		uri = notification.getUri()
+		filename = notification.getHeader('Log-Filename')
+		timestamp = notification.getHeader('Log-Timestamp')
+		sequence = notification.getHeader('Log-Sequence')
+		replay = notification.getHeader('Log-Replay')
+		for (logClass, event) in zip(notification.getHeader('Log-Classes').split(','), events):
+			n = Messages.Notification("LOG", uri, "Il", "1.0")
+			n.setHeader("Log-Filename", filename)
+			n.setHeader("Log-Class", logClass)
+			n.setHeader("Log-Timestamp", timestamp)
+			if sequence is not None:
+				n.setHeader("Log-Sequence", sequence)
+				sequence = int(sequence) + 1
+			if replay is not None:
+				n.setHeader("Log-Replay", replay)
+			n.setContentEncoding(n.ENCODING_UTF8)
+			n.setContentType("application/xml")
+			n.setBody(event)
+			ret.append(n)
+		return ret
 	
 	def getLogger(self):
 		return logging.getLogger('TS.TL')
 
+	def _hasSubscribers(self, uri):
+		return self._subscriptions.hasMatch(str(uri))
+
+	def _getJobLogFilename(self, uri):
+		"""
+		Returns the log filename of a job uri, as provided by its TE
+		in the Log-Filename header, or None if the job is unknown.
+		"""
+		m = re.match(r'job:([0-9]+)$', uri)
+		if not m:
+			return None
+		# Imported here: the JobManager depends on this module
+		import JobManager
+		jobManager = JobManager.instance()
+		job = jobManager and jobManager.getJob(int(m.group(1)))
+		if not job or not job.getLogFilename():
+			return None
+		return os.path.normpath("%s%s" % (cm.get("testerman.document_root"), job.getLogFilename()))
+
+	def _loadJournal(self, uri, filename):
+		"""
+		Returns the log journal for uri, creating it if needed.
+		
+		If the log file already exists (server restart, evicted journal),
+		the journal is rebuilt from it without holding the journal mutex,
+		so that only the threads waiting for this journal are held up meanwhile.
+		No events can be written to this log file until the journal is
+		registered, since they are written once journaled.
+		"""
+		while True:
+			self._journalMutex.acquire()
+			try:
+				journal = self._journals.get(uri)
+				if journal:
+					return journal
+				loading = self._loadingJournals.get(uri)
+				if loading is None:
+					loading = threading.Event()
+					self._loadingJournals[uri] = loading
+					break
+			finally:
+				self._journalMutex.release()
+			loading.wait()
+		
+		journal = LogJournal(filename, cm.get("ts.tl.replay_ring_size"))
+		try:
+			if filename and os.path.exists(filename):
+				# We are not the first to write to this log:
+				# sequence numbers must reflect the existing events
+				self._scanLogFile(journal)
+		except Exception, e:
+			self.getLogger().error("Unable to read the existing log events from %s: %s" % (filename, str(e)))
+		self._journalMutex.acquire()
+		try:
+			journal = self._addJournal(uri, journal)
+			del self._loadingJournals[uri]
+		finally:
+			self._journalMutex.release()
+		loading.set()
+		return journal
+
+	def _scanLogFile(self, journal):
+		"""
+		Sets the next sequence number and offset of a new journal from
+		its existing log file, with checkpoints to read back its events.
+		"""
+		self.flushLog(journal.filename)
+		sequence = 1
+		for (offset, events) in _iterLogChunks(journal.filename, 0):
+			if sequence - journal.checkpoints[-1][0] >= LogJournal.CHECKPOINT_INTERVAL:
+				journal.checkpoints.append((sequence, offset))
+			sequence += len(events)
+		journal.nextSequence = sequence
+		journal.offset = os.path.getsize(journal.filename)
+
+	def _addJournal(self, uri, journal):
+		"""
+		Registers a log journal for uri, unless there is already one,
+		discarding the least recently updated one if needed.
+		Called with the journal mutex held.
+		
+		@rtype: LogJournal
+		@returns: the journal registered for uri
+		"""
+		if self._journals.has_key(uri):
+			return self._journals[uri]
+		if len(self._journals) >= self.MAX_JOURNALS:
+			oldest = min(self._journals.items(), key = lambda (k, v): v.lastUpdate)[0]
+			del self._journals[oldest]
+		self._journals[uri] = journal
+		return journal
+
+	def _journalLog(self, notification, journal, logClasses, data):
+		"""
+		Gives their sequence numbers to Il-received log events,
+		set as the notification Log-Sequence header (first event).
+		Called with the journal mutex held.
+		
+		@type  journal: LogJournal
+		@param journal: the journal loaded for the notification uri
+		(registered again if it was discarded meanwhile)
+		"""
+		journal = self._addJournal(str(notification.getUri()), journal)
+		notification.setHeader('Log-Sequence', journal.append(logClasses, notification.getHeader('Log-Timestamp'), data))
+		return journal
+
 	def handleIlNotification(self, notification):
+		# Il events may be received from several threads (Il server, local jobs):
+		# they must be numbered and dispatched in the order they are written
+		journal = None
+		if notification.getMethod() in [ "LOG", "LOG-BATCH" ]:
+			journal = self._loadJournal(str(notification.getUri()), notification.getHeader('Log-Filename'))
+		self._journalMutex.acquire()
+		try:
+			self._handleIlNotification(notification, journal)
+		finally:
+			self._journalMutex.release()
+
+	def _handleIlNotification(self, notification, journal):
 		method = notification.getMethod()
-		if method == "LOG":
+		if method == "LOG" and notification.getContentType() == BinaryLog.CONTENT_TYPE:
+			# Binary log records are written as is,
+			# but dispatched as XML so that Xc clients don't have to know this format
+			record = notification.getApplicationBody()
+			filename = notification.getHeader('Log-Filename')
+			journal = self._journalLog(notification, journal, [ notification.getHeader('Log-Class') ], record)
+			if filename:
+				self._logWriter.write(filename, record)
+				# The log file must be complete as soon as the ATS is stopped
+				if notification.getHeader('Log-Class') == 'core' and BinaryLog.getRecordElement(record) == 'ats-stopped':
+					self.flushLog(filename, close = True)
+					journal.clearRing()
+			if not self._hasSubscribers(notification.getUri()):
+				return
+			notification.setContentEncoding(notification.ENCODING_UTF8)
+			notification.setContentType("application/xml")
+			notification.setBody(BinaryLog.decodeRecord(record).toXml().encode('utf-8'))
+		elif method == "LOG-BATCH":
+			self._handleIlLogBatch(notification, journal)
+			return
+		elif method == "LOG":
 			# Add server-side/TL control here
 			filename = notification.getHeader('Log-Filename')
+			body = notification.getBody()
+			journal = self._journalLog(notification, journal, [ notification.getHeader('Log-Class') ], '%s\n' % body)
 			if filename:
-				try:
-					f = open(filename, 'a')
-					f.write('%s\n' % notification.getBody())
-					f.close()
-				except Exception, e:
-					self.getLogger().error("Unable to write log for %s: %s" % (notification.getUri(), str(e)))		
+				self._logWriter.write(filename, '%s\n' % body)
+				# The log file must be complete as soon as the ATS is stopped
+				if notification.getHeader('Log-Class') == 'core' and body.startswith('<ats-stopped'):
+					self.flushLog(filename, close = True)
+					journal.clearRing()
 		else:
 			self.getLogger().warning("Received unsupported notification method: " + method)
 
 		# Dispath
 		self.dispatchNotification(notification)
 
+	def _handleIlLogBatch(self, notification, journal):
+		"""
+		A LOG-BATCH body is written to the log file at once.
+		It is only split into events if they must be dispatched,
+		or to look for a terminating ats-stopped event.
+		"""
+		binary = (notification.getContentType() == BinaryLog.CONTENT_TYPE)
+		if binary:
+			data = notification.getApplicationBody()
+		else:
+			data = notification.getBody()
+		logClasses = (notification.getHeader('Log-Classes') or '').split(',')
+		filename = notification.getHeader('Log-Filename')
+		hasSubscribers = self._hasSubscribers(notification.getUri())
+		journal = self._journalLog(notification, journal, logClasses, data)
+
+		events = None
+		if filename:
+			self._logWriter.write(filename, data)
+			# The log file must be complete as soon as the ATS is stopped
+			# (the TE sends core events immediately, so it can only be the last event of the batch)
+			if logClasses[-1] == 'core':
+				events = BinaryLog.splitEvents(data)[0]
+				if not events:
+					stopped = False
+				elif binary:
+					stopped = (BinaryLog.getRecordElement(events[-1]) == 'ats-stopped')
+				else:
+					stopped = events[-1].startswith('<ats-stopped')
+				if stopped:
+					self.flushLog(filename, close = True)
+					journal.clearRing()
+
+		if not hasSubscribers:
+			return
+		if events is None:
+			events = BinaryLog.splitEvents(data)[0]
+		if binary:
+			events = [ BinaryLog.decodeRecord(record).toXml().encode('utf-8') for record in events ]
+		else:
+			events = [ event.rstrip('\r\n') for event in events ]
+		notification.setContentEncoding(notification.ENCODING_UTF8)
+		notification.setContentType("application/xml")
+		notification.setBody(''.join([ '%s\n' % event for event in events ]))
+		self.dispatchLogBatch(notification, events)
+
+	def flushLog(self, filename, close = False):
+		"""
+		Makes sure that all the Il-received logs for filename
+		are written to it.
+		To call before reading a log file.
+		
+		@type  filename: string
+		@param filename: the log filename, as provided in the Log-Filename header
+		@type  close: bool
+		@param close: if True, the file is also closed
+		"""
+		self._logWriter.flush(filename, close)
+
 
 ################################################################################
 # Main module functions
@@ -25,6 +25,7 @@
 #
 ##
 
+import BinaryLog
 import ConfigManager
 import DependencyResolver
 import EventManager
@@ -76,6 +77,45 @@ class PrepareException(Exception):
 # Tools/Convenience functions
 ################################################################################
 
+def readLogChunk(filename, fromOffset, maxBytes):
+	"""
+	Reads the complete log events available in a log file,
+	starting at fromOffset.
+	
+	At most maxBytes are read, unless the first event is larger than that
+	(it is returned anyway so that the reader can progress).
+	
+	@type  filename: string
+	@param filename: the absolute path to the log file
+	@type  fromOffset: integer
+	@param fromOffset: the offset of the first event to read, in bytes
+	(0, or an offset previously returned by this function)
+	@type  maxBytes: integer
+	@param maxBytes: the max number of bytes to read from the file
+	
+	@rtype: tuple (string (utf-8), integer)
+	@returns: the events, as XML events (no prologue, no root element),
+	and the offset of the next event to read.
+	"""
+	# Make sure we get the logs that are still buffered by the TL
+	EventManager.instance().flushLog(filename)
+	f = open(filename, 'rb')
+	try:
+		fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+		f.seek(fromOffset)
+		data = f.read(maxBytes)
+		(events, length) = BinaryLog.splitEvents(data)
+		while not events:
+			# The first event may be larger than maxBytes
+			chunk = f.read(maxBytes)
+			if not chunk:
+				break
+			data += chunk
+			(events, length) = BinaryLog.splitEvents(data)
+	finally:
+		f.close()
+	return (BinaryLog.convertDataToXml(''.join(events)), fromOffset + length)
+
 _GeneratorBaseId = 0
 _GeneratorBaseIdMutex = threading.RLock()
 
@@ -570,6 +610,23 @@ class Job(object):
 		"""		
 		return None
 
+	def getLogChunk(self, fromOffset, maxBytes):
+		"""
+		Returns the complete log events available from a log file offset,
+		so that clients can retrieve the logs of a running job incrementally.
+		
+		@type  fromOffset: integer
+		@param fromOffset: 0, or the offset returned by the previous call
+		@type  maxBytes: integer
+		@param maxBytes: the max number of bytes to read from the log file
+		
+		@rtype: tuple (string (utf-8), integer), or None
+		@returns: the events as XML (no prologue, no root element),
+		          and the offset to use to get the next events.
+		          Returns None if no log is available.
+		"""
+		return None
+
 	def postRun(self):
 		"""
 		Called when the job is complete, regardless of its status.
@@ -637,6 +694,7 @@ class AtsJob(Job):
 		self._tePackageDirectory = None
 		
 		self._selectedGroups = None
+		self._logFormat = None
 		
 		# For detailed info
 		self._teInputSession = None
@@ -678,6 +736,18 @@ self._baseDirectory, self._tePackageDirectory, self._teCommandLine, self._teFile
 	def getSelectedGroups(self):
 		return self._selectedGroups
 	
+	def setLogFormat(self, logFormat):
+		"""
+		@type  logFormat: string, or None
+		@param logFormat: 'xml' or 'binary' (see BinaryLog). None means the TE default (xml).
+		"""
+		if logFormat not in [ None, 'xml', 'binary' ]:
+			raise Exception("Invalid log format (%s)" % logFormat)
+		self._logFormat = logFormat
+	
+	def getLogFormat(self):
+		return self._logFormat
+	
 	def handleSignal(self, sig):
 		getLogger().info("%s received signal %s" % (str(self), sig))
 		
@@ -1125,7 +1195,8 @@ Platform: UNKNOWN
 			logFilename = teLogFilename, 
 			inputSessionFilename = inputSessionFilename, 
 			outputSessionFilename = outputSessionFilename, 
-			selectedGroups = self.getSelectedGroups())
+			selectedGroups = self.getSelectedGroups(),
+			logFormat = self.getLogFormat())
 		executable = cmd['executable']
 		args = cmd['args']
 		env = cmd['env']
@@ -1218,10 +1289,14 @@ Platform: UNKNOWN
 			try:
 				# Logs are locally generated, so no need to access them through the FileSystemManager.
 				absoluteLogFilename = os.path.normpath("%s%s" % (cm.get("testerman.document_root"), self._logFilename))
+				# Make sure we get the logs that are still buffered by the TL
+				EventManager.instance().flushLog(absoluteLogFilename)
 				f = open(absoluteLogFilename, 'r')
-				fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-				res = '<?xml version="1.0" encoding="utf-8" ?>\n<ats>\n%s</ats>' % f.read()
+				fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+				data = f.read()
 				f.close()
+				# Binary events, if any, are converted so that clients always get XML logs
+				res = '<?xml version="1.0" encoding="utf-8" ?>\n<ats>\n%s</ats>' % BinaryLog.convertDataToXml(data)
 				return res
 			except Exception, e:
 				if self.isFinished():
@@ -1235,6 +1310,21 @@ Platform: UNKNOWN
 			# The log file has not been initialized yet.
 			return '<?xml version="1.0" encoding="utf-8" ?>\n<ats>\n</ats>'
 
+	def getLogChunk(self, fromOffset, maxBytes):
+		if self._logFilename:
+			try:
+				absoluteLogFilename = os.path.normpath("%s%s" % (cm.get("testerman.document_root"), self._logFilename))
+				return readLogChunk(absoluteLogFilename, fromOffset, maxBytes)
+			except Exception, e:
+				if self.isFinished():
+					raise e
+				else:
+					# The log file may have not been created yet.
+					return ('', fromOffset)
+		else:
+			# The log file has not been initialized yet.
+			return ('', fromOffset)
+
 
 ################################################################################
 # Job subclass: Campaign Group for parallel execution
@@ -1706,8 +1796,9 @@ class CampaignJob(Job):
 		Returns the current known log.
 		"""
 		if self._logFilename:
+			EventManager.instance().flushLog(self._absoluteLogFilename)
 			f = open(self._absoluteLogFilename, 'r')
-			fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+			fcntl.flock(f.fileno(), fcntl.LOCK_SH)
 			# FIXME: we generate a 'ats' root element. Is that correct ?
 			res = '<?xml version="1.0" encoding="utf-8" ?>\n<ats>\n%s</ats>' % f.read()
 			f.close()
@@ -1715,6 +1806,12 @@ class CampaignJob(Job):
 		else:
 			return '<?xml version="1.0" encoding="utf-8" ?>\n<ats>\n</ats>'
 
+	def getLogChunk(self, fromOffset, maxBytes):
+		if self._logFilename:
+			return readLogChunk(self._absoluteLogFilename, fromOffset, maxBytes)
+		else:
+			return ('', fromOffset)
+
 ################################################################################
 # The Scheduler Thread
 ################################################################################
@@ -1970,6 +2067,13 @@ class JobManager:
 		else:
 			return None
 
+	def getJobLogChunk(self, id_, fromOffset, maxBytes):
+		job = self.getJob(id_)
+		if job:
+			return job.getLogChunk(fromOffset, maxBytes)
+		else:
+			return None
+
 	def rescheduleJob(self, id_, at):
 		job = self.getJob(id_)
 		if job:
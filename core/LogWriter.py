@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+##
+# This file is part of Testerman, a test automation system.
+# Copyright (c) 2008,2009,2010 Sebastien Lefevre and other contributors
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+##
+
+##
+# A buffered, asynchronous log file writer.
+#
+# Log lines are appended to a per-file buffer by the producers
+# (TE local logger, TL sub-system in the server), and actually
+# written by a dedicated thread, either every flush interval
+# or as soon as the buffered data exceeds a max size.
+#
+# Opened files are kept opened (up to a max number of files,
+# the least recently used ones are closed first) so that
+# we don't open/close a file for each log line.
+#
+# Readers that need a complete log file should call flush(filename)
+# before reading it.
+#
+##
+
+import threading
+import time
+
+
+class LogWriter(threading.Thread):
+	"""
+	A thread writing buffered data to files.
+
+	Lock order: _ioMutex, then _condition.
+	_ioMutex serializes the actual writes (so that explicit flushes and
+	the background thread cannot reorder lines),
+	_condition protects the pending buffers.
+	"""
+	def __init__(self, flushInterval = 0.2, flushSize = 65536, maxOpenFiles = 64, errorCallback = None):
+		"""
+		@type  flushInterval: float
+		@param flushInterval: the max delay, in s, before buffered data are written
+		@type  flushSize: integer
+		@param flushSize: the buffered size, in bytes, that triggers an immediate write
+		@type  maxOpenFiles: integer
+		@param maxOpenFiles: the max number of files kept opened at the same time
+		@type  errorCallback: callable(filename, exception), or None
+		@param errorCallback: called when a write to a file failed.
+		The corresponding data are lost.
+		"""
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+		self._flushInterval = flushInterval
+		self._flushSize = flushSize
+		self._maxOpenFiles = maxOpenFiles
+		self._errorCallback = errorCallback
+
+		self._condition = threading.Condition(threading.Lock())
+		self._ioMutex = threading.RLock()
+		self._stopEvent = threading.Event()
+		# dict[filename] = list of strings to append to the file
+		self._pending = {}
+		self._pendingSize = 0
+		# dict[filename] = file object, and the LRU ordered filenames (last used last)
+		self._files = {}
+		self._lruFilenames = []
+
+	def write(self, filename, data):
+		"""
+		Buffers data to append to filename.
+
+		@type  filename: string
+		@param filename: the file to append data to
+		@type  data: string (utf-8 encoded, not unicode)
+		@param data: the data to append
+		"""
+		self._condition.acquire()
+		try:
+			buf = self._pending.get(filename)
+			if buf is None:
+				self._pending[filename] = [ data ]
+			else:
+				buf.append(data)
+			self._pendingSize += len(data)
+			if self._pendingSize >= self._flushSize:
+				self._condition.notify()
+		finally:
+			self._condition.release()
+
+	def flush(self, filename = None, close = False):
+		"""
+		Synchronously writes the buffered data for filename,
+		or for all files if filename is None.
+		When this function returns, the data are readable from the file.
+
+		@type  filename: string, or None
+		@param filename: the file to flush, or None to flush all files
+		@type  close: bool
+		@param close: if True, also closes the file (it will be re-opened on next write)
+		"""
+		self._ioMutex.acquire()
+		try:
+			self._condition.acquire()
+			try:
+				if filename is None:
+					pending = self._pending
+					self._pending = {}
+					self._pendingSize = 0
+				else:
+					pending = {}
+					buf = self._pending.pop(filename, None)
+					if buf is not None:
+						pending[filename] = buf
+						self._pendingSize -= sum([ len(x) for x in buf ])
+			finally:
+				self._condition.release()
+
+			for (name, buf) in pending.items():
+				self._writeFile(name, ''.join(buf))
+
+			if close:
+				if filename is None:
+					for name in self._files.keys():
+						self._closeFile(name)
+				else:
+					self._closeFile(filename)
+		finally:
+			self._ioMutex.release()
+
+	def run(self):
+		while not self._stopEvent.isSet():
+			self._condition.acquire()
+			try:
+				if self._pendingSize < self._flushSize:
+					self._condition.wait(self._flushInterval)
+			finally:
+				self._condition.release()
+			self.flush()
+		# Final flush, close all opened files
+		self.flush(close = True)
+
+	def stop(self):
+		"""
+		Stops the writer thread, once all the buffered data are written.
+		"""
+		self._stopEvent.set()
+		self._condition.acquire()
+		self._condition.notify()
+		self._condition.release()
+		if self.isAlive():
+			self.join()
+		else:
+			self.flush(close = True)
+
+	def _writeFile(self, filename, data):
+		"""
+		Called with _ioMutex held.
+		"""
+		try:
+			f = self._files.get(filename)
+			if f is None:
+				if len(self._files) >= self._maxOpenFiles:
+					self._closeFile(self._lruFilenames[0])
+				f = open(filename, 'a')
+				self._files[filename] = f
+			else:
+				self._lruFilenames.remove(filename)
+			self._lruFilenames.append(filename)
+			f.write(data)
+			f.flush()
+		except Exception, e:
+			self._closeFile(filename)
+			if self._errorCallback:
+				self._errorCallback(filename, e)
+
+	def _closeFile(self, filename):
+		"""
+		Called with _ioMutex held.
+		"""
+		f = self._files.pop(filename, None)
+		if filename in self._lruFilenames:
+			self._lruFilenames.remove(filename)
+		if f is not None:
+			try:
+				f.close()
+			except Exception:
+				pass
+
+
+################################################################################
+# Standalone test
+################################################################################
+
+def test(filenameCount = 50, lineCount = 2000):
+	import os
+	import tempfile
+
+	d = tempfile.mkdtemp()
+	filenames = [ os.path.join(d, '%d.log' % i) for i in range(filenameCount) ]
+	line = '<user class="user" timestamp="%s">%s</user>\n' % (time.time(), 'x' * 100)
+
+	start = time.time()
+	for i in range(lineCount):
+		for filename in filenames:
+			f = open(filename, 'a')
+			f.write(line)
+			f.close()
+	print "open/append/close per line: %.3fs" % (time.time() - start)
+	for filename in filenames:
+		os.unlink(filename)
+
+	writer = LogWriter()
+	writer.start()
+	start = time.time()
+	for i in range(lineCount):
+		for filename in filenames:
+			writer.write(filename, line)
+	writer.flush()
+	print "LogWriter: %.3fs" % (time.time() - start)
+	writer.stop()
+
+	for filename in filenames:
+		assert os.path.getsize(filename) == lineCount * len(line)
+		os.unlink(filename)
+	os.rmdir(d)
+
+if __name__ == '__main__':
+	test()
@@ -187,7 +187,7 @@ def createTestExecutable(name, ats, atsDirInTePackage):
 	
 	return te
 	
-def createCommandLine(jobId, teFilename, logFilename, inputSessionFilename, outputSessionFilename, selectedGroups = None):
+def createCommandLine(jobId, teFilename, logFilename, inputSessionFilename, outputSessionFilename, selectedGroups = None, logFormat = None):
 	"""
 	@rtype: a dict { 'executable': string, 'env': dict[string] of strings, 'args': list of strings }
 	@returns: the info needed to an execve or the like to execute the TE.
@@ -209,6 +209,8 @@ def createCommandLine(jobId, teFilename, logFilename, inputSessionFilename, outp
 
 	if selectedGroups is not None:
 		cmdOptions += [ '--groups', ','.join(selectedGroups) ]
+	if logFormat is not None:
+		cmdOptions += [ '--log-format', logFormat ]
 
 	# Interpreter
 	pythonInterpreter = cm.get("testerman.te.python.interpreter")
@@ -21,7 +21,10 @@
 import TestermanMessages as Messages
 import TestermanNodes as Nodes
 
+import Queue
+import sys
 import threading
+import time
 
 class TaccException(Exception): pass
 
@@ -127,17 +130,42 @@ class IaClient(Nodes.ConnectingNode):
 	# (binary payload encoding problems)
 	# OK will the agents are implemented in Python, which is the case for now.
 	def triSend(self, probeUri, message, sutAddress, profile = Messages.Message.CONTENT_TYPE_PYTHON_PICKLE):
+		response = self.triSendAsync(probeUri, message, sutAddress, profile).getResponse()
+		error = self.getTriSendError(probeUri, response)
+		if error:
+			raise error
+		return True
+
+	def triSendAsync(self, probeUri, message, sutAddress, profile = Messages.Message.CONTENT_TYPE_PYTHON_PICKLE):
+		"""
+		Sends a message through a probe without waiting for its acknowledgement.
+		
+		Several sends may be pending at the same time:
+		they are delivered to the probe in the order they were sent.
+		
+		@rtype: Nodes.ResponseFuture
+		@returns: the future TRI-SEND response, to check with getTriSendError()
+		"""
 		request = Messages.Request("TRI-SEND", probeUri, "Ia", "1.0")
 		request.setHeader("SUT-Address", sutAddress)
 		request.setApplicationBody(message, profile)
-		response = self.executeRequest(0, request)
+		return self.executeRequestAsync(0, request)
+
+	def getTriSendError(self, probeUri, response):
+		"""
+		@type  response: Messages.Response, or None
+		@param response: a TRI-SEND response, or None in case of a timeout
+		
+		@rtype: TaccException, or None
+		@returns: the error to report for this response, if any
+		"""
 		if response:
 			if response.getStatusCode() == 200:
-				return True
+				return None
 			else:
-				raise TaccException("Error while sending a message through %s:\n%d %s\nDetailled error:\n%s" % (probeUri, response.getStatusCode(), response.getReasonPhrase(), response.getBody()))
+				return TaccException("Error while sending a message through %s:\n%d %s\nDetailled error:\n%s" % (probeUri, response.getStatusCode(), response.getReasonPhrase(), response.getBody()))
 		else:
-			raise TaccException("Timeout while sending a message through %s. Please check that the probe (or the hosting agent) still works and the TACS is still online." % (probeUri))
+			return TaccException("Timeout while sending a message through %s. Please check that the probe (or the hosting agent) still works and the TACS is still online." % (probeUri))
 	
 	def triSAReset(self, probeUri):
 		request = Messages.Request("TRI-SA-RESET", probeUri, "Ia", "1.0")
@@ -147,8 +175,14 @@ class IaClient(Nodes.ConnectingNode):
 		else:
 			return False
 
-	def triMap(self, probeUri):
+	def triMap(self, probeUri, accept = None):
+		"""
+		@type  accept: string, or None
+		@param accept: the application body profiles accepted by the TE
+		for the probe notifications (see Messages.getAcceptedProfiles())
+		"""
 		request = Messages.Request("TRI-MAP", probeUri, "Ia", "1.0")
+		request.setHeader("Accept", accept)
 		response = self.executeRequest(0, request)
 		if response and response.getStatusCode() == 200:
 			return True
@@ -321,6 +355,7 @@ class IaClient(Nodes.ConnectingNode):
 		 contact: string
 		 lock: bool
 		 type: string
+		 accept: string, or None (the profiles accepted by the hosting agent)
 		"""
 		request = Messages.Request("GET-PROBE", "system:tacs", "Ia", "1.0")
 		request.setHeader('Probe-Uri', probeUri)
@@ -399,11 +434,106 @@ def finalize():
 
 
 
-# Some basic tests
+################################################################################
+# Loopback benchmark
+################################################################################
+
+class _BenchmarkAgent(Nodes.ConnectingNode):
+	"""
+	A pyagent stand-in hosting a single probe.
+	
+	TRI-SENDs are acknowledged after a fixed delay, simulating the LAN and
+	probe latency, without blocking the next requests (as if they were
+	in flight on the network).
+	"""
+	def __init__(self, name, ackDelay):
+		Nodes.ConnectingNode.__init__(self, name, "BenchmarkAgent/1.0")
+		self._ackDelay = ackDelay
+		self._acks = Queue.Queue(0)
+		self.registered = threading.Event()
+		self.received = []
+		self._ackThread = threading.Thread(target = self._sendAcks)
+		self._ackThread.setDaemon(True)
+		self._ackThread.start()
+	
+	def getUri(self):
+		return "agent:%s" % self.getNodeName()
+
+	def onConnection(self, channel):
+		request = Messages.Request("REGISTER", self.getUri(), "Xa", "1.0")
+		request.setHeader("Agent-Supported-Probe-Types", "loopback")
+		request.setHeader("Accept", Messages.getAcceptedProfiles())
+		self.executeRequest(channel, request)
+		request = Messages.Request("REGISTER", "probe:loopback@%s" % self.getNodeName(), "Xa", "1.0")
+		request.setHeader("Probe-Name", "loopback")
+		request.setHeader("Probe-Type", "loopback")
+		request.setHeader("Agent-Uri", self.getUri())
+		self.executeRequest(channel, request)
+		self.registered.set()
+
+	def onRequest(self, channel, transactionId, request):
+		if request.getMethod() == "TRI-SEND":
+			self.received.append(request.getApplicationBody())
+			self._acks.put((time.time() + self._ackDelay, channel, transactionId))
+		else:
+			self.sendResponse(channel, transactionId, Messages.Response(200, "OK"))
+	
+	def _sendAcks(self):
+		while True:
+			(due, channel, transactionId) = self._acks.get()
+			delay = due - time.time()
+			if delay > 0:
+				time.sleep(delay)
+			self.sendResponse(channel, transactionId, Messages.Response(200, "OK"))
+
+def benchmark(count = 1000, windows = [ 0, 1, 8, 64 ], ackDelay = 0.002, iaPort = 48087, xaPort = 48000):
+	"""
+	Sends count messages through a remote probe adapter with different send windows,
+	via an in-process TACS, to a pyagent stand-in whose probe acknowledges
+	each message after ackDelay (a LAN round trip).
+	
+	A window of 0 is the default synchronous send mode.
+	"""
+	import TestermanAgentControllerServer as TACS
+	import TestermanSA
+
+	controller = TACS.Controller(("127.0.0.1", xaPort), ("127.0.0.1", iaPort), "/tmp")
+	controller.start()
+	agent = _BenchmarkAgent("benchmark", ackDelay)
+	agent.initialize(("127.0.0.1", xaPort))
+	agent.start()
+	initialize("benchmark", ("127.0.0.1", iaPort))
+	try:
+		agent.registered.wait(5.0)
+		time.sleep(0.5) # the Ia connection
+		uri = "probe:loopback@benchmark"
+		for window in windows:
+			probe = TestermanSA.RemoteProbeAdapter()
+			probe.attachToUri(uri, None)
+			probe.setProperty(probe.SEND_WINDOW_PROPERTY, window)
+			probe.onTriMap()
+			del agent.received[:]
+			start = time.time()
+			for i in range(count):
+				probe.onTriSend({ 'seq': i }, None)
+			probe.onTriUnmap()
+			duration = time.time() - start
+			ordered = ([ m['seq'] for m in agent.received ] == range(count))
+			print "send window %3d: %d sends in %.3fs (%.0f sends/s), in order: %s" % (window, count, duration, count / duration, ordered)
+	finally:
+		finalize()
+		agent.stop()
+		controller.stop()
 
 if __name__ == "__main__":
-	initialize("test", ("127.0.0.1", 8087))
-	print "Getting registered probes..."
-	print str(instance().getRegisteredProbes())
-	finalize()
+	if sys.argv[1:] == [ "benchmark" ]:
+		# Use the module instance shared with TestermanSA, not __main__
+		import TestermanAgentControllerClient
+		TestermanAgentControllerClient.benchmark()
+	else:
+		# Some basic tests
+		initialize("test", ("127.0.0.1", 8087))
+		print "Getting registered probes..."
+		print str(instance().getRegisteredProbes())
+		finalize()
 	
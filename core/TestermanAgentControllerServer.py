@@ -114,10 +114,10 @@ class XaServer(Nodes.ListeningNode):
 	 R TRI-MAP
 	
 	"""
-	def __init__(self, controller, xaAddress):
+	def __init__(self, controller, xaAddress, maxQueueSize = 0, queueFullPolicy = Nodes.QUEUE_FULL_DISCONNECT):
 		Nodes.ListeningNode.__init__(self, "TACS/Xa", "XaServer/%s" % Versions.getAgentControllerVersion())
 		self._controller = controller
-		self.initialize(xaAddress)
+		self.initialize(xaAddress, maxQueueSize, queueFullPolicy)
 	
 	def getLogger(self):
 		return logging.getLogger('TACS.XaServer')
@@ -130,7 +130,7 @@ class XaServer(Nodes.ListeningNode):
 			if method == "REGISTER":
 				if request.getUri().getScheme() == "agent":
 					# This is an Agent-level registration - throws TacsException
-					self._controller.registerAgent(channel, request.getUri(), request.getHeader("Contact"), request.getHeader("Agent-Supported-Probe-Types").split(','), request.getHeader('User-Agent'))
+					self._controller.registerAgent(channel, request.getUri(), request.getHeader("Contact"), request.getHeader("Agent-Supported-Probe-Types").split(','), request.getHeader('User-Agent'), request.getHeader('Accept'))
 					self.sendResponse(channel, transactionId, Messages.Response(200, "OK"))
 				elif request.getUri().getScheme() == "probe":
 					# This is a probe-level registration - throws TacsException
@@ -193,15 +193,26 @@ class XaServer(Nodes.ListeningNode):
 
 	# TACS -> Probes
 
-	def triSend(self, channel, request):
+	def triSend(self, channel, request, callback):
 		"""
+		Forwards the request without waiting for the probe response,
+		so that the TRI-SENDs pipelined by a TE are not serialized here.
+		They are still sent to the probe in order.
+		
 		@type request: TestermanMessages.Request
+		@type callback: callable(XaException or None)
+		@param callback: called once the probe responded (or timed out), with the error, if any.
+		Called from a network thread: must not block.
 		"""
-		resp = self.executeRequest(channel, request)
+		future = self.executeRequestAsync(channel, request)
+		future.addCallback(lambda resp: callback(self._getTriSendError(request, resp)))
+
+	def _getTriSendError(self, request, resp):
 		if not resp:
-			raise XaException("Timeout while waiting for TRI-SEND response from probe %s" % request.getUri())
+			return XaException("Timeout while waiting for TRI-SEND response from probe %s" % request.getUri())
 		if resp.getStatusCode() != 200:
-			raise XaException("TRI-SEND from probe %s returned:\n%d %s\n%s" % (request.getUri(), resp.getStatusCode(), resp.getReasonPhrase(), resp.getBody()))
+			return XaException("TRI-SEND from probe %s returned:\n%d %s\n%s" % (request.getUri(), resp.getStatusCode(), resp.getReasonPhrase(), resp.getBody()))
+		return None
 
 	def triExecuteTestCase(self, channel, request):
 		"""
@@ -213,11 +224,13 @@ class XaServer(Nodes.ListeningNode):
 		if resp.getStatusCode() != 200:
 			raise XaException("TRI-EXECUTE-TESTCASE from probe %s returned %d %s" % (request.getUri(), resp.getStatusCode(), resp.getReasonPhrase()))
 
-	def triMap(self, channel, uri):
+	def triMap(self, channel, uri, accept = None):
 		"""
 		Constructs a reset request, execute it.
+		The profiles accepted by the mapping client, if any, are forwarded to the probe.
 		"""
 		req = Messages.Request(method = "TRI-MAP", uri = uri, protocol = "XA", version = Versions.getXaVersion())
+		req.setHeader("Accept", accept)
 		resp = self.executeRequest(channel, req)
 		if not resp:
 			raise XaException("Timeout while waiting for TRI-MAP response from probe %s" % req.getUri())
@@ -314,6 +327,7 @@ class IaServer(Nodes.ListeningNode):
 	 R GET-AGENTS
 	 R GET-PROBE
 	 R GET-VARIABLES
+	 R GET-CHANNELS
 
 	TE -> Probe via TACS:
 	 R TRI-SEND
@@ -335,10 +349,10 @@ class IaServer(Nodes.ListeningNode):
 	 N TRI-ENQUEUE-MSG
 	 
 	"""
-	def __init__(self, controller, iaAddress):
+	def __init__(self, controller, iaAddress, maxQueueSize = 0, queueFullPolicy = Nodes.QUEUE_FULL_DISCONNECT):
 		Nodes.ListeningNode.__init__(self, "TACS/Ia", "IaServer/%s" % Versions.getAgentControllerVersion())
 		self._controller = controller
-		self.initialize(iaAddress)
+		self.initialize(iaAddress, maxQueueSize, queueFullPolicy)
 	
 	def getLogger(self):
 		return logging.getLogger('TACS.IaServer')
@@ -355,13 +369,13 @@ class IaServer(Nodes.ListeningNode):
 				self.sendResponse(channel, transactionId, Messages.Response(200, "OK"))
 			elif method == "TRI-SEND":
 				# Probe send - we forward the body as is, with the original encoding and type.
-				self._controller.triSend(request.getUri(), request)
-				self.sendResponse(channel, transactionId, Messages.Response(200, "OK"))
+				# Responded to once the probe acknowledged it, without blocking the next requests.
+				self._controller.triSend(request.getUri(), request, lambda e: self._onTriSendCompleted(channel, transactionId, e))
 			elif method == "TRI-SA-RESET":
 				self._controller.triSaReset(request.getUri())
 				self.sendResponse(channel, transactionId, Messages.Response(200, "OK"))
 			elif method == "TRI-MAP":
-				self._controller.triMap(request.getUri())
+				self._controller.triMap(request.getUri(), request.getHeader('Accept'))
 				self.sendResponse(channel, transactionId, Messages.Response(200, "OK"))
 			elif method == "TRI-UNMAP":
 				self._controller.triUnmap(request.getUri())
@@ -391,6 +405,10 @@ class IaServer(Nodes.ListeningNode):
 				resp = Messages.Response(200, "OK")
 				resp.setApplicationBody(variables)
 				self.sendResponse(channel, transactionId, resp)
+			elif method == "GET-CHANNELS":
+				resp = Messages.Response(200, "OK")
+				resp.setApplicationBody(self._controller.getChannelStats())
+				self.sendResponse(channel, transactionId, resp)
 			elif method == "GET-PROBE":
 				probeUri = request.getHeader('Probe-Uri')
 				info = self._controller.getProbeInfo(probeUri)
@@ -449,6 +467,20 @@ class IaServer(Nodes.ListeningNode):
 			resp.setBody(str(e) + "\n" + Nodes.getBacktrace())
 			self.sendResponse(channel, transactionId, resp)
 	
+	def _onTriSendCompleted(self, channel, transactionId, e):
+		"""
+		Responds to a forwarded TRI-SEND.
+		
+		@type e: XaException, or None
+		@param e: the forwarding error, if any
+		"""
+		if e is None:
+			self.sendResponse(channel, transactionId, Messages.Response(200, "OK"))
+		else:
+			resp = Messages.Response(e.code, e.reason)
+			resp.setBody(str(e))
+			self.sendResponse(channel, transactionId, resp)
+	
 	def onNotification(self, channel, notification):
 		self.getLogger().debug("New notification received:\n%s" % str(notification))
 		try:
@@ -499,17 +531,29 @@ class Controller(object):
 	corresponding (probe) URIs.
 	[step 1]: notifications are forwarded to ALL Ia clients.
 	
+	Routing lookups (probes, subscriptions) are lock-free: the mutex only
+	serializes the updates, and the subscribing channels are immutable
+	tuples replaced on update.
+	Messages are sent to each channel through its own bounded outbound queue,
+	written by the thread handling the channel, so that a slow peer does not
+	delay the others (see Nodes.QUEUE_FULL_POLICIES for full queues).
+	By default, a peer whose queue is full is disconnected: agents and
+	servers reconnect and register again. The 'block' policy must be
+	explicitly selected, as a stalled peer then stalls the routing to
+	all the other peers.
 	"""
 	
-	def __init__(self, xaAddress, iaAddress, documentRoot):
+	def __init__(self, xaAddress, iaAddress, documentRoot, maxQueueSize = 0, queueFullPolicy = Nodes.QUEUE_FULL_DISCONNECT):
+		if not queueFullPolicy in Nodes.QUEUE_FULL_POLICIES:
+			raise TacsException("Invalid queue full policy (%s), should be one of %s" % (queueFullPolicy, ', '.join(Nodes.QUEUE_FULL_POLICIES)))
 		self._mutex = threading.RLock()
-		self._xaServer = XaServer(self, xaAddress)
-		self._iaServer = IaServer(self, iaAddress)
+		self._xaServer = XaServer(self, xaAddress, maxQueueSize, queueFullPolicy)
+		self._iaServer = IaServer(self, iaAddress, maxQueueSize, queueFullPolicy)
 		self._agents = {}
 		self._probes = {}
 		self._documentRoot = documentRoot
 
-		# The subscription mapping is a list of Ia channels per uri (probe:<id>, system:probes, ...).
+		# The subscription mapping is a tuple of Ia channels per uri (probe:<id>, system:probes, ...).
 		self._subscriptions = {}
 		self._iaClients = []
 	
@@ -544,13 +588,16 @@ class Controller(object):
 	##
 	# Agent registration
 	##
-	def registerAgent(self, channel, uri, contact, supportedProbes, userAgent):
+	def registerAgent(self, channel, uri, contact, supportedProbes, userAgent, accept = None):
 		"""
 		@type supportedProbes: list of strings
+		@type accept: string, or None
+		@param accept: the application body profiles accepted by the agent (comma-separated),
+		None for older agents
 		"""
 		uri = str(uri)
 		self._lock()
-		self._agents[uri] = { 'channel': channel, 'uri': uri, 'contact': contact, 'supported-probes': supportedProbes, 'user-agent': userAgent }
+		self._agents[uri] = { 'channel': channel, 'uri': uri, 'contact': contact, 'supported-probes': supportedProbes, 'user-agent': userAgent, 'accept': accept }
 		self._unlock()
 		# Now sends an event over Ia to notify the new agent
 		notification = Messages.Notification("PROBE-EVENT", "system:probes", "Ia", "1.0")
@@ -633,11 +680,9 @@ class Controller(object):
 	def subscribe(self, channel, uri):
 		uri = str(uri) # make sure we deal with URI strings, not URI objects
 		self._lock()
-		if not self._subscriptions.has_key(uri):
-			self._subscriptions[uri] = [ channel ]
-		else:
-			if channel not in self._subscriptions[uri]:
-				self._subscriptions[uri].append(channel)
+		channels = self._subscriptions.get(uri, ())
+		if channel not in channels:
+			self._subscriptions[uri] = channels + (channel, )
 		self._unlock()
 		self.getLogger().info("channel %s subscribed to uri %s" % (str(channel), uri))
 	
@@ -649,14 +694,14 @@ class Controller(object):
 			self.getLogger().info("Unsubscription attempt for a non-known uri. Discarding.")
 			return
 
-		if channel in self._subscriptions[uri]:
-			self._subscriptions[uri].remove(channel)
+		channels = tuple([ x for x in self._subscriptions[uri] if x != channel ])
+		self._subscriptions[uri] = channels
 
 		self.getLogger().info("channel %s unsubscribed from uri %s" % (str(channel), uri))
 		
 		# Garbage collecting:
 		# The uri may be watched by anybody else
-		if len(self._subscriptions[uri]) == 0:
+		if len(channels) == 0:
 			self.getLogger().info("Subscription without any other channel, garbage collecting it...")
 			del self._subscriptions[uri]
 
@@ -678,7 +723,8 @@ class Controller(object):
 		self._lock()
 		for (uri, clients) in self._subscriptions.items():
 			if channel in clients:
-				clients.remove(channel)
+				clients = tuple([ x for x in clients if x != channel ])
+				self._subscriptions[uri] = clients
 			# Garbage collection
 			if len(clients) == 0:
 				del self._subscriptions[uri]
@@ -713,17 +759,13 @@ class Controller(object):
 		uri = str(notification.getUri()) # make sure we deal with URI strings, not URI objects
 		self.getLogger().debug("Dispatching notification on Ia for %s..." % uri)
 		nbClients = 0
-		self._lock()
-		if not self._subscriptions.has_key(uri):
-			self._unlock()
-			return
-		for channel in self._subscriptions[uri]:
+		# Lock-free: the subscribing channels are an immutable tuple
+		for channel in self._subscriptions.get(uri, ()):
 			try:
 				self._iaServer.sendNotification(channel, notification)
 				nbClients += 1
 			except:
 				self.getLogger().warning("Unable to send a notification to a client")
-		self._unlock()
 		self.getLogger().debug("Notification dispatched to %d Ia clients" % nbClients)
 	
 	##
@@ -731,11 +773,7 @@ class Controller(object):
 	##
 	def triSAReset(self, uri):
 		uri = str(uri)
-		probe = None
-		self._lock()
-		if self._probes.has_key(uri):
-			probe = self._probes[uri]
-		self._unlock()
+		probe = self._probes.get(uri)
 		if probe:
 			self._xaServer.triSAReset(probe['channel'], probe['uri'])
 		else:
@@ -743,25 +781,17 @@ class Controller(object):
 
 	def triUnmap(self, uri):
 		uri = str(uri)
-		probe = None
-		self._lock()
-		if self._probes.has_key(uri):
-			probe = self._probes[uri]
-		self._unlock()
+		probe = self._probes.get(uri)
 		if probe:
 			self._xaServer.triUnmap(probe['channel'], probe['uri'])
 		else:
 			raise TacsException("Probe %s not available on controller" % uri)
 
-	def triMap(self, uri):
+	def triMap(self, uri, accept = None):
 		uri = str(uri)
-		probe = None
-		self._lock()
-		if self._probes.has_key(uri):
-			probe = self._probes[uri]
-		self._unlock()
+		probe = self._probes.get(uri)
 		if probe:
-			self._xaServer.triMap(probe['channel'], probe['uri'])
+			self._xaServer.triMap(probe['channel'], probe['uri'], accept)
 		else:
 			raise TacsException("Probe %s not available on controller" % uri)
 
@@ -780,9 +810,30 @@ class Controller(object):
 		if self._probes.has_key(uri):
 			probe = self._probes[uri]
 			info = { 'agent-uri': probe['agent-uri'], 'uri': probe['uri'], 'type': probe['type'], 'name': probe['name'], 'contact': probe['contact'], 'locked': (probe['locks'] != {}) }
+			agent = self._agents.get(probe['agent-uri'])
+			if agent:
+				info['accept'] = agent['accept']
 		self._unlock()
 		return info
 
+	def getChannelStats(self):
+		"""
+		Returns the outbound queue statistics for each Xa and Ia channel.
+		
+		@rtype: list of dict(interface, channel, uri, queue-depth, dropped)
+		"""
+		agentUris = {}
+		self._lock()
+		for agent in self._agents.values():
+			agentUris[agent['channel']] = agent['uri']
+		self._unlock()
+		ret = []
+		for stats in self._xaServer.getChannelStats():
+			ret.append({ 'interface': 'Xa', 'channel': str(stats['channel']), 'uri': agentUris.get(stats['channel']), 'queue-depth': stats['queue-depth'], 'dropped': stats['dropped'] })
+		for stats in self._iaServer.getChannelStats():
+			ret.append({ 'interface': 'Ia', 'channel': str(stats['channel']), 'uri': None, 'queue-depth': stats['queue-depth'], 'dropped': stats['dropped'] })
+		return ret
+
 	def getRegisteredAgents(self):
 		ret = []
 		self._lock()
@@ -852,16 +903,13 @@ class Controller(object):
 		self._unlock()
 		raise TacsException("", 404, "Probe Not Found")
 
-	def triSend(self, uri, request):
+	def triSend(self, uri, request, callback):
 		"""
 		Forwards a TRI-SEND operation, expect a response.
+		callback(XaException or None) is called once the probe responded.
 		"""
 		uri = str(uri)
-		probe = None
-		self._lock()
-		if self._probes.has_key(uri):
-			probe = self._probes[uri]
-		self._unlock()
+		probe = self._probes.get(uri)
 		
 		if probe:
 			# FIXME: what do we rewrite the message ??
@@ -870,7 +918,7 @@ class Controller(object):
 			req.setContentType(request.getContentType())
 			req.setContentEncoding(request.getContentEncoding())
 			req.setBody(request.getBody())
-			self._xaServer.triSend(probe['channel'], req)
+			self._xaServer.triSend(probe['channel'], req, callback)
 		else:
 			raise TacsException("Probe %s not available on controller" % uri)
 
@@ -879,11 +927,7 @@ class Controller(object):
 		Forwards a TRI-SEND operation, expect a response.
 		"""
 		uri = str(uri)
-		probe = None
-		self._lock()
-		if self._probes.has_key(uri):
-			probe = self._probes[uri]
-		self._unlock()
+		probe = self._probes.get(uri)
 		
 		if probe:
 			# FIXME: what do we rewrite the message ??
@@ -1032,6 +1076,9 @@ def main():
 	cm.register("tacs.debug", False)
 	cm.register("tacs.log_filename", "", xform = expandPath)
 	cm.register("tacs.pid_filename", "", xform = expandPath)
+	cm.register("tacs.channel_queue_size", 10000)
+	# 'block' is an opt-in: a stalled agent or server would stall the routing
+	cm.register("tacs.channel_queue_policy", Nodes.QUEUE_FULL_DISCONNECT)
 	cm.register("testerman.document_root", "/tmp", xform = expandPath, dynamic = True)
 	cm.register("testerman.var_root", "", xform = expandPath)
 
@@ -1130,7 +1177,7 @@ def main():
 	cm.set_transient("tacs.pid", os.getpid())
 	controller = None
 	try:
-		controller = Controller(xaAddress = (cm.get("interface.xa.ip"), cm.get("interface.xa.port")), iaAddress = (cm.get("interface.ia.ip"), cm.get("interface.ia.port")), documentRoot = cm.get("testerman.document_root"))
+		controller = Controller(xaAddress = (cm.get("interface.xa.ip"), cm.get("interface.xa.port")), iaAddress = (cm.get("interface.ia.ip"), cm.get("interface.ia.port")), documentRoot = cm.get("testerman.document_root"), maxQueueSize = cm.get("tacs.channel_queue_size"), queueFullPolicy = cm.get("tacs.channel_queue_policy"))
 		controller.start()
 		controller.getLogger().info("Started.")
 		while 1:
@@ -23,7 +23,7 @@ import TestermanTCI
 from CodecManager import CodecNotFoundException
 
 
-CodecManager.instance().setLogCallback(lambda x: TestermanTCI.logInternal("CD: %s" % x))
+CodecManager.instance().setLogCallback(lambda x: TestermanTCI.logInternal("CD: %s", x), lambda: TestermanTCI.isLogLevelEnabled('internal'))
 
 def instance():
 	return CodecManager.instance()
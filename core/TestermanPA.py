@@ -14,9 +14,10 @@
 
 ##
 # -*- coding: utf-8 -*-
-# First implementation:
-# Using Threading.Timer.
-# Not scalable (max ~ 30 timers).
+# Timers are managed by a single scheduler thread,
+# based on a heap of timer expiry times.
+# Stopped timers are not removed from the heap, but ignored
+# when popped (and purged when they become too numerous).
 #
 # Testerman TRI implementation - Platform Interface part.
 #
@@ -26,7 +27,9 @@
 import TestermanTCI
 import TestermanTTCN3 as Testerman
 
+import heapq
 import threading
+import select
 import signal
 import os
 import re
@@ -37,14 +40,22 @@ import time
 TRI_OK = 1
 TRI_Error = 0
 
-def log(message):
-	TestermanTCI.logInternal("PA: %s" % str(message))
+def log(message, *args):
+	"""
+	Internal PA logging.
+	The message is only formatted (message % args) if the internal log level is enabled.
+	"""
+	if args:
+		TestermanTCI.logInternal("PA: " + message, *args)
+	else:
+		TestermanTCI.logInternal("PA: %s", message)
 
 
 
 PaMutex = None
 
-CurrentTimers = {} # { 'timer': threading.Timer, 'start': timestamp } indexed by the TE timerId
+CurrentTimers = {} # { 'start': timestamp, 'expiry': timestamp, 'seq': int } indexed by the TE timerId
+TheTimerScheduler = None
 
 def _lock():
 	PaMutex.acquire()
@@ -52,15 +63,120 @@ def _lock():
 def _unlock():
 	PaMutex.release()
 
-def _onTimeout(timerId):
-	_lock()
-	if not CurrentTimers.has_key(timerId):
+
+class TimerScheduler(threading.Thread):
+	"""
+	A single thread calling Testerman.triTimeout() for expired timers.
+	
+	Started timers are pushed to a heap of (expiry, seq, timerId).
+	A stopped (or restarted) timer entry is left in the heap, and discarded
+	when popped if it does not match the CurrentTimers entry (seq) anymore.
+	
+	The thread waits on a pipe, with the next expiry as a timeout,
+	so that it can be woken up immediately when a timer expiring earlier
+	is started.
+	
+	The heap and CurrentTimers are protected by the PA mutex.
+	"""
+	# Purge the cancelled heap entries when they exceed this count
+	# and half of the heap size
+	MIN_PURGE_COUNT = 64
+	
+	def __init__(self):
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+		self._heap = []
+		self._seq = 0
+		self._cancelledCount = 0
+		self._stopped = False
+		self._wakeupPending = False
+		self._pipe = os.pipe()
+	
+	def schedule(self, timerId, start, duration):
+		"""
+		Called with the PA mutex held.
+		"""
+		self._seq += 1
+		expiry = start + duration
+		if CurrentTimers.has_key(timerId):
+			# Restarted without being stopped: the previous entry is now obsolete
+			self._cancelledCount += 1
+		CurrentTimers[timerId] = { 'start': start, 'expiry': expiry, 'seq': self._seq }
+		heapq.heappush(self._heap, (expiry, self._seq, timerId))
+		if self._heap[0][1] == self._seq:
+			# We are the next timer to expire: the scheduler must re-evaluate its timeout
+			self._wakeup()
+	
+	def cancel(self, timerId):
+		"""
+		Called with the PA mutex held.
+		"""
+		del CurrentTimers[timerId]
+		self._cancelledCount += 1
+		if self._cancelledCount > self.MIN_PURGE_COUNT and self._cancelledCount * 2 > len(self._heap):
+			self._heap = filter(lambda (expiry, seq, timerId): CurrentTimers.has_key(timerId) and CurrentTimers[timerId]['seq'] == seq, self._heap)
+			heapq.heapify(self._heap)
+			self._cancelledCount = 0
+	
+	def _wakeup(self):
+		"""
+		Called with the PA mutex held.
+		"""
+		if not self._wakeupPending:
+			self._wakeupPending = True
+			os.write(self._pipe[1], 'w')
+	
+	def stop(self):
+		_lock()
+		self._stopped = True
+		self._wakeup()
 		_unlock()
-		log("Timeout received on unexisting timerId. Ignoring")
-		return
-	del CurrentTimers[timerId]
-	_unlock()
-	Testerman.triTimeout(timerId)
+		self.join()
+		os.close(self._pipe[0])
+		os.close(self._pipe[1])
+	
+	def run(self):
+		while True:
+			expired = []
+			_lock()
+			if self._stopped:
+				_unlock()
+				break
+			now = time.time()
+			while self._heap and self._heap[0][0] <= now:
+				(expiry, seq, timerId) = heapq.heappop(self._heap)
+				timer = CurrentTimers.get(timerId)
+				if timer and timer['seq'] == seq:
+					del CurrentTimers[timerId]
+					expired.append(timerId)
+				else:
+					self._cancelledCount -= 1
+			if self._heap:
+				timeout = self._heap[0][0] - now
+			else:
+				timeout = None
+			_unlock()
+			
+			for timerId in expired:
+				try:
+					Testerman.triTimeout(timerId)
+				except Exception, e:
+					log("Exception while notifying timeout for timer %s: %s", timerId, TestermanTCI.getBacktrace())
+
+			if expired:
+				# Timeout callbacks may have taken some time: re-evaluate the heap first
+				continue
+
+			try:
+				r, w, e = select.select([ self._pipe[0] ], [], [], timeout)
+			except select.error:
+				# Interrupted system call
+				continue
+			if r:
+				_lock()
+				os.read(self._pipe[0], 1)
+				self._wakeupPending = False
+				_unlock()
 
 ################################################################################
 # tri interface: PA-provided (TE -> PA)
@@ -76,15 +192,11 @@ def triStartTimer(timerId, duration):
 	"""
 	Returns 1 (TRI_OK) or 0 (TRI_Error)
 	"""
-	log("triStartTimer(%s, duration %f)" % (str(timerId), duration))
+	log("triStartTimer(%s, duration %f)", timerId, duration)
 	
-	# We should check that timerId is not already used
 	_lock()
-	
-	t = threading.Timer(duration, lambda: _onTimeout(timerId))
-	CurrentTimers[timerId] = { 'timer': t, 'start': time.time() }
+	TheTimerScheduler.schedule(timerId, time.time(), duration)
 	_unlock()
-	t.start()
 	
 	return TRI_OK
 	
@@ -96,11 +208,7 @@ def triStopTimer(timerId):
 	if not CurrentTimers.has_key(timerId):
 		_unlock()
 		return TRI_Error
-	try:
-		CurrentTimers[timerId]['timer'].cancel()
-	except:
-		pass
-	del CurrentTimers[timerId]
+	TheTimerScheduler.cancel(timerId)
 	_unlock()
 	return TRI_OK
 
@@ -210,16 +318,25 @@ def initialize():
 	Initialize the PA
 	"""
 	global PaMutex
+	global TheTimerScheduler
 
 	log("Initializating PA...")
 	PaMutex = threading.RLock()	
+	TheTimerScheduler = TimerScheduler()
+	TheTimerScheduler.start()
 	log("PA initialized")
 	
 def finalize():
 	"""
-	TODO
+	Stops the timer engine.
+	Pending timers are discarded.
 	"""
+	global TheTimerScheduler
+
 	log("finalizing timer engine...")
+	if TheTimerScheduler:
+		TheTimerScheduler.stop()
+		TheTimerScheduler = None
 	log("timer engine finalized.")
 	
 
@@ -56,15 +56,22 @@ TR_OK = 1
 # The usual shortcuts
 ################################################################################
 
-def log(msg):
-	TestermanTCI.logInternal("SA: %s" % msg)
+def log(msg, *args):
+	"""
+	Internal SA logging.
+	The message is only formatted (msg % args) if the internal log level is enabled.
+	"""
+	if args:
+		TestermanTCI.logInternal("SA: " + msg, *args)
+	else:
+		TestermanTCI.logInternal("SA: %s", msg)
 
 class TliLogger:
-	def warning(self, txt): TestermanTCI.logInternal("SA: %s" % txt)
-	def error(self, txt): TestermanTCI.logInternal("SA: %s" % txt)
-	def debug(self, txt): TestermanTCI.logInternal("SA: %s" % txt)
-	def critical(self, txt): TestermanTCI.logInternal("SA: %s" % txt)
-	def info(self, txt): TestermanTCI.logInternal("SA: %s" % txt)
+	def warning(self, txt, *args): log(txt, *args)
+	def error(self, txt, *args): log(txt, *args)
+	def debug(self, txt, *args): log(txt, *args)
+	def critical(self, txt, *args): log(txt, *args)
+	def info(self, txt, *args): log(txt, *args)
 
 
 ################################################################################
@@ -108,7 +115,7 @@ def triSAReset():
 		try:
 			probe.onTriSAReset()
 		except Exception, e:
-			log("triSAReset: error on probe %s during onTriSAReset(): %s" % (probe.getUri(), str(e)))
+			log("triSAReset: error on probe %s during onTriSAReset(): %s", probe.getUri(), e)
 		if probe.isRemote():
 			# Actually, we sould only do this on probes that were actually locked, i.e.
 			# not necessarely all of them if we stop our testcase because we were not able
@@ -143,7 +150,7 @@ def triExecuteTestCase(testCaseId, tsiPortList):
 			try:
 				probe.onTriExecuteTestCase()
 			except Exception, e:
-				log("triExecuteTestCase: error on probe %s onTriExecuteTestCase(): %s" % (probe.getUri(), str(e)))
+				log("triExecuteTestCase: error on probe %s onTriExecuteTestCase(): %s", probe.getUri(), e)
 		else:
 			# No implementation available
 			# TODO: provides a default impl ?
@@ -221,7 +228,7 @@ def triMap(compPortId, tsiPortId):
 	currentMappingCount += 1
 	TsiPortMappings[tsiPortId] = currentMappingCount
 	
-	log("triMap: %s mapping OK, existing binding" % tsiPortId)
+	log("triMap: %s mapping OK, existing binding", tsiPortId)
 	return TR_OK
 
 def triUnmap(compPortId, tsiPortId):
@@ -246,10 +253,10 @@ def triUnmap(compPortId, tsiPortId):
 			probe.onTriUnmap()
 		except:
 			pass
-		log("triMap: %s unmapping OK, no more other mapping" % tsiPortId)
+		log("triMap: %s unmapping OK, no more other mapping", tsiPortId)
 	else:
 		TsiPortMappings[tsiPortId] = currentMappingCount
-		log("triMap: %s unmapping OK, remaining mapping: %d" % (tsiPortId, currentMappingCount))
+		log("triMap: %s unmapping OK, remaining mapping: %d", tsiPortId, currentMappingCount)
 		
 	return TR_OK
 
@@ -308,7 +315,7 @@ def onLogNotification(probeUri, logClass, logInfo):
 			TestermanTCI.logSystemReceived(tsiPort = probeUri, label = label, payload = payload, sutAddress = sutAddress)
 
 	except Exception, e:
-		log("Exception in onLogNotification: %s" % str(e))
+		log("Exception in onLogNotification: %s", e)
 
 def onTriEnqueueMsgNotification(probeUri, message, sutAddress):
 	"""
@@ -321,7 +328,7 @@ def onTriEnqueueMsgNotification(probeUri, message, sutAddress):
 			probeAdapter.triEnqueueMsg(message, sutAddress)
 
 	except Exception, e:
-		log("Exception in onTriEnqueueMsgNotification: %s" % str(e))
+		log("Exception in onTriEnqueueMsgNotification: %s", e)
 
 ################################################################################
 # Test Adapters configuration management (bindings)
@@ -357,7 +364,7 @@ class TestAdapterConfiguration(object):
 	def _declareBinding(self, tsiPort, uri, type_, **kwargs):
 		if self._declaredBindings.has_key(tsiPort):
 			raise TestermanSAException("Test system interface port %s is already bound to a Test Adapter." % tsiPort)
-		log("Declaring binding: test adapter %s for tsiPort %s..." % (uri, tsiPort))
+		log("Declaring binding: test adapter %s for tsiPort %s...", uri, tsiPort)
 		transient = False
 		u = Messages.Uri(uri)
 		if u.getUser() and u.getUser() == '_': # Wildcard for automatic, transient probe naming
@@ -377,18 +384,18 @@ class TestAdapterConfiguration(object):
 		if we cannot autodeploy it.
 		"""
 		for tsiPort, binding in self._declaredBindings.items():
-			log("Installing binding: test adapter %s for tsiPort %s..." % (binding['uri'], tsiPort))
+			log("Installing binding: test adapter %s for tsiPort %s...", binding['uri'], tsiPort)
 			probe = createProbe(binding['uri'], binding['type'], binding['transient'])
 
 			for name, value in binding['properties'].items():
-				log(u"Setting property %s to %s for test adapter %s..." % (name, unicode(value), probe.getUri()))
+				log(u"Setting property %s to %s for test adapter %s...", name, unicode(value), probe.getUri())
 				probe.setProperty(name, value)
 			# Declare the binding in the current TTCN3 world
 			bind(tsiPort, probe)
 
 	def _uninstall(self):
 		for tsiPort, binding in self._declaredBindings.items():
-			log("Uninstalling binding: test adapter %s for tsiPort %s..." % (binding['uri'], tsiPort))
+			log("Uninstalling binding: test adapter %s for tsiPort %s...", binding['uri'], tsiPort)
 			unbind(tsiPort)				
 
 def bind(tsiPortId, probe):
@@ -580,10 +587,34 @@ class RemoteProbeAdapter(ProbeAdapter):
 	This is a default remote adapter as remote stubs may exist;
 	in this case the adapter to use is a RemoteStubAdapter, which is
 	technically equivalent to a LocalProbeAdapter in term of IProbe interface forwarding.
+	
+	By default, a send waits for the probe acknowledgement.
+	If the send_window property is set to N > 0 when binding the probe,
+	up to N sends may be pending at the same time (N = a large value means
+	fire-and-forget). They are still delivered in order.
+	A failed pending send is logged as soon as it is reported, and raised
+	as a port error on the next send through the same port.
+	Pending sends are flushed on unmapping.
 	"""
+	SEND_WINDOW_PROPERTY = 'send_window'
+	
 	def __init__(self):
 		ProbeAdapter.__init__(self)
 		self._remote = True
+		# The TRI-SEND body profile, according to what the hosting agent accepts
+		self._profile = Messages.Message.CONTENT_TYPE_PYTHON_PICKLE
+		# Windowed send mode
+		self._sendWindow = 0
+		self._sendCondition = threading.Condition(threading.Lock())
+		self._pendingSendCount = 0
+		self._sendError = None
+	
+	def setProperty(self, name, value):
+		# TE-side property, not forwarded to the probe
+		if name == self.SEND_WINDOW_PROPERTY:
+			self._sendWindow = int(value)
+		else:
+			ProbeAdapter.setProperty(self, name, value)
 	
 	def attachToUri(self, uri, type_):
 		"""
@@ -605,8 +636,12 @@ class RemoteProbeAdapter(ProbeAdapter):
 			# Autodeployment OK.
 			self._uri = uri
 			self._type = type_
+			info = TACC.instance().getProbeInfo(uri)
 		else:
 			raise TestermanSAException("Unable to use probe %s: not deployed, no type given, no autodeployment possible." % (uri))
+		# Older controllers or agents do not advertise the accepted profiles
+		if info:
+			self._profile = Messages.selectProfile(info.get('accept'))
 
 	def unbind(self):
 		if self._transient:
@@ -620,13 +655,58 @@ class RemoteProbeAdapter(ProbeAdapter):
 		TACC.instance().triSAReset(self.getUri())
 
 	def onTriMap(self):
-		TACC.instance().triMap(self.getUri())
+		self._sendError = None
+		# Let the probe know the profiles we accept for its notifications
+		TACC.instance().triMap(self.getUri(), Messages.getAcceptedProfiles())
 
 	def onTriUnmap(self):
+		self._flushSends()
 		TACC.instance().triUnmap(self.getUri())
 	
 	def onTriSend(self, message, sutAddress):
-		TACC.instance().triSend(self.getUri(), message, sutAddress)
+		if self._sendWindow <= 0:
+			TACC.instance().triSend(self.getUri(), message, sutAddress, self._profile)
+			return
+
+		self._sendCondition.acquire()
+		try:
+			while self._pendingSendCount >= self._sendWindow and not self._sendError:
+				self._sendCondition.wait()
+			error = self._sendError
+			if error:
+				self._sendError = None
+			else:
+				self._pendingSendCount += 1
+		finally:
+			self._sendCondition.release()
+		if error:
+			raise error
+		TACC.instance().triSendAsync(self.getUri(), message, sutAddress, self._profile).addCallback(self._onTriSendResponse)
+
+	def _onTriSendResponse(self, response):
+		"""
+		Called from the TACC network or timeout threads.
+		"""
+		error = TACC.instance().getTriSendError(self.getUri(), response)
+		if error:
+			TestermanTCI.logUser("Pending send through %s (port %s) failed:\n%s" % (self.getUri(), self._tsiPortId, error))
+		self._sendCondition.acquire()
+		self._pendingSendCount -= 1
+		if error and not self._sendError:
+			self._sendError = error
+		self._sendCondition.notifyAll()
+		self._sendCondition.release()
+
+	def _flushSends(self):
+		"""
+		Waits for the pending sends to be acknowledged.
+		Their errors, if any, have already been logged.
+		"""
+		self._sendCondition.acquire()
+		while self._pendingSendCount > 0:
+			self._sendCondition.wait()
+		self._sendError = None
+		self._sendCondition.release()
 
 
 ################################################################################
@@ -313,6 +313,13 @@ def main():
 	cm.register("ts.pid_filename", "")
 	cm.register("ts.name", socket.gethostname(), dynamic = True)
 	cm.register("ts.jobscheduler.interval", 1000, dynamic = True)
+	cm.register("ts.tl.flush_interval", 200) # max delay, in ms, before writing Il-received logs to files
+	cm.register("ts.tl.flush_size", 64*1024) # buffered log size, in bytes, that triggers an immediate write
+	cm.register("ts.tl.max_open_files", 64) # max number of log files kept opened
+	cm.register("ts.tl.replay_ring_size", 10000) # max number of recent log events kept in memory per running job, replayed to resuming Xc subscriptions
+	cm.register("ts.tl.max_replay_events", 100000, dynamic = True) # max number of log events replayed to a resuming Xc subscription (the older ones are reported as lost, 0: no limit)
+	cm.register("ts.xc.queue_size", 5000) # max number of notifications queued per Xc client (the oldest ones are dropped)
+	cm.register("ts.xc.slow_consumer_timeout", 30, dynamic = True) # max duration, in s, an Xc client may lag before being unsubscribed (0: never)
 	cm.register("testerman.document_root", "/tmp", xform = expandPath, dynamic = True)
 	cm.register("testerman.var_root", "", xform = expandPath)
 	cm.register("testerman.web.document_root", "%s/web" % testerman_home, xform = expandPath, dynamic = False)
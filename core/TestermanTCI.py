@@ -44,6 +44,8 @@ class LogLevelDocumentation:
 	|| `internal` || `internal` || Internal/debug logs ||
 	"""
 
+import BinaryLog
+import LogWriter
 import TestermanMessages as Messages
 import TestermanNodes as Nodes
 
@@ -61,6 +63,17 @@ import StringIO
 # through initialize()
 TheIlClient = None
 MaxLogPayloadSize = 65535
+# 'xml' or 'binary' (see BinaryLog)
+LogFormat = 'xml'
+
+# Log events are sent to the TL in batches, as soon as their size
+# reaches MaxLogBatchSize (bytes) or the oldest one was queued
+# MaxLogBatchLatency (s) ago.
+MaxLogBatchSize = 65536
+MaxLogBatchLatency = 0.02
+# Log levels whose events are sent immediately (with the pending ones):
+# they structure the log and are expected without delay by the monitors.
+ImmediateLogLevels = [ 'core', 'action' ]
 
 
 ################################################################################
@@ -83,33 +96,146 @@ def getBacktrace():
 ################################################################################
 
 class IlClient(Nodes.ConnectingNode):
+	"""
+	Sends the log events to the TL as LOG-BATCH notifications.
+	
+	A LOG-BATCH notification contains several log events, in their logging order,
+	formatted as they are appended to the log file (XML events followed by a newline,
+	or binary records, base64-encoded since Il messages cannot contain null characters).
+	Their log levels are listed, in the same order, in the Log-Classes header.
+	
+	Events are queued until the batch is large enough, or old enough
+	(see MaxLogBatchSize, MaxLogBatchLatency), the latter being controlled
+	by a flusher thread.
+	The batch is sent while holding the batch mutex so that
+	the events cannot be reordered.
+	"""
 	def __init__(self, jobId, serverAddress, localAddress = ('', 0), logFilename = None):
 		Nodes.ConnectingNode.__init__(self, "TE job:%s" % str(jobId), "TestermanTCI/IlClient")
 		
 		self.logFilename = logFilename
 		self.jobId = jobId
 		
+		# The pending batch: list of encoded events, their log levels, size,
+		# content type, and the time its first event was queued
+		self._batchCondition = threading.Condition(threading.Lock())
+		self._batch = []
+		self._batchClasses = []
+		self._batchSize = 0
+		self._batchContentType = None
+		self._batchTimestamp = None
+		self._flusherStopped = False
+		self._flusher = None
+		
 		self.localAddress = localAddress
 		self.initialize(serverAddress, self.localAddress)
 
+	def start(self):
+		Nodes.ConnectingNode.start(self)
+		self._flusherStopped = False
+		self._flusher = threading.Thread(target = self._flushBatches)
+		self._flusher.setDaemon(True)
+		self._flusher.start()
+	
+	def stop(self):
+		if self._flusher:
+			self._batchCondition.acquire()
+			self._flusherStopped = True
+			self._batchCondition.notify()
+			self._batchCondition.release()
+			self._flusher.join()
+			self._flusher = None
+		Nodes.ConnectingNode.stop(self)
+
 	def sendLogNotification(self, logClass, xml):
 		"""
-		Creates a notification and send it to the EventManager/TL, through the Il interface.
+		Queues an XML log event to send to the EventManager/TL, through the Il interface.
+		"""
+		try:
+			self._queueLogEvent(logClass, "application/xml", '%s\n' % xml.encode('utf-8'))
+		except Exception:
+			# Logging fallback to stderr
+			print >> sys.stdout, "WARNING: unable to send LOG notification: " + getBacktrace()
+
+	def sendBinaryLogNotification(self, logClass, element, record):
 		"""
-		try:	
-			notification = Messages.Notification("LOG", "job:%s" % self.jobId, "Il", "1.0")
+		Same as sendLogNotification, for a binary log record.
+		"""
+		try:
+			self._queueLogEvent(logClass, BinaryLog.CONTENT_TYPE, record)
+		except Exception:
+			# Logging fallback to stderr
+			print >> sys.stdout, "WARNING: unable to send LOG notification: " + getBacktrace()
+
+	def _queueLogEvent(self, logClass, contentType, data):
+		self._batchCondition.acquire()
+		try:
+			if self._batch and contentType != self._batchContentType:
+				self._sendBatch()
+			if not self._batch:
+				self._batchContentType = contentType
+				self._batchTimestamp = time.time()
+				# The flusher must start watching this new batch latency
+				self._batchCondition.notify()
+			self._batch.append(data)
+			self._batchClasses.append(logClass)
+			self._batchSize += len(data)
+			if self._batchSize >= MaxLogBatchSize or logClass in ImmediateLogLevels:
+				self._sendBatch()
+		finally:
+			self._batchCondition.release()
+
+	def _flushBatches(self):
+		"""
+		Flusher thread: sends the pending batch when it becomes too old.
+		The pending batch, if any, is sent on stop.
+		"""
+		self._batchCondition.acquire()
+		try:
+			while not self._flusherStopped:
+				if not self._batch:
+					self._batchCondition.wait()
+					continue
+				delay = self._batchTimestamp + MaxLogBatchLatency - time.time()
+				if delay > 0:
+					self._batchCondition.wait(delay)
+				else:
+					self._sendBatch()
+			if self._batch:
+				self._sendBatch()
+		finally:
+			self._batchCondition.release()
+
+	def _sendBatch(self):
+		"""
+		Sends the pending batch as a LOG-BATCH notification.
+		Called with the batch mutex held.
+		"""
+		data = ''.join(self._batch)
+		classes = ','.join(self._batchClasses)
+		contentType = self._batchContentType
+		self._batch = []
+		self._batchClasses = []
+		self._batchSize = 0
+		
+		try:
+			notification = Messages.Notification("LOG-BATCH", "job:%s" % self.jobId, "Il", "1.0")
 			if self.logFilename:
 				notification.setHeader("Log-Filename", self.logFilename)
-			notification.setHeader("Log-Class", logClass)
+			notification.setHeader("Log-Classes", classes)
 			notification.setHeader("Log-Timestamp", time.time())
-			notification.setHeader("Content-Encoding", "utf-8")
-			notification.setHeader("Content-Type", "application/xml")
-			notification.setBody(xml.encode('utf-8'))
+			notification.setContentType(contentType)
+			if contentType == BinaryLog.CONTENT_TYPE:
+				notification.setContentEncoding(notification.ENCODING_BASE64)
+				notification.setBody(base64.encodestring(data))
+			else:
+				notification.setContentEncoding(notification.ENCODING_UTF8)
+				notification.setBody(data)
 
 			self.sendNotification(0, notification)
 		except Exception:
 			# Logging fallback to stderr
-			print >> sys.stdout, "WARNING: unable to send LOG notification: " + getBacktrace()
+			print >> sys.stdout, "WARNING: unable to send LOG-BATCH notification: " + getBacktrace()
 
 ##################################################################################
 # A fake Il Client that write logs locally instead of sending log notifications
@@ -120,6 +246,10 @@ class LocalIlClient:
 	def __init__(self, logFilename = None):
 		self.logFilename = logFilename
 		self.mutex = threading.RLock()
+		self.writer = None
+		if self.logFilename and self.logFilename != '-':
+			self.writer = LogWriter.LogWriter(maxOpenFiles = 1)
+			self.writer.start()
 	
 	def sendLogNotification(self, logClass, xml):
 		"""
@@ -128,27 +258,57 @@ class LocalIlClient:
 		if not self.logFilename:
 			return
 			
-		self.mutex.acquire()
-		if self.logFilename == '-':
+		if self.writer:
+			self.writer.write(self.logFilename, '%s\n' % xml.encode('utf-8'))
+			# Make sure the log is complete as soon as the ATS is stopped
+			if logClass == 'core' and xml.startswith('<ats-stopped'):
+				self.writer.flush(self.logFilename)
+		else:
+			self.mutex.acquire()
 			print xml
+			self.mutex.release()
+
+	def sendBinaryLogNotification(self, logClass, element, record):
+		"""
+		Locally logs the binary record.
+		"""
+		if not self.logFilename:
+			return
+
+		if self.writer:
+			self.writer.write(self.logFilename, record)
+			# Make sure the log is complete as soon as the ATS is stopped
+			if logClass == 'core' and element == 'ats-stopped':
+				self.writer.flush(self.logFilename)
 		else:
-			try:
-				f = open(self.logFilename, 'a')
-				f.write('%s\n' % xml.encode('utf-8'))
-				f.close()
-			except:
-				pass
-		self.mutex.release()
+			# Not readable on stdout
+			self.sendLogNotification(logClass, BinaryLog.decodeRecord(record).toXml())
 
-def initialize(logFilename, ilServerAddress = None, jobId = None, maxPayloadSize = 65535):
+	def stop(self):
+		if self.writer:
+			self.writer.stop()
+			self.writer = None
+	
+	def finalize(self):
+		pass
+
+def initialize(logFilename, ilServerAddress = None, jobId = None, maxPayloadSize = 65535, logFormat = 'xml'):
 	"""
 	Sets module variables, starts connecting the IlClient to the TL subsystem
 	or initializes the logger for local logging only
+	
+	@type  logFormat: string
+	@param logFormat: 'xml' (default) or 'binary'. Binary log events are smaller
+	and faster to write and parse, and can be converted back to XML with BinaryLog.
 	"""
 	global TheIlClient
 	global MaxLogPayloadSize
+	global LogFormat
 
 	MaxLogPayloadSize = maxPayloadSize
+	if logFormat not in [ 'xml', 'binary' ]:
+		raise Exception("Invalid log format (%s)" % logFormat)
+	LogFormat = logFormat
 
 	if ilServerAddress and jobId:
 		TheIlClient = IlClient(jobId, serverAddress = ilServerAddress, logFilename = logFilename)
@@ -170,15 +330,36 @@ def finalize():
 ################################################################################
 
 ExcludedLogLevels = [ 'internal' ]
+# The same levels, as a set, so that checking a level costs a single lookup.
+# Must be kept in sync with ExcludedLogLevels.
+_ExcludedLogLevelSet = frozenset(ExcludedLogLevels)
+
+def _updateExcludedLogLevelSet():
+	global _ExcludedLogLevelSet
+	_ExcludedLogLevelSet = frozenset(ExcludedLogLevels)
 
 def setExcludedLogLevels(levels):
 	# Cannot exclude some low-level levels
 	global ExcludedLogLevels
 	ExcludedLogLevels = filter(lambda x: not x in [ 'core', 'action' ], levels)
+	_updateExcludedLogLevelSet()
 
 def getExcludedLogLevels():
 	return ExcludedLogLevels
 
+def isLogLevelEnabled(level):
+	"""
+	Fast check to call before preparing a costly log event,
+	so that a disabled log level costs a single lookup.
+	
+	@type  level: string
+	@param level: the log level (internal, event, system, match, mismatch, user, core, action)
+	
+	@rtype: bool
+	@returns: True if events of this level are logged, False otherwise
+	"""
+	return not level in _ExcludedLogLevelSet
+
 def enableDebugLogs():
 	setExcludedLogLevels([])
 
@@ -192,6 +373,7 @@ def enableLogLevel(level):
 	global ExcludedLogLevels
 	if level in ExcludedLogLevels:
 		ExcludedLogLevels.remove(level)
+		_updateExcludedLogLevelSet()
 
 def disableLogLevel(level):
 	global ExcludedLogLevels
@@ -200,6 +382,96 @@ def disableLogLevel(level):
 		return
 	if not level in ExcludedLogLevels:
 		ExcludedLogLevels.append(level)
+		_updateExcludedLogLevelSet()
+
+
+################################################################################
+# Template dictionary
+################################################################################
+
+# Template match/mismatch events usually log the same (static) templates
+# over and over. Instead of serializing a template in each event, it is logged
+# once in a template-defined event (id, fingerprint, template), and the
+# template-match/mismatch events then reference it with a template-id attribute.
+#
+# The dictionary is reset when a testcase is created, so that the log of a
+# testcase is self-contained. Template ids are unique in the whole ATS log.
+
+# When this number of templates is reached, the dictionary is reset
+MaxTemplateDictionarySize = 1000
+
+# Set to False to log the templates inline, in each template-match/mismatch event
+UseTemplateDictionary = True
+
+# dict[template key] = template id
+_TemplateDictionary = {}
+_TemplateDictionaryMutex = threading.RLock()
+_TemplateIdGenerator = 0
+
+def _getTemplateKey(obj):
+	"""
+	Returns a hashable representation of a Testerman structure,
+	as serialized in the logs (i.e. once toMessage() is applied).
+	Equal keys mean identical serializations.
+	"""
+	toMessage = getattr(obj, 'toMessage', None)
+	if toMessage is not None:
+		obj = toMessage()
+	if isinstance(obj, dict):
+		return (dict, frozenset([ (k, _getTemplateKey(v)) for (k, v) in obj.iteritems() ]))
+	if isinstance(obj, (list, tuple)):
+		return (obj.__class__, tuple([ _getTemplateKey(x) for x in obj ]))
+	if obj is None or isinstance(obj, (basestring, int, long, float)):
+		return (obj.__class__, obj)
+	# Other objects (matching mechanisms, etc) are logged as unicode strings
+	return (obj.__class__, unicode(obj))
+
+def _getTemplateId(level, template, timestamp):
+	"""
+	Returns the id of a template in the dictionary,
+	logging a template-defined event first if it was not defined yet.
+
+	@type  level: string
+	@param level: the log level of the event referencing the template
+	@type  template: any valid Testerman structure
+	@param template: the template to reference
+	@type  timestamp: float
+	@param timestamp: the timestamp of the event referencing the template
+	
+	@rtype: integer, or None
+	@returns: the template id, or None if the template cannot be referenced
+	(and should be logged inline)
+	"""
+	global _TemplateIdGenerator
+	if not UseTemplateDictionary:
+		return None
+	try:
+		key = _getTemplateKey(template)
+		fingerprint = hash(key)
+	except Exception:
+		# Unhashable values
+		return None
+
+	_TemplateDictionaryMutex.acquire()
+	try:
+		templateId = _TemplateDictionary.get(key)
+		if templateId is None:
+			if len(_TemplateDictionary) >= MaxTemplateDictionarySize:
+				_TemplateDictionary.clear()
+			templateId = _TemplateIdGenerator + 1
+			# Logged with the mutex held, so that no other thread can log a reference
+			# to this template before its definition
+			tliLogEvent(level, 'template-defined', { 'class': 'event', 'timestamp': timestamp, 'id': templateId, 'fingerprint': '%08x' % (fingerprint & 0xffffffff) }, fields = [ ('template', template) ])
+			_TemplateIdGenerator = templateId
+			_TemplateDictionary[key] = templateId
+		return templateId
+	finally:
+		_TemplateDictionaryMutex.release()
+
+def _resetTemplateDictionary():
+	_TemplateDictionaryMutex.acquire()
+	_TemplateDictionary.clear()
+	_TemplateDictionaryMutex.release()
 
 
 ################################################################################
@@ -211,117 +483,218 @@ def toXml(element, attributes, value = ''):
 	return u'<%s %s>%s</%s>' % (element, u" ".join(map(lambda e: u'%s="%s"' % (e[0], str(e[1])), attributes.items())), value, element)
 
 def logAtsStarted(id_):
-	tliLog('core', toXml('ats-started', { 'class': 'event', 'timestamp': time.time(), 'id': id_ }))
+	tliLogEvent('core', 'ats-started', { 'class': 'event', 'timestamp': time.time(), 'id': id_ })
 
 def logAtsStopped(id_, result, message = ''):
-	tliLog('core', toXml('ats-stopped', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'result': str(result) }, cgi.escape(message)))
+	tliLogEvent('core', 'ats-stopped', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'result': str(result) }, text = message)
 
 def logUser(message, tc = None):
+	if 'user' in _ExcludedLogLevelSet:
+		return
 	if tc is None:
-		tliLog('user', toXml('user', { 'class': 'user', 'timestamp': time.time() }, cgi.escape(message)))
+		tliLogEvent('user', 'user', { 'class': 'user', 'timestamp': time.time() }, text = message)
 	else:
-		tliLog('user', toXml('user', { 'class': 'user', 'timestamp': time.time(), 'tc': tc }, cgi.escape(message)))
+		tliLogEvent('user', 'user', { 'class': 'user', 'timestamp': time.time(), 'tc': tc }, text = message)
 
-def logInternal(message):
-	tliLog('internal', toXml('internal', { 'class': 'internal', 'timestamp': time.time() }, cgi.escape(message)))
+def logInternal(message, *args):
+	"""
+	Logs an internal/debug message.
+	
+	The internal log level being disabled by default, the message
+	is only formatted (message % args) if it is enabled:
+	pass costly values (repr'd structures, etc) as args instead
+	of formatting the message yourself.
+	"""
+	if 'internal' in _ExcludedLogLevelSet:
+		return
+	if args:
+		message = message % args
+	tliLogEvent('internal', 'internal', { 'class': 'internal', 'timestamp': time.time() }, text = message)
 	
 def logMessageSent(fromTc, fromPort, toTc, toPort, message, address = None):
+	if 'event' in _ExcludedLogLevelSet:
+		return
 	if not address:
 		address = ''
 	try:
-		tliLog('event', toXml('message-sent', { 'class': 'event', 'timestamp': time.time(), 'from-tc': fromTc, 'from-port': fromPort, 'to-tc': toTc, 'to-port': toPort }, '%s%s' % (testermanToXml(message, 'message'), testermanToXml(address, 'address'))))
+		tliLogEvent('event', 'message-sent', { 'class': 'event', 'timestamp': time.time(), 'from-tc': fromTc, 'from-port': fromPort, 'to-tc': toTc, 'to-port': toPort }, fields = [ ('message', message), ('address', address) ])
 	except Exception, e:
 		ret = getBacktrace()
 		logUser(unicode(e) + u'\n' + unicode(ret))
 
 def logTestcaseCreated(id_, role):
-	tliLog('core', toXml('testcase-created', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'role': role }))
+	# A testcase log must be self-contained: templates are redefined in each testcase
+	_resetTemplateDictionary()
+	tliLogEvent('core', 'testcase-created', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'role': role })
 
 def logTestcaseStarted(id_, title):
-	tliLog('core', toXml('testcase-started', { 'class': 'event', 'timestamp': time.time(), 'id': id_ }, cgi.escape(title)))
+	tliLogEvent('core', 'testcase-started', { 'class': 'event', 'timestamp': time.time(), 'id': id_ }, text = title)
 
 def logTestcaseStopped(id_, verdict, description):
-	tliLog('core', toXml('testcase-stopped', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'verdict': verdict }, u"<![CDATA[%s]]>" % description))
+	tliLogEvent('core', 'testcase-stopped', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'verdict': verdict }, cdata = description)
 
 def logTimerStarted(id_, tc, duration):
-	tliLog('event', toXml('timer-started', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'duration': str(duration), 'tc': tc }))
+	if 'event' in _ExcludedLogLevelSet:
+		return
+	tliLogEvent('event', 'timer-started', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'duration': str(duration), 'tc': tc })
 
 def logTimerStopped(id_, tc, runningTime):
-	tliLog('event', toXml('timer-stopped', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'running-time': str(runningTime), 'tc': tc }))
+	if 'event' in _ExcludedLogLevelSet:
+		return
+	tliLogEvent('event', 'timer-stopped', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'running-time': str(runningTime), 'tc': tc })
 
 def logTimerExpiry(id_, tc):
-	tliLog('event', toXml('timer-expiry', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'tc': tc }))
+	if 'event' in _ExcludedLogLevelSet:
+		return
+	tliLogEvent('event', 'timer-expiry', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'tc': tc })
 
 def logTestComponentCreated(id_):
-	tliLog('event', toXml('tc-created', { 'class': 'event', 'timestamp': time.time(), 'id': id_ }))
+	if 'event' in _ExcludedLogLevelSet:
+		return
+	tliLogEvent('event', 'tc-created', { 'class': 'event', 'timestamp': time.time(), 'id': id_ })
 
 def logTestComponentStarted(id_, behaviour):
-	tliLog('event', toXml('tc-started', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'behaviour': behaviour }))
+	if 'event' in _ExcludedLogLevelSet:
+		return
+	tliLogEvent('event', 'tc-started', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'behaviour': behaviour })
 
 def logTestComponentStopped(id_, verdict, message = ''):
-	tliLog('event', toXml('tc-stopped', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'verdict': verdict }, cgi.escape(message)))
+	if 'event' in _ExcludedLogLevelSet:
+		return
+	tliLogEvent('event', 'tc-stopped', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'verdict': verdict }, text = message)
 
 def logTestComponentKilled(id_, message = ''):
-	tliLog('event', toXml('tc-killed', { 'class': 'event', 'timestamp': time.time(), 'id': id_, }, cgi.escape(message)))
+	if 'event' in _ExcludedLogLevelSet:
+		return
+	tliLogEvent('event', 'tc-killed', { 'class': 'event', 'timestamp': time.time(), 'id': id_, }, text = message)
 
 def logVerdictUpdated(tc, verdict):
-	tliLog('event', toXml('verdict-updated', { 'class': 'event', 'timestamp': time.time(), 'tc': tc, 'verdict': verdict }))
+	if 'event' in _ExcludedLogLevelSet:
+		return
+	tliLogEvent('event', 'verdict-updated', { 'class': 'event', 'timestamp': time.time(), 'tc': tc, 'verdict': verdict })
+
+def _getTemplateMatchFields(level, attributes, message, template, encodedMessage):
+	"""
+	Returns the fields of a template-match/mismatch event.
+	The template is replaced with a template-id attribute if it can be
+	referenced from the template dictionary.
+	"""
+	fields = [ ('message', message) ]
+	templateId = _getTemplateId(level, template, attributes['timestamp'])
+	if templateId is None:
+		fields.append(('template', template))
+	else:
+		attributes['template-id'] = templateId
+	if encodedMessage:
+		fields.append(('encoded-message', encodedMessage))
+	return fields
 
 def logTemplateMatch(tc, port, message, template, encodedMessage = None):
+	if 'match' in _ExcludedLogLevelSet:
+		return
+	attributes = { 'class': 'event', 'timestamp': time.time(), 'tc': tc, 'port': port }
 	try:
 		# Should we call a tliMatch/tliMisMatch ?
-		if encodedMessage:
-			tliLog('match', toXml('template-match', { 'class': 'event', 'timestamp': time.time(), 'tc': tc, 'port': port }, '%s%s%s' % (testermanToXml(message, 'message'), testermanToXml(template, 'template'), testermanToXml(encodedMessage, 'encoded-message'))))
-		else:
-			tliLog('match', toXml('template-match', { 'class': 'event', 'timestamp': time.time(), 'tc': tc, 'port': port }, '%s%s' % (testermanToXml(message, 'message'), testermanToXml(template, 'template'))))
+		fields = _getTemplateMatchFields('match', attributes, message, template, encodedMessage)
+		tliLogEvent('match', 'template-match', attributes, fields = fields)
 	except Exception, e:
 		ret = getBacktrace()
 		logUser(unicode(e) + u'\n' + unicode(ret))
 
 def logTemplateMismatch(tc, port, message, template, encodedMessage = None, mismatchedPath = None):
+	if 'mismatch' in _ExcludedLogLevelSet:
+		return
 	attributes = { 'class': 'event', 'timestamp': time.time(), 'tc': tc, 'port': port }
 	if mismatchedPath:
 		attributes['path'] = mismatchedPath 
 	try:
 		# Should we call a tliMatch/tliMisMatch ?
-		if encodedMessage:
-			tliLog('mismatch', toXml('template-mismatch', attributes, '%s%s%s' % (testermanToXml(message, 'message'), testermanToXml(template, 'template'), testermanToXml(encodedMessage, 'encoded-message'))))
-		else:
-			tliLog('mismatch', toXml('template-mismatch', attributes, '%s%s' % (testermanToXml(message, 'message'), testermanToXml(template, 'template'))))
+		fields = _getTemplateMatchFields('mismatch', attributes, message, template, encodedMessage)
+		tliLogEvent('mismatch', 'template-mismatch', attributes, fields = fields)
 	except Exception, e:
 		ret = getBacktrace()
 		logUser(unicode(e) + u'\n' + unicode(ret))
 
 def logTimeoutBranchSelected(id_):
+	if 'match' in _ExcludedLogLevelSet:
+		return
 	# in a alt, we selected a timer.TIMEOUT where the timer's id is id_
-	tliLog('match', toXml('timeout-branch', { 'class': 'event', 'timestamp': time.time(), 'id': id_ }))
+	tliLogEvent('match', 'timeout-branch', { 'class': 'event', 'timestamp': time.time(), 'id': id_ })
 
 def logDoneBranchSelected(id_):
+	if 'match' in _ExcludedLogLevelSet:
+		return
 	# in a alt, we selected a tc.DONE where the tc's id is id_
-	tliLog('match', toXml('done-branch', { 'class': 'event', 'timestamp': time.time(), 'id': id_ }))
+	tliLogEvent('match', 'done-branch', { 'class': 'event', 'timestamp': time.time(), 'id': id_ })
 
 def logKilledBranchSelected(id_):
+	if 'match' in _ExcludedLogLevelSet:
+		return
 	# in a alt, we selected a tc.KILLED where the tc's id is id_
-	tliLog('match', toXml('killed-branch', { 'class': 'event', 'timestamp': time.time(), 'id': id_ }))
+	tliLogEvent('match', 'killed-branch', { 'class': 'event', 'timestamp': time.time(), 'id': id_ })
 
 def logSystemSent(tsiPort, label, payload, sutAddress = None):
+	if 'system' in _ExcludedLogLevelSet:
+		return
 	if sutAddress is None: sutAddress = ''
-	tliLog('system', toXml('system-sent', { 'class': 'system', 'timestamp': time.time(), 'tsi-port': tsiPort }, '%s%s%s' % (testermanToXml(label, 'label'), testermanToXml(payload, 'payload'), testermanToXml(sutAddress, 'sut-address'))))
+	tliLogEvent('system', 'system-sent', { 'class': 'system', 'timestamp': time.time(), 'tsi-port': tsiPort }, fields = [ ('label', label), ('payload', payload), ('sut-address', sutAddress) ])
 
 def logSystemReceived(tsiPort, label, payload, sutAddress = None):
+	if 'system' in _ExcludedLogLevelSet:
+		return
 	if sutAddress is None: sutAddress = ''
-	tliLog('system', toXml('system-received', { 'class': 'system', 'timestamp': time.time(), 'tsi-port': tsiPort }, '%s%s%s' % (testermanToXml(label, 'label'), testermanToXml(payload, 'payload'), testermanToXml(sutAddress, 'sut-address'))))
+	tliLogEvent('system', 'system-received', { 'class': 'system', 'timestamp': time.time(), 'tsi-port': tsiPort }, fields = [ ('label', label), ('payload', payload), ('sut-address', sutAddress) ])
 
 def logActionRequested(message, timeout, tc):
-	tliLog('action', toXml('action-requested', { 'class': 'action', 'timestamp': time.time(), 'timeout': timeout, 'tc': tc }, '%s' % (testermanToXml(message, 'message'))))
+	tliLogEvent('action', 'action-requested', { 'class': 'action', 'timestamp': time.time(), 'timeout': timeout, 'tc': tc }, fields = [ ('message', message) ])
 
 def logActionCleared(reason, tc):
-	tliLog('action', toXml('action-cleared', { 'class': 'action', 'timestamp': time.time(), 'tc': tc, 'reason': reason }))
+	tliLogEvent('action', 'action-cleared', { 'class': 'action', 'timestamp': time.time(), 'tc': tc, 'reason': reason })
 
 def tliLog(level, xml):
-	if not level in getExcludedLogLevels():
+	if not level in _ExcludedLogLevelSet:
 		# Fire a log event
 		TheIlClient.sendLogNotification(level, xml)
+
+def tliLogEvent(level, element, attributes, text = None, cdata = None, fields = None):
+	"""
+	Logs an event in the current log format.
+	See eventToXml() for the parameters.
+	"""
+	if not level in _ExcludedLogLevelSet:
+		# Fire a log event
+		if LogFormat == 'binary':
+			TheIlClient.sendBinaryLogNotification(level, element, BinaryLog.encodeEvent(element, attributes.items(), text, cdata, fields))
+		else:
+			TheIlClient.sendLogNotification(level, eventToXml(element, attributes.items(), text, cdata, fields))
+
+def eventToXml(element, attributes, text = None, cdata = None, fields = None):
+	"""
+	Serializes a log event to XML.
+	
+	@type  element: string
+	@param element: the event element name
+	@type  attributes: list of (string, object)
+	@param attributes: the event attributes, rendered with str()
+	@type  text: unicode, or None
+	@param text: the event text value, if any (escaped)
+	@type  cdata: unicode, or None
+	@param cdata: the event value, if any, as a CDATA section
+	@type  fields: list of (string, object), or None
+	@param fields: the event structured values, as (element name, Testerman structure),
+	serialized with testermanToXml().
+	
+	@rtype: unicode
+	"""
+	if fields is not None:
+		value = u''.join([ testermanToXml(v, n) for (n, v) in fields ])
+	elif cdata is not None:
+		value = u"<![CDATA[%s]]>" % cdata
+	elif text is not None:
+		value = cgi.escape(text)
+	else:
+		value = ''
+	return u'<%s %s>%s</%s>' % (element, u" ".join([ u'%s="%s"' % (n, str(v)) for (n, v) in attributes ]), value, element)
 	
 ################################################################################
 # Main Testerman log format: XML serializer
@@ -31,6 +31,8 @@ from TestermanTCI import *
 import TestermanTCI
 
 import binascii
+import collections
+import itertools
 import random
 import re
 import threading
@@ -123,6 +125,72 @@ def trim(docstring):
 _ContextMap = {} # a list of TLS, per thread ID
 _ContextMapMutex = threading.RLock()
 
+class _Notifier(object):
+	"""
+	A wakeup object a test component waits on in alt(),
+	signalled by the ports it watches (including the system queue)
+	whenever a new message is enqueued.
+	
+	Implemented with a single pipe per notifier (i.e. per test component context),
+	which is written only when the notifier is not already signalled,
+	i.e. not for each enqueued message.
+	We wait on a fd (and not on a threading.Condition) so that a SIGINT
+	can still interrupt the wait in the main thread.
+	"""
+	def __init__(self):
+		self._mutex = threading.Lock()
+		self._signalled = False
+		self._pipe = os.pipe()
+		if hasattr(select, 'poll'):
+			self._poll = select.poll()
+			self._poll.register(self._pipe[0], select.POLLIN)
+		else:
+			self._poll = None
+
+	def notify(self):
+		"""
+		Wakes up the waiting test component, if any.
+		May be called from any thread.
+		"""
+		# The pipe I/Os are done outside the critical section
+		# so that the woken up thread does not block on it.
+		fd = None
+		self._mutex.acquire()
+		# Once closed, the fds may have been reused: never write to them
+		if not self._signalled and self._pipe:
+			self._signalled = True
+			fd = self._pipe[1]
+		self._mutex.release()
+		if fd is not None:
+			os.write(fd, 'r')
+
+	def wait(self):
+		"""
+		Blocks until notify() is called, or returns immediately
+		if it has been called since the last wait().
+		"""
+		fd = self._pipe[0]
+		if self._poll:
+			self._poll.poll()
+		else:
+			select.select([ fd ], [], [])
+		self._mutex.acquire()
+		signalled = self._signalled
+		self._signalled = False
+		self._mutex.release()
+		if signalled:
+			os.read(fd, 1)
+
+	def close(self):
+		self._mutex.acquire()
+		try:
+			if self._pipe:
+				os.close(self._pipe[0])
+				os.close(self._pipe[1])
+				self._pipe = None
+		finally:
+			self._mutex.release()
+
 class TestermanContext:
 	"""
 	A Context store several info about the associated timers,
@@ -145,9 +213,8 @@ class TestermanContext:
 		# Current activated default alternatives
 		self._defaultAlternatives = []
 		self._defaultAltsteps = {}
-		# The pipe used for system queue notifications in alt()
-		self._systemQueueNotifier = None
-		self._systemQueueNotifierUserCount = 0 # smart counter, multiple nested alt() can use the same notifier
+		# The notifier the watched ports signal in alt(), created on first use
+		self._notifier = None
 	
 	def getValues(self):
 		return self._values
@@ -186,19 +253,19 @@ class TestermanContext:
 		# something it brings.
 		for alternative in altstep:
 			self._defaultAlternatives.append(alternative)
-		TestermanTCI.logInternal("Activated default altstep %s" % altstepReference)
+		TestermanTCI.logInternal("Activated default altstep %s", altstepReference)
 		return altstepReference
 
 	def removeDefaultAltstep(self, ref):
 		if not ref in self._defaultAltsteps:
-			TestermanTCI.logInternal("Unable to deactivate altstep %s: not activated" % ref)
+			TestermanTCI.logInternal("Unable to deactivate altstep %s: not activated", ref)
 			return False
 		altstep = self._defaultAltsteps[ref]
 		for alternative in altstep:
 			# This 'if' should be useless.
 			if alternative in self._defaultAlternatives:
 				self._defaultAlternatives.remove(alternative)
-		TestermanTCI.logInternal("Default altstep %s deactivated" % ref)
+		TestermanTCI.logInternal("Default altstep %s deactivated", ref)
 		return True
 	
 	def getDefaultAlternatives(self):
@@ -211,24 +278,16 @@ class TestermanContext:
 		if timer in self._timers:
 			self._timers.remove(timer)
 	
-	def getSystemQueueNotifier(self):
-		if not self._systemQueueNotifier:
-			self._systemQueueNotifier = os.pipe()
-			self._systemQueueNotifierUserCount = 0
-		self._systemQueueNotifierUserCount += 1
-		return self._systemQueueNotifier
+	def getNotifier(self):
+		if not self._notifier:
+			self._notifier = _Notifier()
+		return self._notifier
 	
-	def cleanSystemQueueNotifier(self, force = False):
-		self._systemQueueNotifierUserCount -= 1
-		if (force or self._systemQueueNotifierUserCount <= 0) and self._systemQueueNotifier:
-			try:
-				os.close(self._systemQueueNotifier[0])
-				os.close(self._systemQueueNotifier[1])
-			except:
-				pass
-			self._systemQueueNotifierUserCount = 0
-			self._systemQueueNotifier = None
-			logInternal("tc %s does not use the system queue notifier any more - cleaned up" % self._tc)
+	def cleanNotifier(self):
+		if self._notifier:
+			self._notifier.close()
+			self._notifier = None
+			logInternal("tc %s does not use its notifier any more - cleaned up", self._tc)
 	
 def getLocalContext():
 	"""
@@ -265,13 +324,29 @@ def _stopAllTimers():
 			timer.stop()
 	_ContextMapMutex.release()
 
+def _retireLocalContext():
+	"""
+	Detaches the current local context from the current thread,
+	so that the next getLocalContext() in this thread creates a new one.
+	
+	The retired context is kept until the end of the testcase,
+	so that its timers are still stopped by _stopAllTimers().
+	(to call when a thread is reused for another behaviour)
+	"""
+	_ContextMapMutex.acquire()
+	context = _ContextMap.pop(threading.currentThread(), None)
+	if context:
+		context.cleanNotifier()
+		_ContextMap[('retired', _getNewId())] = context
+	_ContextMapMutex.release()
+
 def _clearLocalContexts():
 	"""
 	Clears the existing local contexts.
 	"""
 	_ContextMapMutex.acquire()
 	for context in _ContextMap.values():
-		context.cleanSystemQueueNotifier(force = True)
+		context.cleanNotifier()
 	_ContextMap.clear()
 	_ContextMapMutex.release()
 
@@ -286,6 +361,31 @@ class _BranchCondition:
 		self.value = value
 		self.sender = sender
 		self.from_ = from_
+		# The compiled template, on first match
+		self._matcher = None
+
+	def _resetMatcher(self):
+		"""
+		The compiled template will be looked up again
+		(and recompiled if the template was modified) on next match.
+		"""
+		self._matcher = None
+
+	def match(self, message, decode = True):
+		"""
+		Matches a message against the condition template,
+		looking up its compiled form on first use.
+		
+		@rtype: tuple (bool, object, unicode)
+		@returns: (matched, decodedMessage, mismatchedPath), as templateMatch()
+		"""
+		try:
+			if self._matcher is None:
+				self._matcher = _getTemplateMatcher(self.template)
+			return self._matcher.match(message, u'template', decode)
+		except Exception:
+			logUser("Exception while trying to match a template:\n%s" % getBacktrace())
+			return (False, message, u'template')
 
 ################################################################################
 # ATS Context: ATS-wide 
@@ -375,7 +475,7 @@ class Timer:
 		getLocalContext().registerTimer(self)
 		self._tc = getLocalContext().getTc()
 
-		logInternal("%s created" % str(self))
+		logInternal("%s created", self)
 	
 	def __str__(self):
 		return self._name
@@ -485,6 +585,213 @@ def triTimeout(timerId):
 # TTCN-3 Test Component (TC)
 ################################################################################
 
+class _ComponentExecutor:
+	"""
+	Runs the PTC behaviours on a pool of reusable worker threads,
+	so that starting a behaviour does not create a new thread
+	(and a new local context) each time.
+	
+	Once a behaviour is completed, its worker retires its local context
+	then waits for another behaviour to execute, unless there are
+	already maxIdleWorkers idle workers (in this case, the thread ends).
+	
+	If maxConcurrentComponents is not 0, no more than this number of
+	behaviours are executed at the same time: additional start requests
+	are queued until a running behaviour completes.
+	Warning: a behaviour waiting for a queued one may deadlock, so
+	the default is no limit.
+	"""
+	def __init__(self, maxIdleWorkers = 16, maxConcurrentComponents = 0):
+		self._mutex = threading.RLock()
+		self._maxIdleWorkers = maxIdleWorkers
+		self._maxConcurrentComponents = maxConcurrentComponents
+		# Pending start requests: list of (callable, args, kwargs)
+		self._queue = []
+		# Idle workers, waiting for a job (the most recently used last)
+		self._idleWorkers = []
+		self._workerCount = 0
+		self._runningCount = 0
+		# Counters
+		self._startedCount = 0
+		self._createdWorkerCount = 0
+		self._queuedCount = 0
+		self._maxQueueSize = 0
+		self._maxRunningCount = 0
+	
+	def configure(self, maxIdleWorkers = None, maxConcurrentComponents = None):
+		self._mutex.acquire()
+		try:
+			if maxIdleWorkers is not None:
+				self._maxIdleWorkers = maxIdleWorkers
+				while len(self._idleWorkers) > self._maxIdleWorkers:
+					self._idleWorkers.pop(0).assign(None)
+			if maxConcurrentComponents is not None:
+				self._maxConcurrentComponents = maxConcurrentComponents
+				self._schedule()
+		finally:
+			self._mutex.release()
+	
+	def submit(self, function, args = (), kwargs = {}):
+		"""
+		Executes function(*args, **kwargs) in a worker thread,
+		as soon as the max number of concurrent components allows it.
+		"""
+		self._mutex.acquire()
+		try:
+			self._queue.append((function, args, kwargs))
+			self._schedule()
+			if self._queue:
+				self._queuedCount += 1
+				self._maxQueueSize = max(self._maxQueueSize, len(self._queue))
+		finally:
+			self._mutex.release()
+	
+	def _canStart(self):
+		"""
+		Called with the mutex held.
+		"""
+		return self._queue and (not self._maxConcurrentComponents or self._runningCount < self._maxConcurrentComponents)
+
+	def _schedule(self):
+		"""
+		Dispatches the queued jobs to idle (or new) workers, as long as allowed.
+		Called with the mutex held.
+		"""
+		while self._canStart():
+			job = self._queue.pop(0)
+			self._runningCount += 1
+			self._startedCount += 1
+			self._maxRunningCount = max(self._maxRunningCount, self._runningCount)
+			if self._idleWorkers:
+				self._idleWorkers.pop().assign(job)
+			else:
+				self._workerCount += 1
+				self._createdWorkerCount += 1
+				worker = _ComponentWorker(self, job)
+				worker.start()
+	
+	def _onJobCompleted(self, worker):
+		"""
+		Called by a worker once its job is completed.
+		Returns the next job to execute directly, if any,
+		or None if the worker should wait for a job (then it has been set idle),
+		or False if the worker should terminate.
+		"""
+		self._mutex.acquire()
+		try:
+			self._runningCount -= 1
+			if self._canStart():
+				job = self._queue.pop(0)
+				self._runningCount += 1
+				self._startedCount += 1
+				return job
+			if len(self._idleWorkers) < self._maxIdleWorkers:
+				# Flags the worker as waiting for assign()
+				worker._job = False
+				self._idleWorkers.append(worker)
+				return None
+			self._workerCount -= 1
+			return False
+		finally:
+			self._mutex.release()
+
+	def _onWorkerStopped(self, worker):
+		self._mutex.acquire()
+		self._workerCount -= 1
+		self._mutex.release()
+
+	def stop(self):
+		"""
+		Terminates the idle workers.
+		Running behaviours are not interrupted.
+		"""
+		self._mutex.acquire()
+		try:
+			for worker in self._idleWorkers:
+				worker.assign(None)
+			self._idleWorkers = []
+		finally:
+			self._mutex.release()
+	
+	def getStatistics(self):
+		"""
+		@rtype: dict[string] of integers
+		@returns: the executor counters:
+		workers: current number of worker threads,
+		idle-workers: workers waiting for a behaviour to execute,
+		running: behaviours being executed,
+		queued: start requests waiting for a running behaviour to complete,
+		started: total number of started behaviours,
+		created-workers: total number of created worker threads
+		(started - created-workers behaviours reused an existing thread),
+		total-queued: total number of start requests that have been queued,
+		max-running, max-queued: the peak values.
+		"""
+		self._mutex.acquire()
+		try:
+			return {
+				'workers': self._workerCount,
+				'idle-workers': len(self._idleWorkers),
+				'running': self._runningCount,
+				'queued': len(self._queue),
+				'started': self._startedCount,
+				'created-workers': self._createdWorkerCount,
+				'total-queued': self._queuedCount,
+				'max-running': self._maxRunningCount,
+				'max-queued': self._maxQueueSize,
+			}
+		finally:
+			self._mutex.release()
+
+class _ComponentWorker(threading.Thread):
+	"""
+	A thread executing behaviours for a _ComponentExecutor.
+	"""
+	def __init__(self, executor, job):
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+		self._executor = executor
+		self._condition = threading.Condition(executor._mutex)
+		self._job = job
+	
+	def assign(self, job):
+		"""
+		Wakes up the idle worker to execute job,
+		or to terminate if job is None.
+		Called with the executor mutex held.
+		"""
+		self._job = job
+		self._condition.notify()
+
+	def run(self):
+		job = self._job
+		while job:
+			function, args, kwargs = job
+			try:
+				function(*args, **kwargs)
+			except Exception:
+				logInternal("Exception while executing a component behaviour:\n%s", getBacktrace())
+			# The next behaviour executed in this thread should start with a clean context
+			_retireLocalContext()
+
+			job = self._executor._onJobCompleted(self)
+			if job is None:
+				# We have been set idle: wait for a new job (or None to terminate)
+				self._condition.acquire()
+				try:
+					while self._job is False:
+						self._condition.wait()
+					job = self._job
+				finally:
+					self._condition.release()
+				if not job:
+					self._executor._onWorkerStopped(self)
+
+_TheComponentExecutor = _ComponentExecutor()
+
+def _getComponentExecutor():
+	return _TheComponentExecutor
+
 class TestComponent:
 	"""
 	Implements most of the TestComponent TTCN-3 interface.
@@ -560,9 +867,14 @@ class TestComponent:
 	
 	def _setState(self, state):
 		self._lock()
+		wasAlive = self.alive()
 		self._state = state
+		isAlive = self.alive()
 		self._unlock()
-		logInternal("%s switched its state to %s" % (str(self), str(state)))
+		logInternal("%s switched its state to %s", self, state)
+		# Keep the number of alive PTCs up to date, to detect the all component done/killed states
+		if wasAlive != isAlive and not self._mtc:
+			self._testcase._updateAlivePtcCount(isAlive and 1 or -1)
 	
 	def _getState(self):
 		self._lock()
@@ -575,7 +887,7 @@ class TestComponent:
 		Prepares the TC for discarding: purge all port queues.
 		"""
 		for port in self._ports.values():
-			logInternal("Finalizing port %s" % port)
+			logInternal("Finalizing port %s", port)
 			port.stop()
 			port._finalize()
 	
@@ -718,26 +1030,31 @@ class TestComponent:
 				self._emitDoneEvent()
 				self._emitKilledEvent()
 		else:
-			if not self._getState() == self.STATE_STOPPED:
-				# Alive components
-				self._setState(self.STATE_STOPPED)
-				self._emitDoneEvent()
+			# Alive components.
+			# The DONE event is posted with the state change, so that a start()
+			# in another thread cannot remove it before it is posted
+			# (it would be matched by the next done()).
+			self._lock()
+			try:
+				if not self._getState() == self.STATE_STOPPED:
+					self._setState(self.STATE_STOPPED)
+					self._emitDoneEvent()
+			finally:
+				self._unlock()
 
 	def _emitDoneEvent(self):
 		_postSystemEvent(self._DONE_EVENT, self)
 		# If we are the last DONE, emit a all_component._DONE_EVENT too
-		for ptc in self._testcase._ptcs:
-			if ptc.alive():
-				return
+		if self._testcase._getAlivePtcCount():
+			return
 		# OK, Last one.
 		_postSystemEvent(self._ALL_DONE_EVENT, None)
 	
 	def _emitKilledEvent(self):
 		_postSystemEvent(self._KILLED_EVENT, self)
 		# If we are the last DONE, emit a all_component._KILLED_EVENT too
-		for ptc in self._testcase._ptcs:
-			if ptc.alive():
-				return
+		if self._testcase._getAlivePtcCount():
+			return
 		# OK, Last one.
 		_postSystemEvent(self._ALL_KILLED_EVENT, None)
 	
@@ -823,7 +1140,8 @@ class TestComponent:
 		Implementation note:
 		normally we should go through the Component Handler to execute the behaviour
 		on a possibly distributed PTC. 
-		For now, this is just a (local) thread.
+		For now, this is just a (local) thread, taken from the component executor
+		pool (see set_component_executor()).
 		
 		@type  behaviour: a Behaviour object
 		@param behaviour: the behaviour to bind to the PTC
@@ -835,22 +1153,25 @@ class TestComponent:
 		if not self.alive():
 			raise TestermanTtcn3Exception("Invalid operation: you cannot start a behaviour on a PTC which is not alive anymore.")
 
-		if self._getState() == self.STATE_RUNNING:
-			raise TestermanTtcn3Exception("Invalid operation: you cannot start a behaviour on a running PTC.")
-
-		# We remove any DONE event that may be in the system queue for this PTC,
-		# so that a previous ptc.DONE / ptc.done() does not match after a restart()
-		# In other words, the state "done" is no longer valid for this PTC.
-		_removeSystemEvent(self._DONE_EVENT, self)
-		_removeSystemEvent(self._ALL_DONE_EVENT, None)
-
-		logInternal("Starting %s..." % str(self))
-		self._setState(self.STATE_RUNNING)
+		self._lock()
+		try:
+			if self._getState() == self.STATE_RUNNING:
+				raise TestermanTtcn3Exception("Invalid operation: you cannot start a behaviour on a running PTC.")
+
+			# We remove any DONE event that may be in the system queue for this PTC,
+			# so that a previous ptc.DONE / ptc.done() does not match after a restart()
+			# In other words, the state "done" is no longer valid for this PTC.
+			_removeSystemEvent(self._DONE_EVENT, self)
+			_removeSystemEvent(self._ALL_DONE_EVENT, None)
+
+			logInternal("Starting %s...", self)
+			self._setState(self.STATE_RUNNING)
+		finally:
+			self._unlock()
 		# Attach the PTC to this behaviour
 		behaviour._setPtc(self)
 		
-		behaviourThread = threading.Thread(target = self._start, args = (behaviour, ), kwargs = kwargs)
-		behaviourThread.start()
+		_getComponentExecutor().submit(self._start, (behaviour, ), kwargs)
 
 	def stop(self):
 		"""
@@ -865,7 +1186,7 @@ class TestComponent:
 			raise TestermanStopException()
 		else:
 			if self._getState() == self.STATE_RUNNING:
-				logInternal("Stopping %s..." % str(self))
+				logInternal("Stopping %s...", self)
 				# Let's post a system event to manage inter-thread communications
 				_postSystemEvent(self._STOP_COMMAND, self)
 
@@ -918,6 +1239,10 @@ class TestComponent:
 # TTCN-3 Port
 ###############################################################################
 
+# Messages are numbered when enqueued, so that alt() can analyze the messages
+# received on several ports in their arrival order.
+_MessageArrivalCounter = itertools.count()
+
 class Port:
 	"""
 	TTCN-3 Port object.
@@ -928,8 +1253,8 @@ class Port:
 			self._name = "port_%d" % _getNewId()
 		self._mutex = threading.RLock()
 
-		# The internal port's message queue
-		self._messageQueue = []
+		# The internal port's message queue, of (message, from_, arrival number)
+		self._messageQueue = collections.deque()
 
 		# The port state. Automatically started() when accessed for the first type ( via tc[port])
 		self._started = False
@@ -944,16 +1269,33 @@ class Port:
 		# In this case, _connectedPorts shall be empty.
 		self._mappedTsiPort = None
 		
-		# a pipe ((r, w) fds) to notify that the port has something new in it.
-		# Enables to implement a poll/select on multiple ports in alt()
-		self._notifier = None
+		# The notifiers (of the test components currently in alt() on this port)
+		# to signal when a new message is enqueued.
+		# A notifier may be registered multiple times (nested alt()).
+		self._listeners = []
+	
+	def _registerListener(self, notifier):
+		self._lock()
+		self._listeners.append(notifier)
+		self._unlock()
+	
+	def _unregisterListener(self, notifier):
+		self._lock()
+		try:
+			self._listeners.remove(notifier)
+		except ValueError:
+			pass
+		self._unlock()
 	
-	def getNotifierFd(self):
+	def _notifyListeners(self):
 		"""
-		Returns the (pipe) fd to watch to be notified
-		of a new message on this port.
+		Called with the port lock held.
 		"""
-		return self._notifier[0]
+		for notifier in self._listeners:
+			try:
+				notifier.notify()
+			except Exception, e:
+				logInternal("port %s: async notifier error %s", self, e)
 	
 	def _lock(self):
 		self._mutex.acquire()
@@ -977,20 +1319,51 @@ class Port:
 	def _isConnectedTo(self, port):
 		return port in self._connectedPorts
 	
+	def _hasPendingMessages(self):
+		"""
+		Returns True if alt() has some messages to analyze in this port
+		without waiting for a new one.
+		"""
+		return len(self._messageQueue) > 0
+	
 	def _enqueue(self, message, from_):
-#		logInternal("%s enqueuing message (started=%s)" % (str(self), str(self._started)))
+#		logInternal("%s enqueuing message (started=%s)", self, self._started)
 		self._lock()
 		if self._started:
-			self._messageQueue.append((message, from_))
-			try:
-				os.write(self._notifier[1], 'r')
-				logInternal("port %s: notifying a new message for reader on %s" % (self, self._notifier[0]))
-			except Exception, e:
-				logInternal("port %s: async notifier error %s" % (self, e))
-				pass
+			self._messageQueue.append((message, from_, _MessageArrivalCounter.next()))
+			self._notifyListeners()
 		# else not started: not enqueueing anything.
 		self._unlock()
 
+	def _peekMessage(self):
+		"""
+		Returns the oldest queued (message, from_, arrival number), or None.
+		
+		Not locked: only the test component owning the port consumes its messages,
+		and clear() replaces the queue instead of emptying it.
+		"""
+		try:
+			return self._messageQueue[0]
+		except IndexError:
+			return None
+	
+	def _popMessage(self, entry = None):
+		"""
+		Consumes the oldest queued message.
+		If entry is provided, only consumes it if it is still the oldest
+		one (the queue may have been cleared since it was peeked).
+		
+		@rtype: tuple (message, from_, arrival number), or None
+		@returns: the consumed entry, or None if nothing was consumed
+		"""
+		self._lock()
+		try:
+			if self._messageQueue and (entry is None or self._messageQueue[0] is entry):
+				return self._messageQueue.popleft()
+			return None
+		finally:
+			self._unlock()
+
 
 	# TTCN-3 compliant operations
 	def send(self, message, to = None):
@@ -1007,10 +1380,12 @@ class Port:
 		@returns: True if the message has been sent (i.e. if the port has not been connected or mapped),
 		          False if not (port stopped)
 		"""
-		logInternal("sending a message through %s" % str(self))
+		logInternal("sending a message through %s", self)
 		if self._started:
-			messageToLog = _expandTemplate(message)
-			messageToSend = _encodeTemplate(message)
+			# Single pass valuation: the expanded template is only needed for logging.
+			# A message enqueued to connected ports is a value: it must not share
+			# its dicts and lists with the sent template, which may be modified later.
+			(messageToLog, messageToSend) = _valuateTemplate(message, expand = TestermanTCI.isLogLevelEnabled('event'), copyValues = not self._mappedTsiPort)
 
 			# Mapped port first.
 			if self._mappedTsiPort:
@@ -1063,15 +1438,10 @@ class Port:
 		"""
 		self._lock()
 		if not self._started:
-			self._messageQueue = []
+			self._messageQueue = collections.deque()
 			self._started = True
-			try:
-				self._notifier = os.pipe()
-			except Exception, e:
-				self._unlock()
-				raise Exception("Unable to start port %s: %s" % (str(self), e))
 		self._unlock()
-		logInternal("%s started" % str(self))
+		logInternal("%s started", self)
 
 	def stop(self):
 		"""
@@ -1081,23 +1451,17 @@ class Port:
 		self._lock()
 		if self._started:
 			self._started = False
-			try:
-				os.close(self._notifier[0])
-				os.close(self._notifier[1])
-			except:
-				pass
-			self._notifier = None
 		self._unlock()			
-		logInternal("%s stopped" % str(self))
+		logInternal("%s stopped", self)
 
 	def clear(self):
 		"""
 		Purges the internal queue, without stopping the port.
 		"""
 		self._lock()
-		self._messageQueue = []
+		self._messageQueue = collections.deque()
 		self._unlock()
-		logInternal("%s cleared" % str(self))
+		logInternal("%s cleared", self)
 
 	def RECEIVE(self, template = None, value = None, sender = None, from_ = None):
 		"""
@@ -1189,6 +1553,8 @@ class TestCase:
 		self._name = self.__class__.__name__
 		# This is a list of the ptc created by/within this testcase.
 		self._ptcs = []
+		# ... and the number of them that are still alive()
+		self._alivePtcCount = 0
 		self._stopOnFailure = False
 		logTestcaseCreated(str(self), role = self._role)
 
@@ -1214,6 +1580,17 @@ class TestCase:
 	def _unlock(self):
 		self._mutex.release()
 
+	def _updateAlivePtcCount(self, delta):
+		self._lock()
+		self._alivePtcCount += delta
+		self._unlock()
+
+	def _getAlivePtcCount(self):
+		self._lock()
+		ret = self._alivePtcCount
+		self._unlock()
+		return ret
+
 	def _createMtc(self):
 		"""
 		Creates the MTC component.
@@ -1284,7 +1661,11 @@ class TestCase:
 		"""
 		tc = TestComponent(name, alive)
 		tc._testcase = self
+		self._lock()
 		self._ptcs.append(tc)
+		# A newly created PTC is alive
+		self._alivePtcCount += 1
+		self._unlock()
 		# Remove state events that are no longuer relevant - "ALL_DONE_EVENT" is still, however.
 		_removeSystemEvent(TestComponent._ALL_KILLED_EVENT, None)
 		return tc
@@ -1343,7 +1724,7 @@ class TestCase:
 			self._finalize()
 		except Exception:
 			# Nothing particular to do in case of an error here...
-			logInternal("Exception while finalizing testcase:\n%s" % getBacktrace())
+			logInternal("Exception while finalizing testcase:\n%s", getBacktrace())
 
 		# Final static connection reset
 		TestermanSA.triSAReset()
@@ -1355,8 +1736,13 @@ class TestCase:
 		_AtsResults.append(dict(testcase_id = str(self), verdict = self._mtc._verdict))		
 		logTestcaseStopped(str(self), verdict = self._mtc._verdict, description = self._description)
 
+		logInternal("Component executor statistics: %s", _getComponentExecutor().getStatistics())
+		logInternal("Decode cache statistics: %s", _getDecodeCacheStatistics())
+
 		# Make sure we clean the local contexts
 		_clearLocalContexts()
+		# ... and release the templates compiled during this testcase
+		_purgeTemplateMatcherCache()
 
 		# Now check if we can continue or stop here if the ATS has been cancelled
 		if _isAtsCancelled():
@@ -1592,7 +1978,7 @@ def connect(portA, portB):
 	"""
 	# Does not reconnect connected ports:
 	if portA._isConnectedTo(portB): # The reciprocity should be True, too (normally)
-		logInternal("Multiple connection attempts between %s and %s. Discarding." % (str(portA), str(portB)))
+		logInternal("Multiple connection attempts between %s and %s. Discarding.", portA, portB)
 		return
 
 	# TTCN-3 restriction: "A port that is mapped shall not be connected"
@@ -1809,10 +2195,17 @@ def alt(alternatives):
 	- the associated branch actions, as the remaining list of elements in the alternative list.
 	  They must be lambda or callable() to be executed only if the branch is selected.
 	
+	Snapshots:
+	on each pass, only the messages that arrived before the pass started are analyzed,
+	in their arrival order (whatever the port they arrived on), so that a burst of messages
+	is analyzed in a single pass.
+	The legacy implementation, analyzing at most one message per port per pass
+	(in no particular port order), can be restored with use_legacy_alt().
+	
 	This implementation is not TTCN-3 compliant because:
-	- it does not take a snapshot at each iteration, meaning that messages may arrive on port2 just
-	  before analyzing it, while something arrives on port1 just after, leading to incorrect alt branching
-	  in the case of port1.RECEIVE() is before port2.RECEIVE() (in "order of appearance")
+	- the snapshot messages are analyzed in arrival order, then against the alternatives in
+	  order of appearance, instead of checking each alternative in order of appearance
+	  against the snapshot
 	- altstep-branches are not implemented. Only timeout-, receiving-, killed-, done- branches are.
 	- there is no mechanism to trigger an exception if the alt is completely blocked.
 	  As a consequence, the user must carefully design his/her alt() (especially with watchdog timers)
@@ -1836,8 +2229,10 @@ def alt(alternatives):
 	"""
 	# Algorithm:
 	# 1. First, we group alternatives per port (ordered).
-	# 2. Then, we look messages port by port:
-	#  2.1 Pop the first message in its queue (if any)
+	# 2. Then, we look at the system queue, then at the messages of the other ports in arrival order,
+	#    up to the last message that arrived when the pass started (snapshot):
+	#    (legacy mode: port by port, one message per port)
+	#  2.1 Pop the message from its queue
 	#  2.2 Compare it to the templates contained in its associated alternative's conditions, once we checked that the guard was satisfied
 	#  2.3 If we have a template match (the first one for the list of alternatives)
 	#      - select the branch: execute the associated actions. If an action evaluates to RETURN, stop executing further actions,
@@ -1845,7 +2240,8 @@ def alt(alternatives):
 	#        If we have no other actions to execute, leave the alt.
 	#      If this is a mismatch, do nothing, just compare to the next alternative's conditions.
 	#  2.4 in any case (even if we leave or repeat the alt, match or mismatch), the current popped message is consumed.
-	# 3. Once we looped once without a match, repeat from 2 until we have a match.
+	# 3. Once we looped once without a match, repeat from 2 until we have a match
+	#    (waiting for a new message if no message arrived in the meantime).
 	# 
 	# The system queue is handled differently:
 	# - unmatched messages are not consumed, but kept in the queue. This is not the case for "userland ports".
@@ -1860,16 +2256,17 @@ def alt(alternatives):
 	for a in getLocalContext().getDefaultAlternatives():
 		alternatives.append(a)
 
-	logInternal("Number of alternatives for this alt: %s" % str(len(alternatives)))
+	logInternal("Number of alternatives for this alt: %s", len(alternatives))
 	
-#	logInternal("Entering alt():\n%s" % alternatives)
+#	logInternal("Entering alt():\n%s", alternatives)
 	
 	# Step 1. Preparation.
 	# Alternatives per port
 	portAlternatives = {}
-	# And prepare a list of watched fds (pipes) to be notified as soon as a
+	# And register our notifier on the watched ports to be notified as soon as a
 	# port has something new in it.
-	watchedPortsFds = []
+	notifier = getLocalContext().getNotifier()
+	watchedPorts = []
 	
 	systemQueueWatched = False
 		
@@ -1888,214 +2285,225 @@ def alt(alternatives):
  		if not portAlternatives.has_key(condition.port) and condition.port._started:
 			portAlternatives[condition.port] = []
 			if condition.port is _getSystemQueue():
-				# Register ourselves as a listener on the system port
-				condition.port._registerListener()
 				systemQueueWatched = True
-			watchedPortsFds.append(condition.port.getNotifierFd())
+			condition.port._registerListener(notifier)
+			watchedPorts.append(condition.port)
 		portAlternatives[condition.port].append((guard, condition, actions))
 	
-	logInternal("alt: tc %s is watching the following fds: %s - watching the system queue: %s" % (getLocalContext().getTc(), watchedPortsFds, systemQueueWatched))
+	logInternal("alt: tc %s is watching %s ports - watching the system queue: %s", getLocalContext().getTc(), len(watchedPorts), systemQueueWatched)
 
 	# Step 2.
 	matchedInfo = None # tuple (guard, template, asValue, actions, message, decodedMessage)
 	repeat = False
+	systemQueue = _getSystemQueue()
+	userPorts = filter(lambda x: x is not systemQueue, watchedPorts)
+	# The system queue enqueued count when it was analyzed without a match:
+	# no need to analyze it again until a new system event is posted
+	systemQueueAnalyzedCount = None
 	try:
-		while (not matchedInfo) or repeat:
-			# Reset info in case of a repeat
-			matchedInfo = None
-			repeat = False
-
-			for (port, alternatives) in portAlternatives.items():
-
-				# Special handling for system queue: messages are NOT popped if not matching anything.
-				# Instead, they are kept in the queue for other consumers (other TCs, or in a next alt()
-				# in the current TC).
-				if port is _getSystemQueue():
-					port._lock()
-					try:
-						# Make sure that we don't loop forever here because we did not remove our notification
-						# from the notification pipe.
-						port._acknowledgeNotification()
-						for (message, from_) in port._messageQueue:
-							# We ignore the 'from' in systemQueue
-							for (guard, condition, actions) in alternatives:
-								# Guard is ignored for internal messages (we shouldn't have one, anyway)
-	
-								# Special message matches (NB: we're suppose to have only dict messages in the system queue)
-								if isinstance(message, dict) and condition.template['event'].startswith('any.'):
-									# "Wildcard"-based match: we do not expect this exact event in the queue.
-									# Instead, we match any 'ressembling' event.
-									if condition.template['event'] == 'any.c.done':
-										# We match is we have any 'done' in our queue
-										if message.get('event') == 'done':
-											match = True
-									elif condition.template['event'] == 'any.c.killed':
-										# We match is we have any 'killed' in our queue
-										if message.get('event') == 'killed':
-											match = True
-	
-									if match:
-										matchedInfo = (guard, condition, actions, message, None) # None: decodedMessage
-										# In this case, we do NOT consume the message: left for
-										# other ptc.KILLED, or other any component killed, ...
-										break
-
-								# Standard system message matches - consumed if matched
-								else:
-									# Ignore the decoded message: must be the same as encoded for internal events.
-									(match, _, _) = templateMatch(message, condition.template)
-									if match:
-										matchedInfo = (guard, condition, actions, message, None) # None: decodedMessage
-										# Consume the message
-										port._remove(message, from_)
-										# Exit the port alternative loop, with matchedInfo
-										break
-	
-							if matchedInfo:
-								# Exit the loop on messages directly.
-								break
-					except Exception, e:
-						port._unlock()
-						logInternal("Exception while analyzing system events: %s" % str(e))
-						raise
-					port._unlock()
-					if matchedInfo:
-						(guard, condition, actions, message, _) = matchedInfo
-						# OK, we have some actions to trigger (outside the critical section)
-						# According to the event type we matched, log it (or not)
-						# system queue events are always formatted as a dict { 'event': string } and 'ptc' or 'timer' dependending on the event.
-						branch = condition.template['event']
-						if branch == 'timeout':
-							# timeout-branch selected
-							logTimeoutBranchSelected(id_ = str(condition.template['timer']))
-						elif branch == 'done':
-							# done-branch selected
-							logDoneBranchSelected(id_ = str(condition.template['ptc']))
-						elif branch == 'killed':
-							# killed-branch selected
-							logKilledBranchSelected(id_ = str(condition.template['ptc']))
-						elif branch == 'all.c.done':
-							# all component-done branch selected
-							logDoneBranchSelected(id_ = 'all')
-						elif branch == 'all.c.killed':
-							# all component-killed branch selected
-							logKilledBranchSelected(id_ = 'all')
-						elif branch == 'any.c.done':
-							# any component-done branch selected
-							logDoneBranchSelected(id_ = 'any')
-						elif branch == 'any.c.killed':
-							# all component-killed branch selected
-							logKilledBranchSelected(id_ = 'any')
-						else:
-							# Other system messages are for internal purpose only and does not have TTCN-3 branch equivalent
-							logInternal('system event received in system queue: %s' % repr(condition.template))
-
-						for action in actions:
-							# Minimal command management for internal messages
-							if callable(action):
-								action = action()
-							if action == REPEAT:
-								repeat = True
-								break
-							elif action == RETURN:
+		try:
+			while (not matchedInfo) or repeat:
+				if repeat:
+					# The actions may have modified the templates in place:
+					# their compiled forms must be checked again
+					for alternatives in portAlternatives.values():
+						for (guard, condition, actions) in alternatives:
+							condition._resetMatcher()
+				# Reset info in case of a repeat
+				matchedInfo = None
+				repeat = False
+
+				if _LegacyAlt:
+					ports = portAlternatives.keys()
+				elif systemQueueWatched and systemQueue._enqueuedCount != systemQueueAnalyzedCount:
+					ports = [ systemQueue ]
+				else:
+					ports = []
+
+				for port in ports:
+					alternatives = portAlternatives[port]
+
+					# Special handling for system queue: messages are NOT popped if not matching anything.
+					# Instead, they are kept in the queue for other consumers (other TCs, or in a next alt()
+					# in the current TC).
+					if port is systemQueue:
+						(alternative, enqueuedCount) = port._matchAlternatives(alternatives)
+						if alternative:
+							(guard, condition, actions) = alternative
+							matchedInfo = (guard, condition, actions, condition.template, None) # None: decodedMessage
+						if matchedInfo:
+							# OK, we have some actions to trigger (outside the critical section)
+							# According to the event type we matched, log it (or not)
+							# system queue events are always formatted as a dict { 'event': string } and 'ptc' or 'timer' dependending on the event.
+							branch = condition.template['event']
+							if branch == 'timeout':
+								# timeout-branch selected
+								logTimeoutBranchSelected(id_ = str(condition.template['timer']))
+							elif branch == 'done':
+								# done-branch selected
+								logDoneBranchSelected(id_ = str(condition.template['ptc']))
+							elif branch == 'killed':
+								# killed-branch selected
+								logKilledBranchSelected(id_ = str(condition.template['ptc']))
+							elif branch == 'all.c.done':
+								# all component-done branch selected
+								logDoneBranchSelected(id_ = 'all')
+							elif branch == 'all.c.killed':
+								# all component-killed branch selected
+								logKilledBranchSelected(id_ = 'all')
+							elif branch == 'any.c.done':
+								# any component-done branch selected
+								logDoneBranchSelected(id_ = 'any')
+							elif branch == 'any.c.killed':
+								# all component-killed branch selected
+								logKilledBranchSelected(id_ = 'any')
+							else:
+								# Other system messages are for internal purpose only and does not have TTCN-3 branch equivalent
+								logInternal('system event received in system queue: %r', condition.template)
+
+							action = _executeAltActions(actions)
+							if action == RETURN:
 								return
-						if repeat:
-							# Break the loop on system messages
+							repeat = (action == REPEAT)
+							# Break the loop on ports
 							break
 
-					else:
-						# no match, nothing to do.
-						pass
+						else:
+							# no match, nothing to do until a new system event is posted.
+							systemQueueAnalyzedCount = enqueuedCount
 
-				else:
-					# This is a normal port. We always consume the popped message, 
-					# support for RETURN and REPEAT "keywords" in actions, etc.
-					message = None
-					port._lock()
-					try:
-						if port._messageQueue:
-							# 2.1 Let's pop the first message in the queue (will be consumed whatever happens since not kept in queue)
-							# FIXME: flawn implementation: we shoud not consume only one message per port per pass.
-							# We should really take a "snapshot" (ie freezing ports) and considering timestamped messages...
-							(message, from_) = port._messageQueue[0]
-							port._messageQueue = port._messageQueue[1:]
-							# FIXME - must be hidden in the port class
-							try:
-								os.read(port._notifier[0], 1)
-							except:
-								pass
-					except Exception, e:
-						port._unlock()
-						logInternal("Exception while consuming standard port message: %s" % str(e))
-						raise e
-					port._unlock()
-					if message is not None: # And what is we want to send "None" ? should be considered as a non-message, ie a non-send ?
-						# 2.2: For each existing satisfied conditions for this port (x[0] is the guard)
-						for (guard, condition, actions) in filter(lambda x: (x[0] and x[0]()) or (x[0] is None), alternatives):
-							# Only try to match messages from the expected sender
-							if condition.from_ and condition.from_ != from_:
-								logInternal("not matching condition: not received from the expected address (expected: %s, got: %s)" % (condition.from_, from_))
-								match = False
-								# In this case, we don't even attempt to decode the message. So we assign a default decoded one for logging purpose
-								decodedMessage = message
-							else:
-								(match, decodedMessage, mismatchedPath) = templateMatch(message, condition.template)
-							# Now handle the matching result
-							if not match:
-								# 2.3 - Mismatch, we should log it.
-								logTemplateMismatch(tc = port._tc, port = port._name, message = decodedMessage, template = _expandTemplate(condition.template), encodedMessage = message, mismatchedPath = mismatchedPath)
-							else:
-								# 2.3 - Match
-								matchedInfo = (guard, condition, actions, message, decodedMessage)
-								logTemplateMatch(tc = port._tc, port = port._name, message = decodedMessage, template = _expandTemplate(condition.template), encodedMessage = message)
-								# Store the message as value, if needed
-								if condition.value:
-									_setValue(condition.value, decodedMessage)
-								if condition.sender:
-									_setSender(condition.sender, from_)
-								# Then execute actions
-								for action in actions:
-									if callable(action):
-										action = action()
-									if action == REPEAT:
-										repeat = True
-										break
-									elif action == RETURN:
-										return
-								# Break the loop on guard-validated alternatives for this port
+					else:
+						# Legacy mode only. This is a normal port. We always consume the popped message, 
+						# support for RETURN and REPEAT "keywords" in actions, etc.
+						# 2.1 Let's pop the first message in the queue (will be consumed whatever happens since not kept in queue)
+						entry = port._popMessage()
+						if entry:
+							(message, from_, _) = entry
+							matchedInfo = _matchAltMessage(port, alternatives, message, from_)
+							if matchedInfo:
+								action = _executeAltActions(matchedInfo[2])
+								if action == RETURN:
+									return
+								repeat = (action == REPEAT)
+								# Let's break the main loop on ports
 								break
+
+				if not matchedInfo and not _LegacyAlt:
+					# Snapshot mode: analyze the messages arrived on the user ports until now, oldest first
+					snapshot = _MessageArrivalCounter.next()
+					while True:
+						# Let's find the port with the oldest message
+						oldestPort = None
+						oldestEntry = None
+						for port in userPorts:
+							entry = port._peekMessage()
+							if entry and entry[2] < snapshot and (oldestEntry is None or entry[2] < oldestEntry[2]):
+								oldestPort = port
+								oldestEntry = entry
+						if not oldestPort:
+							# Snapshot completed
+							break
+						# 2.1 Consume it, whatever happens
+						if not oldestPort._popMessage(oldestEntry):
+							# The port has been cleared in the meantime
+							continue
+						(message, from_, _) = oldestEntry
+						matchedInfo = _matchAltMessage(oldestPort, portAlternatives[oldestPort], message, from_)
 						if matchedInfo:
-							# We left the loop on guard-validated alternatives for this port because of a match,
-							# Let's break the main loop on ports
+							action = _executeAltActions(matchedInfo[2])
+							if action == RETURN:
+								return
+							repeat = (action == REPEAT)
 							break
+
+				# Now wait until another message arrives on one of our watched ports (if we have to wait,
+				# i.e. if we have no other queued messages to analyze).
+				# On REPEAT, the ports (including the system queue, whose events may
+				# have been posted before we registered our notifier) must be analyzed
+				# again first: we only wait once a whole pass did not match anything.
+				if (not matchedInfo) and not filter(lambda x: x._hasPendingMessages(), watchedPorts):
+					try:
+						logInternal("alt: tc %s is waiting for new messages", getLocalContext().getTc())
+						notifier.wait()
+					except select.error, e:
+						if e.args[0] == 4:
+							# Interrupted system call -> SIGINT, stop() the TC
+							stop()
 						else:
-							# No match for this port: nothing to do
-							pass
-					else:
-						# no message for this port: nothing to do
-						pass
+							raise
+		except Exception, e:
+			logInternal("exception in alt(): %s (%r)", e, e)
+			raise
+	finally:
+		# Also executed on RETURN
+		for port in watchedPorts:
+			port._unregisterListener(notifier)
 
-			# Now wait until another message arrives on one of our watched ports (if we have to wait)
-			if (not matchedInfo) or repeat:
-				try:
-					logInternal("alt: tc %s is renewing its subscription on the following fds: %s" % (getLocalContext().getTc(), watchedPortsFds))
-					r, w, e = select.select(watchedPortsFds, [], [], 1)
-				except select.error, e:
-					if e.args[0] == 4:
-						# Interrupted system call -> SIGINT, stop() the TC
-						stop()
-					else:
-						raise
-					
-	#			if r: logInternal("activity detected on port(s) %s" % r)
-	except Exception, e:
-		logInternal("exception in alt(): %s (%s)" % (str(e), repr(e)))
-		if systemQueueWatched:
-			_getSystemQueue()._unregisterListener()
-		raise e
-
-	if systemQueueWatched:
-		_getSystemQueue()._unregisterListener()
+def _matchAltMessage(port, alternatives, message, from_):
+	"""
+	Matches a message popped from a (non-system) port against the port alternatives
+	whose guard is satisfied, in order of appearance, logging the mismatches and the match.
+	On match, stores the message and the sender as value()/sender(), if requested.
+	
+	@rtype: tuple (guard, condition, actions, message, decodedMessage), or None
+	@returns: the matched alternative info, or None if no alternative matched.
+	"""
+	# Each codec decodes the message (parts) at most once for all the alternatives
+	_openDecodeCache()
+	try:
+		return _matchAltMessageAlternatives(port, alternatives, message, from_)
+	finally:
+		_closeDecodeCache()
+
+def _matchAltMessageAlternatives(port, alternatives, message, from_):
+	# The decoded message and the mismatched path are only built if we need them
+	logMatch = TestermanTCI.isLogLevelEnabled('match')
+	logMismatch = TestermanTCI.isLogLevelEnabled('mismatch')
+	# 2.2: For each existing satisfied conditions for this port (x[0] is the guard)
+	for (guard, condition, actions) in filter(lambda x: (x[0] and x[0]()) or (x[0] is None), alternatives):
+		# Only try to match messages from the expected sender
+		if condition.from_ and condition.from_ != from_:
+			logInternal("not matching condition: not received from the expected address (expected: %s, got: %s)", condition.from_, from_)
+			match = False
+			# In this case, we don't even attempt to decode the message. So we assign a default decoded one for logging purpose
+			decodedMessage = message
+			mismatchedPath = None
+		else:
+			(match, decodedMessage, mismatchedPath) = condition.match(message, decode = logMatch or logMismatch or bool(condition.value))
+		# Now handle the matching result
+		if not match:
+			# 2.3 - Mismatch, we should log it.
+			if logMismatch:
+				logTemplateMismatch(tc = port._tc, port = port._name, message = decodedMessage, template = _expandTemplate(condition.template), encodedMessage = message, mismatchedPath = mismatchedPath)
+		else:
+			# 2.3 - Match
+			if logMatch:
+				logTemplateMatch(tc = port._tc, port = port._name, message = decodedMessage, template = _expandTemplate(condition.template), encodedMessage = message)
+			# Store the message as value, if needed
+			if condition.value:
+				_setValue(condition.value, decodedMessage)
+			if condition.sender:
+				_setSender(condition.sender, from_)
+			return (guard, condition, actions, message, decodedMessage)
+	return None
+
+def _executeAltActions(actions):
+	"""
+	Executes the actions of a selected branch, until one of them
+	evaluates to REPEAT or RETURN.
+	
+	@rtype: REPEAT, RETURN, or None
+	@returns: the control "keyword" that stopped the actions execution, if any.
+	"""
+	for action in actions:
+		if callable(action):
+			action = action()
+		if action == REPEAT or action == RETURN:
+			return action
+	return None
+
+# Set by use_legacy_alt()
+_LegacyAlt = False
 
 # Control "Keywords" for alt().
 # May be used as is directly, in a lambda, or returned from an altstep or a function called
@@ -2128,80 +2536,52 @@ class SystemQueue(Port):
 	system messages are handled in alt(), in particular with regards
 	to new message notifications.
 	
-	each alt() that are watching the system queue should register
-	a dedicated notifier (calling getNotifierFd(), the queue assign
-	a new notifier automatically per TLS),
+	each alt() that are watching the system queue registers
+	its test component notifier, as for any other port,
 	and whenever a new message arrives in the system queue, all
 	registered notifiers are notified.
+	
+	System events are always dicts { 'event': string } with a 'ptc' or
+	'timer' entry depending on the event, and are matched by identity
+	of their event and owning ptc/timer. So instead of a list of
+	events, the queue is an index of the number of pending events per
+	(event, ptc or timer), plus the number of pending events per event
+	(to match any component.done/killed without scanning the events).
 	"""
 	def __init__(self):
 		Port.__init__(self, tc = None, name = '__system_queue__')
-		self._pipes = []
-
-	def _registerListener(self):
-		pipe = getLocalContext().getSystemQueueNotifier()
-		self._lock()
-		if not pipe in self._pipes:
-			self._pipes.append(pipe)
-		self._unlock()
-		logInternal("system queue: tc %s registered as a listener (fd %s)" % (getLocalContext().getTc(), pipe[0]))
-		return pipe
-	
-	def getNotifierFd(self):
-		pipe = getLocalContext().getSystemQueueNotifier()
-		return pipe[0]
-	
-	def _unregisterListener(self):
-		pipe = getLocalContext().getSystemQueueNotifier()
-		self._lock()
-		try:
-			self._pipes.remove(pipe)
-		except:
-			pass
-		self._unlock()
-		getLocalContext().cleanSystemQueueNotifier()
-		logInternal("system queue: tc %s unregistered as a listener (fd %s)" % (getLocalContext().getTc(), pipe[0]))
-	
-	def _notifyListeners(self):
+		# Incremented on each enqueued message, so that alt() knows when
+		# the queue needs to be analyzed again
+		self._enqueuedCount = 0
+		# dict[(event, ptc or timer)] = number of pending events
+		self._events = {}
+		# dict[event] = number of pending events
+		self._eventCounts = {}
+
+	def _getEventKey(self, event):
+		return (event['event'], event.get('ptc', event.get('timer')))
+
+	def _hasPendingMessages(self):
 		"""
-		Notify current system queue listeners (writing something in their notification pipes).
+		Messages are not consumed from the system queue if they are not matched:
+		alt() always waits for a new one before analyzing the queue again.
 		"""
-		for p in self._pipes:
-			try:
-				os.write(p[1], 'r')
-				logInternal("system queue: notifying a new message for reader on %s" % (p[0]))
-			except Exception, e:
-				logInternal("system queue: async notifier error %s" % (e))
-				pass
+		return False
 
 	def _enqueue(self, message, from_):
 		"""
-		The system queue implementation for enqueue is to enqueue the message,
-		then send a notification through the notifier pipe only if
+		The system queue implementation for enqueue is to enqueue the message
+		(even if not started), then notify all the registered listeners.
 		"""
-		logInternal("system queue: enqueuing message from %s" % (str(from_)))
+		logInternal("system queue: enqueuing message from %s", from_)
+		key = self._getEventKey(message)
 		self._lock()
-		self._messageQueue.append((message, from_))
+		self._events[key] = self._events.get(key, 0) + 1
+		self._eventCounts[key[0]] = self._eventCounts.get(key[0], 0) + 1
+		self._enqueuedCount += 1
 		self._notifyListeners()
 		self._unlock()
 
-	def _acknowledgeNotification(self):
-		"""
-		To be called by a listener when it acknowledges that
-		it is aware that new messages where received in the system queue.
-		Technically, this purges its notification pipe to avoid an overflow
-		in the long run.
-		"""
-		pipe = getLocalContext().getSystemQueueNotifier()
-		try:
-			f = pipe[0]
-			r, w, e = select.select([f], [], [], 0)
-			if f in r:
-				os.read(f, 1000)
-				logInternal("system queue: tc %s acknowledged new message notification on fd %s" % (getLocalContext().getTc(), f))
-		except:
-			pass
-	
 	def _remove(self, message, from_):
 		"""
 		Consumes a particular message from the system queue.
@@ -2213,12 +2593,74 @@ class SystemQueue(Port):
 		instead of actual triggers.
 		"""
 		self._lock()
-		try:
-			self._messageQueue.remove((message, from_))
-		except ValueError:
+		self._consume(self._getEventKey(message))
+		self._unlock()
+
+	def _consume(self, key):
+		"""
+		Called with the lock held.
+		"""
+		count = self._events.get(key)
+		if not count:
 			# Not in queue
-			pass
+			return
+		if count == 1:
+			del self._events[key]
+		else:
+			self._events[key] = count - 1
+		count = self._eventCounts[key[0]]
+		if count == 1:
+			del self._eventCounts[key[0]]
+		else:
+			self._eventCounts[key[0]] = count - 1
+
+	def _matchAlternatives(self, alternatives):
+		"""
+		Looks for the first alternative, in order of appearance, whose
+		condition is satisfied by a pending event, and consumes the matched event
+		(except for any component conditions, whose events are left
+		for other ptc.DONE/KILLED or other any component conditions).
+		Guards are ignored for internal messages (we shouldn't have one, anyway).
+		
+		@type  alternatives: list of (guard, condition, actions)
+		@param alternatives: the system queue alternatives of an alt()
+		
+		@rtype: tuple ((guard, condition, actions) or None, integer)
+		@returns: the matched alternative, if any, and the enqueued count
+		at the time the queue was analyzed.
+		"""
+		self._lock()
+		try:
+			for alternative in alternatives:
+				template = alternative[1].template
+				event = template['event']
+				if event == 'any.c.done':
+					# "Wildcard"-based match: we match if we have any 'done' in our queue
+					if self._eventCounts.get('done'):
+						return (alternative, self._enqueuedCount)
+				elif event == 'any.c.killed':
+					if self._eventCounts.get('killed'):
+						return (alternative, self._enqueuedCount)
+				else:
+					key = self._getEventKey(template)
+					if self._events.get(key):
+						self._consume(key)
+						return (alternative, self._enqueuedCount)
+			return (None, self._enqueuedCount)
+		finally:
+			self._unlock()
+
+	def start(self):
+		"""
+		Starts the port (after purging its queue)
+		"""
+		self._lock()
+		if not self._started:
+			self._events = {}
+			self._eventCounts = {}
+			self._started = True
 		self._unlock()
+		logInternal("%s started", self)
 	
 
 _SystemQueue = SystemQueue()
@@ -2824,33 +3266,144 @@ def _encodeTemplate(template):
 	- valuates matching mechanisms, if possible
 	- if it's a function, call it (0-arity)
 	"""
+	return _valuateTemplate(template, expand = False)[1]
+
+# Leaves that are never valuated
+_StaticTemplateTypes = (basestring, int, long, float, bool, type(None))
+
+def _valuateTemplate(template, expand = True, copyValues = False):
+	"""
+	Valuates a template to send in a single pass, i.e. both
+	encodes it (see _encodeTemplate()) and, if expand is set, expands it
+	(see _expandTemplate()) for logging purposes.
+	Functions in the template are called only once, except within
+	CodecTemplates whose codec is a callable: these get their template
+	as is, their expanded form being built separately.
+
+	Subtrees that do not contain anything to call, encode or valuate
+	are not copied: the same object is returned in both forms,
+	unless copyValues is set.
+	
+	@type  template: any valid template
+	@param template: the template to valuate
+	@type  expand: bool
+	@param expand: if False, the expanded form is not built (None is returned instead)
+	@type  copyValues: bool
+	@param copyValues: if True, the dicts and lists of the encoded form are always
+	copies, i.e. the encoded form does not share them with the template
+	(as required for a value handed over to another test component)
+	
+	@rtype: tuple (expanded template, encoded template)
+	@returns: the expanded template (or None), and the encoded one.
+	"""
+	(expanded, encoded, static) = _valuate(template, expand, copyValues)
+	if not expand:
+		expanded = None
+	return (expanded, encoded)
+
+def _valuate(template, expand, copyValues = False):
+	"""
+	_valuateTemplate() implementation.
+	
+	@rtype: tuple (expanded template, encoded template, bool)
+	@returns: the expanded template (or None if not expand), the encoded one,
+	and True if the template is static (i.e. returned as is in both forms,
+	except for the copied dicts and lists of the encoded form if copyValues is set).
+	"""
+	if isinstance(template, _StaticTemplateTypes):
+		return (template, template, True)
+
 	if callable(template):
-		template = template()
+		(expanded, encoded, static) = _valuate(template(), expand, copyValues)
+		return (expanded, encoded, False)
 	
 	if isinstance(template, CodecTemplate):
-		return template.encode()
+		if callable(template._codec):
+			# The codec function gets the template as is, and is responsible
+			# for its valuation: the logged form is the one from getTemplate(),
+			# as for any other template proxy.
+			if expand:
+				expanded = template.getTemplate()
+			else:
+				expanded = None
+			return (expanded, template._codec(template._template), False)
+		(expanded, encoded, static) = _valuate(template._template, expand, copyValues)
+		return (expanded, template._encode(encoded), False)
 
 	if isinstance(template, list):
-		ret = []
+		# The copies are only created on the first non-static element
+		# (from the first element for the encoded form, if copyValues is set)
+		expandedList = None
+		encodedList = None
+		if copyValues:
+			encodedList = []
+		static = True
+		i = 0
 		for e in template:
-			ret.append(_encodeTemplate(e))
-		return ret
+			(expanded, encoded, elementStatic) = _valuate(e, expand, copyValues)
+			if static:
+				if elementStatic:
+					if copyValues:
+						encodedList.append(encoded)
+					i += 1
+					continue
+				static = False
+				if not copyValues:
+					encodedList = template[:i]
+				if expand:
+					expandedList = template[:i]
+			encodedList.append(encoded)
+			if expand:
+				expandedList.append(expanded)
+		if static:
+			if copyValues:
+				return (template, encodedList, True)
+			return (template, template, True)
+		return (expandedList, encodedList, False)
 		
 	if isinstance(template, dict):
-		ret = {}
+		expandedDict = None
+		encodedDict = None
+		if copyValues:
+			encodedDict = {}
+		static = True
 		for k, v in template.items():
-			ret[k] = _encodeTemplate(v)
-		return ret
+			(expanded, encoded, elementStatic) = _valuate(v, expand, copyValues)
+			if copyValues:
+				encodedDict[k] = encoded
+			if elementStatic:
+				continue
+			if static:
+				static = False
+				if not copyValues:
+					encodedDict = template.copy()
+				if expand:
+					expandedDict = template.copy()
+			encodedDict[k] = encoded
+			if expand:
+				expandedDict[k] = expanded
+		if static:
+			if copyValues:
+				return (template, encodedDict, True)
+			return (template, template, True)
+		return (expandedDict, encodedDict, False)
 	
 	if isinstance(template, tuple):
-		return (template[0], _encodeTemplate(template[1]))
+		(expanded, encoded, static) = _valuate(template[1], expand, copyValues)
+		if static and len(template) == 2:
+			if copyValues:
+				return (template, (template[0], encoded), True)
+			return (template, template, True)
+		if expand:
+			expanded = (template[0], expanded)
+		return (expanded, (template[0], encoded), False)
 	
 	try:
 		# if the template is a matching mechanism, it may provide a value
-		return template.value()
+		return (template, template.value(), False)
 	except:
 		pass
-	return template
+	return (template, template, True)
 	
 
 def _expandTemplate(template):
@@ -2882,6 +3435,57 @@ def _expandTemplate(template):
 	return template
 
 
+################################################################################
+# Decode cache
+################################################################################
+
+# When a message is matched against several alternatives, their CodecTemplates
+# would decode the same message (or message part) again and again.
+# Within a decode cache scope, i.e. the evaluation of a single message in alt(),
+# the decoded messages are cached per codec and encoded message identity.
+# The cache keeps a reference to the encoded messages, so that their ids
+# cannot be reused by other objects while the scope is opened.
+
+class _DecodeCache:
+	def __init__(self):
+		# dict[(codec, id(encoded message))] = (encoded message, decoded message)
+		self.entries = {}
+		self.hits = 0
+		self.misses = 0
+
+# .cache: the current thread _DecodeCache, if a scope is opened
+_DecodeCacheLocal = threading.local()
+
+# Totals since the ATS start, updated when a scope is closed
+_DecodeCacheStatistics = { 'hits': 0, 'misses': 0 }
+_DecodeCacheStatisticsMutex = threading.Lock()
+
+def _openDecodeCache():
+	_DecodeCacheLocal.cache = _DecodeCache()
+
+def _closeDecodeCache():
+	cache = getattr(_DecodeCacheLocal, 'cache', None)
+	_DecodeCacheLocal.cache = None
+	if cache is not None and (cache.hits or cache.misses):
+		_DecodeCacheStatisticsMutex.acquire()
+		_DecodeCacheStatistics['hits'] += cache.hits
+		_DecodeCacheStatistics['misses'] += cache.misses
+		_DecodeCacheStatisticsMutex.release()
+
+def _getDecodeCache():
+	"""
+	@rtype: _DecodeCache, or None
+	@returns: the decode cache of the current scope, if any.
+	"""
+	return getattr(_DecodeCacheLocal, 'cache', None)
+
+def _getDecodeCacheStatistics():
+	_DecodeCacheStatisticsMutex.acquire()
+	ret = dict(_DecodeCacheStatistics)
+	_DecodeCacheStatisticsMutex.release()
+	return ret
+
+
 class CodecTemplate:
 	"""
 	This is a proxy template class.
@@ -2903,20 +3507,45 @@ class CodecTemplate:
 			# Recursive encoding:
 			# first encode what should be encoded within the template,
 			# then encode it
-			try:
-				(encodedMessage, summary) = TestermanCD.encode(self._codec, _encodeTemplate(self._template))
-			except Exception:
-				# This includes a CodecNotFound exception
-				raise TestermanException('Encoding error: could not encode message with codec %s:\n%s' % (self._codec, getBacktrace()))
-			else:
-				# Summary is FFU.
-				return encodedMessage
+			return self._encode(_encodeTemplate(self._template))
+	
+	def _encode(self, encodedTemplate):
+		"""
+		Encodes the template, whose inner parts have already been encoded,
+		with a standard codec.
+		"""
+		try:
+			(encodedMessage, summary) = TestermanCD.encode(self._codec, encodedTemplate)
+		except Exception:
+			# This includes a CodecNotFound exception
+			raise TestermanException('Encoding error: could not encode message with codec %s:\n%s' % (self._codec, getBacktrace()))
+		else:
+			# Summary is FFU.
+			return encodedMessage
 	
 	def getTemplate(self):
 		# recursive expansion
 		return _expandTemplate(self._template)
 		
 	def decode(self, encodedMessage):
+		"""
+		Decodes the message with the codec, or returns the message
+		already decoded by this codec within the current decode cache scope.
+		"""
+		cache = _getDecodeCache()
+		if cache is None:
+			return self._decode(encodedMessage)
+		key = (self._codec, id(encodedMessage))
+		entry = cache.entries.get(key)
+		if entry is not None:
+			cache.hits += 1
+			return entry[1]
+		cache.misses += 1
+		decodedMessage = self._decode(encodedMessage)
+		cache.entries[key] = (encodedMessage, decodedMessage)
+		return decodedMessage
+
+	def _decode(self, encodedMessage):
 		if callable(self._codec):
 			return self._codec(encodedMessage)
 		else:
@@ -2929,12 +3558,12 @@ class CodecTemplate:
 			except TestermanCD.CodecNotFoundException:
 				raise TestermanException('Decoding error: codec %s not found' % self._codec)
 			except Exception:
-				logInternal('Decoding error: could not decode message with codec %s:\n%s' % (self._codec, getBacktrace()))
+				logInternal('Decoding error: could not decode message with codec %s:\n%s', self._codec, getBacktrace())
 				# Unable to decode: leave the buffer as is - it will lead to a match error probably.
 				# Leaving it as is enables to convey the payload all along the flow for further analysis.
 				return encodedMessage
 			if decodedMessage is None:
-				logInternal('Decoding error: could not decode message with codec %s' % self._codec)
+				logInternal('Decoding error: could not decode message with codec %s', self._codec)
 				return encodedMessage
 			else:
 				# Summary if FFU.
@@ -2948,35 +3577,42 @@ class with_(CodecTemplate):
 # Template matching
 ################################################################################
 
-def templateMatch(message, template, initialPath = u'template'):
+def templateMatch(message, template, initialPath = u'template', decode = True):
 	"""
-	A simple wrapper over _templateMatch to catch possible internal exceptions.
+	A simple wrapper over the compiled template matchers to catch possible internal exceptions.
 
 	@type  message: any object
 	@param message: the encoded message, as received (may be structured, too)
 	@type  template: any object suitable for a template
 	@param template: the template to match. may contain references to coders and conditions. They are evaluated on time.
+	@type  initialPath: unicode
+	@param initialPath: the human readable path of the template, used to report mismatches
+	@type  decode: bool
+	@param decode: if False, the decoded message and the mismatched path are not built
+	               (the message and initialPath are returned instead). Only the matching status is relevant then.
 		
-	@rtype: (bool, object)
-	@returns: (a, b) where a is True if match, False otherwise, b is the decoded message (partially decoded in case of decoding error ?)
+	@rtype: (bool, object, unicode)
+	@returns: (a, b, c) where a is True if match, False otherwise, b is the decoded message (partially decoded in case of decoding error ?),
+	          c the mismatched path
 	"""
-	mismatchedPath = initialPath
 	try:
-		(ret, decodedMessage, mismatchedPath) = _templateMatch(message, template, initialPath)
+		return _getTemplateMatcher(template).match(message, initialPath, decode)
 	except Exception:
 		# Actually, this is for debug purposes
 		logUser("Exception while trying to match a template:\n%s" % getBacktrace())
-		return (False, message, mismatchedPath)
-	return (ret, decodedMessage, mismatchedPath)
+		return (False, message, initialPath)
 
 def match(message, template):
 	"""
 	TTCN-3 match function.
 	"""
-	ret, decodedMessage, mismatchedPath = templateMatch(message, template)
+	logMatch = TestermanTCI.isLogLevelEnabled('match')
+	logMismatch = TestermanTCI.isLogLevelEnabled('mismatch')
+	ret, decodedMessage, mismatchedPath = templateMatch(message, template, decode = logMatch or logMismatch)
 	if not ret:
-		logTemplateMismatch(tc = getLocalContext().getTc(), port = "", message = decodedMessage, template = _expandTemplate(template), encodedMessage = message, mismatchedPath = mismatchedPath)
-	else:
+		if logMismatch:
+			logTemplateMismatch(tc = getLocalContext().getTc(), port = "", message = decodedMessage, template = _expandTemplate(template), encodedMessage = message, mismatchedPath = mismatchedPath)
+	elif logMatch:
 		logTemplateMatch(tc = getLocalContext().getTc(), port = "", message = decodedMessage, template = _expandTemplate(template), encodedMessage = message)
 	return ret
 
@@ -2998,226 +3634,615 @@ def _templateMatch(message, template, path):
 	          b the decoded message (same type as @param message),
 	          path is the last attempted template path before a mismatch. Undetermined if a == True.
 	"""
+	return _getTemplateMatcher(template).match(message, path)
+
+def _is_any_or_none(template):
+	"""
+	Returns True if the template is a any_or_none behind a extract, codec template, etc
+	"""
+	if isinstance(template, any_or_none):
+		return True
+	elif isinstance(template, extract):
+		return _is_any_or_none(template._template)
+	elif isinstance(template, CodecTemplate):
+		return _is_any_or_none(template.getTemplate())
+	else:
+		return False
+
+################################################################################
+# Compiled template matchers
+################################################################################
+
+# Templates are compiled once into a tree of specialized matchers, so that
+# matching a message does not have to probe each template node again
+# (callable(), isinstance() chains, etc).
+#
+# Compiled matchers are cached by template identity. Since templates
+# (dicts, lists) may be modified in place between two matches, a cached
+# matcher is only reused if the template still has the same structure,
+# i.e. the same contents, by identity, as when it was compiled
+# (see _TemplateMatcher.isValid()): this is cheaper than a match.
+# An alt() branch condition checks its cached matcher once per alt() pass,
+# since only the actions may have modified its template in the meantime.
+# The cache is purged at the end of each testcase, and when it grows too
+# large (the re module does the same with its compiled patterns).
+#
+# Each matcher provides a match(message, path, decode) method returning
+# the same (matched, decodedMessage, mismatchedPath) tuple as _templateMatch().
+# When decode is False, the decoded message and the mismatched path are not
+# built - the message and the path are returned as is, and structured
+# matchers stop on the first mismatch.
+
+_MaxCachedTemplateMatchers = 512
+_TemplateMatcherCache = {} # (template, matcher), indexed by id(template)
+# Missing dict entry marker, when checking a template structure
+_Missing = object()
+
+def _getTemplateMatcher(template):
+	"""
+	Returns the compiled matcher for template, compiling and caching it
+	if needed.
+	
+	@type  template: any object suitable for a template
+	@param template: the template to compile
+	
+	@rtype: _TemplateMatcher
+	@returns: the compiled template
+	"""
+	entry = _TemplateMatcherCache.get(id(template))
+	# We keep a reference to the template in the cache,
+	# so that its id cannot be reused while cached.
+	if entry is not None and entry[0] is template and entry[1].isValid():
+		return entry[1]
+	matcher = _compileTemplate(template)
+	if matcher.cacheable:
+		if len(_TemplateMatcherCache) >= _MaxCachedTemplateMatchers:
+			_TemplateMatcherCache.clear()
+		_TemplateMatcherCache[id(template)] = (template, matcher)
+	return matcher
+
+def _purgeTemplateMatcherCache():
+	_TemplateMatcherCache.clear()
+
+def _compileTemplate(template):
+	"""
+	Compiles a template to a matcher. Not cached.
+	"""
 	# Support for dynamic templates
 	if callable(template):
-		template = template()
+		return _DynamicTemplateMatcher(template)
+	return _compileStaticTemplate(template)
 
+def _compileStaticTemplate(template):
+	"""
+	Compiles a template to a matcher, without considering it
+	as a dynamic template if it is callable.
+	Dynamic templates are not called again once evaluated.
+	"""
 	# Match all
 	if template is None:
-		return (True, message, path)
-	
-	# CodecTemplate proxy template
+		return _AnyMatcher
 	if isinstance(template, CodecTemplate):
+		return _CodecTemplateMatcher(template)
+	if isinstance(template, dict):
+		return _DictMatcher(template)
+	if isinstance(template, tuple):
+		return _ChoiceMatcher(template)
+	if isinstance(template, list):
+		return _ListMatcher(template)
+	if isinstance(template, ConditionTemplate):
+		return _ConditionMatcher(template)
+	return _ValueMatcher(template)
+
+class _TemplateMatcher(object):
+	"""
+	Compiled template base class.
+	"""
+	# Worth caching, i.e. more expensive to compile than to match once ?
+	cacheable = False
+	# May the template be modified in place after its compilation ?
+	# (see isValid())
+	mutable = False
+
+	def isValid(self):
+		"""
+		Verifies that the template has not been modified in place since
+		its compilation, i.e. that its containers still have the same
+		contents, by identity. Only called for mutable matchers.
+		
+		@rtype: bool
+		@returns: True if the compiled matcher can still be used
+		"""
+		return True
+
+	def match(self, message, path, decode = True):
+		"""
+		@type  message: any python object, valid for a Testerman fully qualified message
+		@param message: the message to match
+		@type  path: unicode
+		@param path: the human readable path of the template in the top level template
+		@type  decode: bool
+		@param decode: build the decoded message and the mismatched path, or not
+		
+		@rtype: tuple (bool, object, unicode)
+		@returns: (a, b, path) as _templateMatch()
+		"""
+		raise NotImplementedError()
+
+class _AnyMatcherClass(_TemplateMatcher):
+	"""
+	None as a template: matches everything.
+	"""
+	def match(self, message, path, decode = True):
+		return (True, message, path)
+
+_AnyMatcher = _AnyMatcherClass()
+
+class _ValueMatcher(_TemplateMatcher):
+	"""
+	Simple types.
+	"""
+	def __init__(self, template):
+		self._template = template
+
+	def match(self, message, path, decode = True):
+		return (message == self._template, message, path)
+
+class _ConditionMatcher(_TemplateMatcher):
+	"""
+	Conditions: proxied templates.
+	"""
+	def __init__(self, template):
+		self._template = template
+
+	def match(self, message, path, decode = True):
+		# TODO: ConditionTemplate.match() should returns a decoded message, too
+		return (self._template.match(message, path), message, path)
+
+class _DynamicTemplateMatcher(_TemplateMatcher):
+	"""
+	Dynamic templates, evaluated on each match.
+	"""
+	cacheable = True
+
+	def __init__(self, template):
+		self._template = template
+		# The last evaluated template, with its compiled form, (template, matcher),
+		# so that functions returning a constant template are not recompiled each time
+		self._last = None
+
+	def match(self, message, path, decode = True):
+		template = self._template()
+		last = self._last
+		if last is not None and last[0] is template and (not last[1].mutable or last[1].isValid()):
+			matcher = last[1]
+		else:
+			matcher = _compileStaticTemplate(template)
+			self._last = (template, matcher)
+		return matcher.match(message, path, decode)
+
+class _CodecTemplateMatcher(_TemplateMatcher):
+	"""
+	CodecTemplate proxy template: the message is decoded before
+	being matched against the proxied template.
+	"""
+	cacheable = True
+	mutable = True
+
+	def __init__(self, template):
+		self._codecTemplate = template
+		self._codec = template._codec
+		self._proxiedTemplate = template._template
+		# The proxied template is not expanded, because it may contain other proxies
+		self._matcher = _compileTemplate(template._template)
+
+	def isValid(self):
+		return self._codecTemplate._template is self._proxiedTemplate and self._codecTemplate._codec is self._codec and (not self._matcher.mutable or self._matcher.isValid())
+
+	def match(self, message, path, decode = True):
 		# Let's see if we can first decode the message
 		try:
-			decodedMessage = template.decode(message)
+			decodedMessage = self._codecTemplate.decode(message)
 		except Exception, e:
-			logInternal("mismatch: unable to decode message part with codec %s: %s" % (template._codec, str(e) + getBacktrace()))
+			logInternal("mismatch: unable to decode message part with codec %s: %s", self._codecTemplate._codec, str(e) + getBacktrace())
 			return (False, message, path)
 		# TODO: handle decoding error here ?
-		logInternal("_templateMatch: message part %s decoded with codec %s: %s" % (path, template._codec, repr(decodedMessage)))
-		# Now match the decoded message against the proxied template (not expanded, because it should contain other proxies, if any)
-		return _templateMatch(decodedMessage, template._template, path)
-	
-	# Structured type: dict
-	# all entries in template dict must match ; extra message entries are ignored (but kept in "decoded dict")
-	if isinstance(template, dict):
+		logInternal("_templateMatch: message part %s decoded with codec %s: %r", path, self._codecTemplate._codec, decodedMessage)
+		# Now match the decoded message against the proxied template
+		return self._matcher.match(decodedMessage, path, decode)
+
+class _DictMatcher(_TemplateMatcher):
+	"""
+	Structured type: dict
+	All entries in template dict must match ; extra message entries are ignored (but kept in "decoded dict")
+	"""
+	cacheable = True
+	mutable = True
+
+	def __init__(self, template):
+		self._template = template
+		self._templateKeys = frozenset(template.keys())
+		# The template entries, as compiled
+		self._items = template.items()
+		# List of (key, matcher, optional), in template order.
+		# any value or none, ie '*', are not even checked
+		self._fields = []
+		for key, tmplt in template.items():
+			if tmplt is None:
+				continue
+			# if missing keys are omit(), that's ok.
+			optional = isinstance(tmplt, (omit, any_or_none, ifpresent)) or (isinstance(tmplt, extract) and isinstance(tmplt._template, (omit, any_or_none, ifpresent)))
+			self._fields.append((key, _compileTemplate(tmplt), optional))
+		self._mutableMatchers = [ matcher for (key, matcher, optional) in self._fields if matcher.mutable ]
+
+	def isValid(self):
+		template = self._template
+		if len(template) != len(self._items):
+			return False
+		for key, value in self._items:
+			if template.get(key, _Missing) is not value:
+				return False
+		for matcher in self._mutableMatchers:
+			if not matcher.isValid():
+				return False
+		return True
+
+	def match(self, message, path, decode = True):
 		if not isinstance(message, dict):
-			logInternal("mismatch: %s: expected a dict << %s >>, got << %s >>" % (path, repr(template), repr(message)))
+			logInternal("mismatch: %s: expected a dict << %r >>, got << %r >>", path, self._template, message)
 			return (False, message, path)
+
+		if not decode:
+			for key, matcher, optional in self._fields:
+				if key in message:
+					if not matcher.match(message[key], path, False)[0]:
+						return (False, message, path)
+				elif not optional:
+					return (False, message, path)
+			return (True, message, path)
+
 		# Existing entries in template dict must be matched (excepting 'omit' entries, which must not be present...)
 		decodedDict = {}
 		result = True
 		mismatchedPath = None
-		for key, tmplt in template.items():
-			# any value or none, ie '*'
-			if tmplt is None:
-				continue
-			if message.has_key(key):
-				(ret, decodedField, p) = _templateMatch(message[key], tmplt, u"%s.{%s}" % (path, unicode(key)))
+		for key, matcher, optional in self._fields:
+			if key in message:
+				(ret, decodedField, p) = matcher.match(message[key], u"%s.{%s}" % (path, unicode(key)))
 				decodedDict[key] = decodedField
 				if not ret:
-					logInternal("mismatch: %s: mismatched dict entry %s" % (path, unicode(key)))
+					logInternal("mismatch: %s: mismatched dict entry %s", path, unicode(key))
 					result = False
 					mismatchedPath = p
 					# continue to traverse the dict to perform "maximum" message decoding
-			elif isinstance(tmplt, (omit, any_or_none, ifpresent)) or (isinstance(tmplt, extract) and isinstance(tmplt._template, (omit, any_or_none, ifpresent))):
-				# if the missing keys are omit(), that's ok.
-				logInternal("omit: %s: omitted value %s not found, or optional value not found. OK." % (path, repr(key)))
-				continue
+			elif optional:
+				logInternal("omit: %s: omitted value %r not found, or optional value not found. OK.", path, key)
 			else:
 				# if it's something else, missing key, so no match.
-				logInternal("mismatch: %s: missing dict entry %s" % (path, repr(key)))
+				logInternal("mismatch: %s: missing dict entry %r", path, key)
 				result = False
 				mismatchedPath = path
 		# Now, add message keys that were not in template to the decoded dict
+		templateKeys = self._templateKeys
 		for key, m in message.items():
-			if not key in template:
+			if not key in templateKeys:
 				decodedDict[key] = m
 		return (result, decodedDict, mismatchedPath)
-	
-	# Structured type: tuple (choice, value)
-	# Must be the same choice name (ie tupe[0]) and matching value
-	if isinstance(template, tuple):
+
+class _ChoiceMatcher(_TemplateMatcher):
+	"""
+	Structured type: tuple (choice, value)
+	Must be the same choice name (ie tuple[0]) and matching value
+	"""
+	cacheable = True
+	mutable = True
+
+	def __init__(self, template):
+		self._template = template
+		self._matcher = None
+		if len(template) > 1:
+			self._matcher = _compileTemplate(template[1])
+
+	def isValid(self):
+		# The tuple itself cannot be modified, but its value can
+		return self._matcher is None or not self._matcher.mutable or self._matcher.isValid()
+
+	def match(self, message, path, decode = True):
 		if not isinstance(message, tuple):
-			logInternal("mismatch: %s: expected a tuple << %s >>, got << %s >>" % (path, repr(template), repr(message)))
+			logInternal("mismatch: %s: expected a tuple << %r >>, got << %r >>", path, self._template, message)
 			return (False, message, path)
 		# Check choice
-		if not message[0] == template[0]:
-			logInternal("mismatch: %s: tuple choices differ (message: %s, template %s)" % (path, repr(message[0]), repr(template[0])))
+		if not message[0] == self._template[0]:
+			logInternal("mismatch: %s: tuple choices differ (message: %r, template %r)", path, message[0], self._template[0])
 			return (False, message, path)
+		if self._matcher is None:
+			raise TestermanException("Invalid choice template: %s" % repr(self._template))
 		# Check value
-		(ret, decoded, path) = _templateMatch(message[1], template[1], u"%s.(%s)" % (path, unicode(message[0])))
+		if decode:
+			path = u"%s.(%s)" % (path, unicode(message[0]))
+		(ret, decoded, path) = self._matcher.match(message[1], path, decode)
+		if not decode:
+			return (ret, message, path)
 		return (ret, (message[0], decoded), path)
 
-	# Structured type: list
-	# This is a one-to-one exact match, ordered.
-	# as a consequence, the same number of elements in template and message are expected,
-	# unless we have some * in template.
-	if isinstance(template, list):
+class _ListMatcher(_TemplateMatcher):
+	"""
+	Structured type: list
+	This is a one-to-one exact match, ordered.
+	as a consequence, the same number of elements in template and message are expected,
+	unless we have some * in template.
+
+	Dynamic programming implementation over (message index, template index)
+	states: the result of each state is memoized, so that each template element
+	is matched at most once against each message element, whatever the number
+	of * and ifpresent() elements in the template.
+	Only * elements are recursive (the recursion depth is bound to their count).
+
+	In decode mode, the states only memoize the matching status and the mismatched
+	path; the decoded list is then built in a second pass, following the
+	decisions taken while matching.
+	"""
+	cacheable = True
+	mutable = True
+
+	def __init__(self, template):
+		self._template = template
+		# The template elements, as compiled
+		self._elements = list(template)
+		self._matchers = [ _compileTemplate(t) for t in template ]
+		self._mutableMatchers = [ matcher for matcher in self._matchers if matcher.mutable ]
+		self._anyOrNone = [ _is_any_or_none(t) for t in template ]
+		self._ifpresent = [ isinstance(t, ifpresent) for t in template ]
+
+	def isValid(self):
+		template = self._template
+		elements = self._elements
+		if len(template) != len(elements):
+			return False
+		for i in xrange(len(elements)):
+			if template[i] is not elements[i]:
+				return False
+		for matcher in self._mutableMatchers:
+			if not matcher.isValid():
+				return False
+		return True
+
+	def match(self, message, path, decode = True):
 		if not isinstance(message, list):
-			logInternal("mismatch: %s: expected a list" % path)
+			logInternal("mismatch: %s: expected a list", path)
 			return (False, message, path)
+		if not decode:
+			return (self._matches(message, 0, 0, path, {}), message, path)
+		logInternal("Trying to match %r with %r", message, self._template)
+		# dict[(mi, ti)] = (matched, mismatched path, first matching index after a *)
+		states = {}
+		# dict[(mi, ti)] = (matched, decoded message[mi]) for non-* template elements
+		elements = {}
+		(ret, mismatchedPath) = self._match(message, 0, 0, path, states, elements)
+		return (ret, self._getDecodedList(message, states, elements), mismatchedPath)
+	
+	def _matches(self, message, mi, ti, path, states):
+		"""
+		Returns True if message[mi:] matches template[ti:].
 		
-		# Wildcard (*) support:
-		# match(message, *|template) =
-		#  matched = False
-		#  i = 0
-		#  while not matched and message[i:]:
-		#   matched = match(message[i:], template)
-		(result, decodedList, path) = _templateMatch_list(message, template, path)
-		return (result, decodedList, path)
-
-	# conditions: proxied templates	
-	if isinstance(template, ConditionTemplate):
-		# TODO: ConditionTemplate.match() should returns a decoded message, too
-		return (template.match(message, path), message, path)
-	
-	# Simple types
-	return (message == template, message, path)
+		@type  states: dict[(mi, ti)] = bool
+		@param states: the already known results
+		"""
+		templateLength = len(self._matchers)
+		messageLength = len(message)
+		# The states visited before reaching a result, which all share this result
+		visited = []
+		while True:
+			result = states.get((mi, ti))
+			if result is not None:
+				break
+			# An empty template can only match an empty message
+			if ti == templateLength:
+				result = (mi == messageLength)
+				break
+			# The contrary is false. A non-empty template
+			# may match an empty message (wilcards, ifpresent elements, etc)
+			if mi == messageLength:
+				if self._anyOrNone[ti]:
+					result = True
+					break
+				elif self._ifpresent[ti]:
+					ti += 1
+					continue
+				result = False
+				break
 
-def _is_any_or_none(template):
-	"""
-	Returns True if the template is a any_or_none behind a extract, codec template, etc
-	"""
-	if isinstance(template, any_or_none):
-		return True
-	elif isinstance(template, extract):
-		return _is_any_or_none(template._template)
-	elif isinstance(template, CodecTemplate):
-		return _is_any_or_none(template.getTemplate())
-	else:
-		return False
+			visited.append((mi, ti))
+			if self._anyOrNone[ti]:
+				if ti + 1 == templateLength:
+					result = True
+					break
+				# message[i:] matches *|template[ti+1:] if message[i:] matches template[ti+1:],
+				# or if message[i+1:] matches *|template[ti+1:] (which may be already known)
+				result = False
+				for i in xrange(mi, messageLength):
+					if i > mi:
+						known = states.get((i, ti))
+						if known is not None:
+							result = known
+							break
+						visited.append((i, ti))
+					if self._matches(message, i, ti + 1, path, states):
+						result = True
+						break
+				break
+
+			if self._matchers[ti].match(message[mi], path, False)[0]:
+				mi += 1
+				ti += 1
+			elif self._ifpresent[ti]:
+				# bypass this optional template element
+				ti += 1
+			else:
+				result = False
+				break
 
-def _templateMatch_list(message, template, path):
-	"""
-	both message and template are lists.
-	
-	Semi-recursive implementation.
-	De-recursived on wildcard * only.
-	"""
-	logInternal("Trying to match %s with %s" % (repr(message), repr(template)))
-	# match(message, *|template) =
-	#  matched = False
-	#  i = 0
-	#  while not matched and message[i:]:
-	#   matched = match(message[i:], template)
-	
-	# An empty template can only match an empty message
-	if not template:
-		if not message:
-			return (True, [], path)
-		else:
-			return (False, [], path)
-
-	# The contrary is false. A non-empty template
-	# may match an empty message (wilcards, ifpresent elements, etc)
-
-	# template header|trail	
-	th, tt = (template[0], template[1:])
-	
-	if not message:
-		if _is_any_or_none(th):
-			# matched
-			logInternal("_templateMatch_list matched: [] against [*]")
-			return (True, [], path)
-		elif isinstance(th, ifpresent):
-			# discard the optional element, check with the others
-			ret, decoded, path = _templateMatch_list(message, tt, path)
-			return (ret, decoded, path)
-		else:
-			# Other templates: no match, missing mandatory elements to match
-			return (False, [], path)
-	
-	# message header|trail
-	mh, mt = (message[0], message[1:])
+		for state in visited:
+			states[state] = result
+		return result
 
-	if _is_any_or_none(th):
-		if not tt:
-			logInternal("_templateMatch_list matched: %s against %s ([*])" % (repr(message), repr(template)))
-			return (True, message, path)
-		matched = False
-		decodedList = []
-		trailingDecodedList = []
-		i = 0
-		mismatchedPath = path
-		while not matched and message[i:]:
-			(matched, trailingDecodedList, p) = _templateMatch_list(message[i:], tt, path)
-			if not matched:
-				mismatchedPath = p
-				decodedList.append(message[i])
+	def _match(self, message, mi, ti, path, states, elements):
+		"""
+		Matches message[mi:] against template[ti:].
+		The decoded message[mi:] can then be retrieved with _getDecodedList().
+		
+		@rtype: tuple (bool, unicode)
+		@returns: the matching status, and the mismatched path
+		"""
+		templateLength = len(self._matchers)
+		messageLength = len(message)
+		# The (non-*) states visited before reaching a result, which all share this result
+		visited = []
+		while True:
+			known = states.get((mi, ti))
+			if known is not None:
+				result = known[:2]
+				break
+			# An empty template can only match an empty message
+			if ti == templateLength:
+				result = (mi == messageLength, path)
+				break
+			# The contrary is false. A non-empty template
+			# may match an empty message (wilcards, ifpresent elements, etc)
+			if mi == messageLength:
+				if self._anyOrNone[ti]:
+					logInternal("_templateMatch_list matched: [] against [*]")
+					result = (True, path)
+				elif self._ifpresent[ti]:
+					# discard the optional element, check with the others
+					ti += 1
+					continue
+				else:
+					# Other templates: no match, missing mandatory elements to match
+					result = (False, path)
+				break
+
+			if self._anyOrNone[ti]:
+				result = self._matchAnyOrNone(message, mi, ti, path, states, elements)
+				break
+
+			# Iterative approach:
+			# we match the first element, and the trailing list should match, too
+			visited.append((mi, ti))
+			(ret, decodedElement, mismatchedPath) = self._matchers[ti].match(message[mi], u'%s.*' % path)
+			elements[(mi, ti)] = (ret, decodedElement)
+			if ret:
+				mi += 1
+				ti += 1
+			elif self._ifpresent[ti]:
+				# not matching, but it was an optional/ifpresent element.
+				# We just bypass this template element and try to match the
+				# trailing template only
+				ti += 1
+			else:
+				# mismatch on non-optional/if present element
+				logInternal("_templateMatch_list mismatched on element %s: %r", mi, message[mi])
+				result = (False, mismatchedPath)
+				break
+
+		for state in visited:
+			states[state] = (result[0], result[1], None)
+		return result
+
+	def _matchAnyOrNone(self, message, mi, ti, path, states, elements):
+		"""
+		Matches message[mi:] (not empty) against template[ti:], template[ti] being a *.
+		
+		match(message[i:], *|template) =
+		 match(message[i:], template) or match(message[i+1:], *|template)
+		
+		The first i for which message[i:] matches template[ti+1:]
+		is memoized with the state, so that the decoded list can be built.
+		"""
+		templateLength = len(self._matchers)
+		messageLength = len(message)
+		if ti + 1 == templateLength:
+			logInternal("_templateMatch_list matched: %r (from index %s) against [*]", message, mi)
+			states[(mi, ti)] = (True, path, messageLength)
+			return (True, path)
+
+		# The failed attempts, as (i, mismatched path), until we find a matching one
+		# or a state that is already known
+		failed = []
+		next = None
+		i = mi
+		while i < messageLength:
+			if i > mi:
+				next = states.get((i, ti))
+				if next is not None:
+					break
+			(matched, attemptMismatchedPath) = self._match(message, i, ti + 1, path, states, elements)
+			if matched:
+				next = (True, path, i)
+				states[(i, ti)] = next
+				break
+			failed.append((i, attemptMismatchedPath))
 			i += 1
-		logInternal("_templateMatch_list res %s: %s against %s ([*])" % (matched, repr(message), repr(template)))
-		# decodedList += trailingDecodedList
-		for e in trailingDecodedList:
-			decodedList.append(e)
-		return (matched, decodedList, mismatchedPath)
-	else:
-		# Recursive approach:
-		# we match the same element first element, and the trailing list should match, too
+		
+		if next is None:
+			# No match at all. The mismatched path is the one of the last attempt.
+			(i, attemptMismatchedPath) = failed.pop()
+			next = (False, attemptMismatchedPath, None)
+			states[(i, ti)] = next
+		
+		# Now the previous states, from the closest one
+		while failed:
+			(i, attemptMismatchedPath) = failed.pop()
+			if next[2] == i + 1:
+				# the next state directly matched: reports our own mismatch
+				next = (next[0], attemptMismatchedPath, next[2])
+			states[(i, ti)] = next
+		logInternal("_templateMatch_list res %s: %r (from index %s) against [*]", next[0], message, mi)
+		return next[:2]
+
+	def _getDecodedList(self, message, states, elements):
+		"""
+		Builds the decoded message, once matched with _match(),
+		following the decisions taken while matching.
+		
+		When no attempt matches after a *, the message elements are kept as is
+		and completed with the decoded message of the last attempt.
+		Optional/ifpresent template elements may lead to duplicated elements
+		in the decoded message, since the same element may have been matched against
+		several of them in a row.
+		"""
+		templateLength = len(self._matchers)
+		messageLength = len(message)
 		decodedList = []
-		result = True
-		(ret, decodedAttemptedElement, mismatchedPath) = _templateMatch(mh, th, u'%s.*' % path)
-
-		if not ret and not isinstance(th, ifpresent):
-			# mismatch on non-optional/if present element
-			logInternal("_templateMatch_list mismatched on first element: %s against %s " % (repr(message), repr(template)))
-			result = False
-			# Display why we didn't match our element
-			decodedList.append(decodedAttemptedElement)
-			# Complete with undecoded message
-			decodedList += mt
-		elif not ret:
-			# not matching, but it was an optional/ifpresent element.
-			# We just bypass this template element and try to match the
-			# trailing template only
-			
-			# Display why we didn't match our element
-			# This may cause duplicated list elements in the 'decoded message',
-			# in particular in the cases where multiple optional matches are 
-			# attempted in a row. Actually, the same element will be matched
-			# against each optional template elements, making it appear multiple
-			# time in the final 'decoded' message used for template matching.
-			
-			# This basically leads to "expand" the message so that it contains
-			# a number of elements that can be mapped with the optional/ifpresent
-			# template elements.
-			decodedList.append(decodedAttemptedElement)
-
-			logInternal("_templateMatch_list mismatched on first optional element: %s against %s " % (repr(message), repr(template)))
-			(ret, decoded, mismatchedPath) = _templateMatch_list(message, tt, path)
-			result = ret
-			decodedList += decoded
-		else:
-			# Display why we didn't match our element
-			decodedList.append(decodedAttemptedElement)
-			logInternal("_templateMatch_list matched on first element: %s against %s " % (repr(message), repr(template)))
-			(ret, decoded, mismatchedPath) = _templateMatch_list(mt, tt, path)
-			result = ret
-			decodedList += decoded
-
-#		logInternal("_templateMatch_list res %s: %s against %s ([*])" % (result, repr(message), repr(template)))
-		return (result, decodedList, mismatchedPath)
+		mi = 0
+		ti = 0
+		while ti < templateLength:
+			if mi == messageLength:
+				if self._ifpresent[ti] and not self._anyOrNone[ti]:
+					ti += 1
+					continue
+				break
+			if self._anyOrNone[ti]:
+				k = states[(mi, ti)][2]
+				if k is None:
+					decodedList += message[mi:]
+					mi = messageLength - 1
+				else:
+					decodedList += message[mi:k]
+					mi = k
+				ti += 1
+				continue
+			(ret, decodedElement) = elements[(mi, ti)]
+			decodedList.append(decodedElement)
+			if ret:
+				mi += 1
+				ti += 1
+			elif self._ifpresent[ti]:
+				ti += 1
+			else:
+				# Complete with undecoded message
+				decodedList += message[mi+1:]
+				break
+		return decodedList
 
 
 ################################################################################
@@ -3248,11 +4273,11 @@ def triEnqueueMsg(tsiPortId, sutAddress = None, componentId = None, message = No
 	_TsiPortsLock.release()
 	
 	if tsiPort:
-		logInternal("triEnqueueMsg: received a message for tsiPort %s from %s. Enqueing it." % (str(tsiPort), str(sutAddress)))
+		logInternal("triEnqueueMsg: received a message for tsiPort %s from %s. Enqueing it.", tsiPort, sutAddress)
 		tsiPort._enqueue(message, sutAddress)
 	else:
 		# Late message ? just discard it.
-		logInternal("triEnqueueMsg: received a message for unmapped tsiPortId %s. Not delivering to userland, discarding." % str(tsiPortId))
+		logInternal("triEnqueueMsg: received a message for unmapped tsiPortId %s. Not delivering to userland, discarding.", tsiPortId)
 
 TestermanSA.registerTriEnqueueMsgFunction(triEnqueueMsg)
 
@@ -3520,6 +4545,58 @@ def wait(duration, name = "wait"):
 def define_codec_alias(name, codec, **kwargs):
 	TestermanCD.alias(name, codec, **kwargs)
 
+def set_component_executor(max_idle_workers = None, max_concurrent_components = None):
+	"""
+	Configures the pool of threads that execute the PTC behaviours.
+	None keeps the current value.
+	
+	@type  max_idle_workers: integer, or None
+	@param max_idle_workers: the max number of threads kept, waiting for a new
+	behaviour to execute, once their behaviour is completed (default: 16).
+	0 to use a new thread for each started behaviour.
+	@type  max_concurrent_components: integer, or None
+	@param max_concurrent_components: the max number of behaviours executed
+	at the same time. Additional start() are queued until a running behaviour
+	completes. 0 (default) means no limit.
+	Warning: a PTC waiting for a queued PTC would block forever.
+	"""
+	_getComponentExecutor().configure(maxIdleWorkers = max_idle_workers, maxConcurrentComponents = max_concurrent_components)
+
+def use_legacy_alt(legacy = True):
+	"""
+	Selects the alt() implementation.
+	
+	@type  legacy: bool
+	@param legacy: if True, alt() analyzes at most one message per port per pass
+	(in no particular port order), as in previous Testerman versions.
+	If False (default), alt() analyzes all the messages received on the watched
+	ports when the pass started, in their arrival order.
+	"""
+	global _LegacyAlt
+	_LegacyAlt = legacy
+
+def get_component_executor_statistics():
+	"""
+	Returns the counters of the pool of threads that execute the PTC behaviours.
+	
+	@rtype: dict[string] of integers
+	@returns: workers, idle-workers, running, queued (current values),
+	started, created-workers, total-queued (totals since the ATS start),
+	max-running, max-queued (peak values).
+	"""
+	return _getComponentExecutor().getStatistics()
+
+def get_decode_cache_statistics():
+	"""
+	Returns the counters of the cache of the messages decoded by
+	the codec templates (with_()) while evaluating alt() alternatives.
+	
+	@rtype: dict[string] of integers
+	@returns: hits (decodings avoided), misses (actual decodings),
+	totals since the ATS start.
+	"""
+	return _getDecodeCacheStatistics()
+
 
 ################################################################################
 # Additional init/finalization fonctions
@@ -3528,6 +4605,7 @@ def define_codec_alias(name, codec, **kwargs):
 def _finalize():
 	if _CurrentTestAdapterConfiguration:
 		_CurrentTestAdapterConfiguration._tac._uninstall()
+	_getComponentExecutor().stop()
 
 def _initialize():
 	random.seed()
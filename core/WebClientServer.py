@@ -31,6 +31,7 @@
 
 
 import WebServer
+import BinaryLog
 import Tools
 import ConfigManager
 import TestermanClient
@@ -482,6 +483,8 @@ class WebClientApplication(WebServer.WebApplication):
 		getLogger().debug("DEBUG: re-structuring XML...")
 		currentTestCaseNode = None
 		atsNode = libxml2.newNode('ats')
+		# Template-defined nodes, indexed by their template id
+		templates = {}
 		
 		node = rdoc.getRootElement().children
 		while node:
@@ -489,8 +492,16 @@ class WebClientApplication(WebServer.WebApplication):
 			if not node.type == 'element': # libxml2 constant ?
 				pass
 
+			elif node.name == 'template-defined':
+				# Not displayed as is: only used to resolve template references
+				node.unlinkNode()
+				templates[node.prop('id')] = node
+
 			else:
 				# element nodes
+				if node.hasProp('template-id'):
+					self._resolveTemplateReference(node, templates)
+
 				if node.hasProp('timestamp'):
 					node.setProp('timestamp', formatTimestamp(float(node.prop('timestamp'))))
 
@@ -519,6 +530,9 @@ class WebClientApplication(WebServer.WebApplication):
 
 			node = nextnode
 
+		for node in templates.values():
+			node.freeNode()
+
 		# OK, we're done with the DOM tree.
 		# Let's format it back to XML.
 
@@ -530,6 +544,23 @@ class WebClientApplication(WebServer.WebApplication):
 		
 		return ret
 
+	def _resolveTemplateReference(self, node, templates):
+		"""
+		Replaces the template-id attribute of a template-match/mismatch
+		node with a copy of the template it references.
+		"""
+		definition = templates.get(node.prop('template-id'))
+		if definition is None:
+			getLogger().warning("Reference to an undefined template (%s)" % node.prop('template-id'))
+			return
+		child = definition.children
+		while child:
+			if child.type == 'element' and child.name == 'template':
+				node.unsetProp('template-id')
+				node.addChild(child.copyNode(1))
+				return
+			child = child.next
+
 	def handle_view_log(self, path):
 		"""
 		Display an ATS log file as something human-readable (html).
@@ -618,6 +649,30 @@ class WebClientApplication(WebServer.WebApplication):
 		
 		self._sendContent(JSON.dumps(logElements), contentType = JSON_CONTENT_TYPE)
 	
+	def handle_get_job_log_chunk(self, jobId, offset = 0):
+		"""
+		Called via an ajax-like call.
+		Returns the log events of a job (id'd by jobId) from a log offset,
+		as a dict { 'events': list of XML events, 'offset': next offset },
+		or a null object if the job was not found.
+		If the log cannot be retrieved for now (server unreachable, etc),
+		returns a 503 error instead, so that the client polls again later.
+		
+		The client polls with the returned offset to get the new events.
+		"""
+		result = None
+		try:
+			chunk = self._getClient().getJobLogChunk(int(jobId), int(offset))
+			if chunk is not None:
+				(events, nextOffset) = chunk
+				result = dict(events = [ x.rstrip() for x in BinaryLog.splitEvents(events)[0] ], offset = nextOffset)
+		except Exception, e:
+			getLogger().error("handle_get_job_log_chunk: %s" % str(e))
+			self.request.sendError(503)
+			return
+		
+		self._sendContent(JSON.dumps(result), contentType = JSON_CONTENT_TYPE)
+	
 	def _startMonitoring(self, jobInfo):
 		self._jobMonitorManager.monitor(jobInfo)
 
@@ -30,6 +30,7 @@
 #
 ##
 
+import BinaryLog
 import ConfigManager
 import CounterManager
 import DependencyResolver
@@ -52,7 +53,7 @@ import zlib
 #: API versions: major.minor
 #: major += 1 if not backward compatible,
 #: minor += 1 if feature-enriched, backward compatible
-WS_VERSION = '1.8'
+WS_VERSION = '1.9'
 
 
 ################################################################################
@@ -112,7 +113,7 @@ def getXcVersion():
 # service: job (Job management)
 ################################################################################
 
-def scheduleAts(source, atsId, username, session, at, path = None, groups = None):
+def scheduleAts(source, atsId, username, session, at, path = None, groups = None, logFormat = None):
 	"""
 	Schedules an ATS to start at <at>
 	
@@ -138,6 +139,11 @@ def scheduleAts(source, atsId, username, session, at, path = None, groups = None
 	@type  groups: list os unicode strings, or None
 	@param groups: a list of groups selected for this run. If set to None, all groups are considered
 	               (no particular selection)
+	@since: 1.9
+	@type  logFormat: string, or None
+	@param logFormat: the format of the events written to the job log file:
+	                  'xml' or 'binary'. If set to None, 'xml'.
+	                  Regardless of this format, logs are retrieved as XML (getJobLog, getFile).
 	
 	@throws Exception: in case of an internal error
 
@@ -147,7 +153,7 @@ def scheduleAts(source, atsId, username, session, at, path = None, groups = None
 	          job-id: the newly created job id, only valid if status == 0
 	          message: a human readable string indicating what was done.
 	"""
-	getLogger().info(">> scheduleAts(at = %s, username = %s, ..., session = %s, groups = %s)" % (at, username, session, groups))
+	getLogger().info(">> scheduleAts(at = %s, username = %s, ..., session = %s, groups = %s, logFormat = %s)" % (at, username, session, groups, logFormat))
 
 	try:
 		# FIXME: ats and the dict of string seems to be received as unicode,
@@ -167,6 +173,7 @@ def scheduleAts(source, atsId, username, session, at, path = None, groups = None
 		job.setScheduledStartTime(at)
 		job.setScheduledSession(s)
 		job.setSelectedGroups(groups)
+		job.setLogFormat(logFormat)
 		jobId = JobManager.instance().submitJob(job)
 		message = ""
 		if at is None or at <= time.time():
@@ -353,6 +360,55 @@ def getJobLog(jobId, useCompression = True):
 	getLogger().info("<< getJobLog: %d bytes returned" % len(res))
 	return res
 
+def getJobLogChunk(jobId, fromOffset, maxBytes = 1048576, useCompression = True):
+	"""
+	Gets the complete log events logged by an existing job from a log offset.
+	
+	Contrary to getJobLog(), enables to retrieve the logs of a running job
+	incrementally: start with fromOffset = 0, then pass the returned
+	next offset to get the events logged since the previous call.
+	
+	@since: 1.9
+
+	@type  jobId: integer
+	@param jobId: the job ID identifying the job whose log should be retrieved
+	@type  fromOffset: integer
+	@param fromOffset: 0, or the offset returned by a previous call
+	@type  maxBytes: integer
+	@param maxBytes: the max number of log bytes to read. If the first event
+	                 is larger, it is returned anyway.
+	@type  useCompression: bool
+	@param useCompression: if set to True, compress the events using zlib before encoding the response in base64
+	
+	@rtype: dict { 'log': string, 'next-offset': integer }, or None
+	@returns: None if the job was not found, or a dict containing:
+	          log: the complete events available from fromOffset, as utf-8 XML events
+	          (no prologue, no root element), base64 encoded, optionally compressed.
+	          Empty if no new event is available.
+	          next-offset: the offset to pass to the next call
+	"""
+	getLogger().info(">> getJobLogChunk(%d, %d, %d, %s)" % (jobId, fromOffset, maxBytes, str(useCompression)))
+	res = None
+	try:
+		chunk = JobManager.instance().getJobLogChunk(jobId, fromOffset, maxBytes)
+		if chunk is not None:
+			(log, nextOffset) = chunk
+			if useCompression:
+				log = base64.encodestring(zlib.compress(log))
+			else:
+				log = base64.encodestring(log)
+			res = { 'log': log, 'next-offset': nextOffset }
+	except Exception, e:
+		e =  Exception("Unable to complete getJobLogChunk operation: %s\n%s" % (str(e), Tools.getBacktrace()))
+		getLogger().info("<< getJobLogChunk(...): Fault:\n%s" % str(e))
+		raise(e)
+
+	if res is not None:
+		getLogger().info("<< getJobLogChunk: %d bytes returned, next offset %d" % (len(res['log']), res['next-offset']))
+	else:
+		getLogger().info("<< getJobLogChunk: job not found")
+	return res
+
 def getJobLogFilename(jobId):
 	"""
 	Gets an existing job's log filename.
@@ -493,6 +549,9 @@ def getFile(path, useCompression = False):
 		if contents is None:
 			ret = None
 		else:
+			if path.endswith('.log'):
+				# Log files may contain binary events: clients expect XML logs
+				contents = BinaryLog.convertDataToXml(contents)
 			if useCompression:
 				ret = base64.encodestring(zlib.compress(contents))
 			else:
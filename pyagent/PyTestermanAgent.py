@@ -104,6 +104,9 @@ class ProbeImplementationAdapter(ProbeImplementationManager.IProbeImplementation
 		self.__probeImplementation = probeImplementation
 		self.__probeImplementation._setAdapter(self)
 		self.__properties = {}
+		# The profile used to encode notifications, according to what
+		# the TE that mapped the probe accepts
+		self.__profile = Messages.Message.CONTENT_TYPE_PYTHON_PICKLE
 
 	##
 	# IProbeImplementationAdapter
@@ -121,17 +124,26 @@ class ProbeImplementationAdapter(ProbeImplementationManager.IProbeImplementation
 	def getType(self):
 		return self.__type
 
+	def setAcceptedProfiles(self, accept):
+		"""
+		Selects the notification profile from the profiles accepted by the
+		mapping TE, as received in the TRI-MAP Accept header.
+		Older TEs do not send any: the legacy pickle profile is used.
+		"""
+		self.__profile = Messages.selectProfile(accept)
+
 	# Methods provided for the adapted Probe Implementation
 	
 	def triEnqueueMsg(self, message, sutAddress = None):
-		self._triEnqueueMsg(message, sutAddress, profile = Messages.Message.CONTENT_TYPE_PYTHON_PICKLE)
+		self._triEnqueueMsg(message, sutAddress, profile = self.__profile)
 	
 	def _triEnqueueMsg(self, message, sutAddress, profile):
 		"""
 		Creates a TRI-ENQUEUE-MSG notification message over XA and sends it.
 		
-		You may select the encoding used for the body. The default, python/pickle,
-		is safe and the preferred encoding when sending to the TACS.
+		You may select the encoding used for the body. The default, python/pickle
+		(binary if the mapping TE accepts it), is safe and the preferred encoding
+		when sending to the TACS.
 		
 		@type  event: the event, any python type
 		@param event: the event to raise.
@@ -168,7 +180,7 @@ class ProbeImplementationAdapter(ProbeImplementationManager.IProbeImplementation
 		msg.setHeader("Probe-Name", self.getName())
 		body = {'label': label, 'payload': payload}
 		if sutAddress: body['sut-address'] = sutAddress
-		msg.setApplicationBody(body, profile = Messages.Message.CONTENT_TYPE_PYTHON_PICKLE)
+		msg.setApplicationBody(body, profile = self.__profile)
 		return self.__agent.notify(msg)
 	
 	def logReceivedPayload(self, label, payload, sutAddress = None):
@@ -189,7 +201,7 @@ class ProbeImplementationAdapter(ProbeImplementationManager.IProbeImplementation
 		msg.setHeader("Probe-Name", self.getName())
 		body = {'label': label, 'payload': payload}
 		if sutAddress: body['sut-address'] = sutAddress
-		msg.setApplicationBody(body, profile = Messages.Message.CONTENT_TYPE_PYTHON_PICKLE)
+		msg.setApplicationBody(body, profile = self.__profile)
 		return self.__agent.notify(msg)
 
 	def getProperty(self, name, defaultValue):
@@ -399,6 +411,7 @@ class Agent(Nodes.ConnectingNode):
 						probe.onTriSend(request.getApplicationBody(), request.getHeader('SUT-Address'))
 						self.response(transactionId, 200, "OK")
 					elif method == "TRI-MAP":
+						probe.setAcceptedProfiles(request.getHeader('Accept'))
 						probe.onTriMap()
 						self.response(transactionId, 200, "OK")
 					elif method == "TRI-UNMAP":
@@ -527,6 +540,8 @@ class Agent(Nodes.ConnectingNode):
 		req = Messages.Request(method = "REGISTER", uri = self.getUri(), protocol = "Xa", version = "1.0")
 		# we should add a list of supported probe types, os, etc ?
 		req.setHeader("Agent-Supported-Probe-Types", ','.join(ProbeImplementationManager.getProbeImplementationClasses().keys()))
+		# The application body profiles we accept for TRI-SEND
+		req.setHeader("Accept", Messages.getAcceptedProfiles())
 		response = self.request(req)
 		if not response:
 			raise Exception("Timeout")
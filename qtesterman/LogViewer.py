@@ -346,10 +346,28 @@ class LogModel(QObject):
 		
 		self._currentAts = None
 		self._currentTestCase = None
+		
+		# Templates defined by template-defined events, indexed by their id (unicode)
+		self._templates = {}
 
 	def clear(self):
 		self._atses = []
 		self._containsIncludes = False
+		self._templates = {}
+
+	def _resolveTemplateReference(self, domElement):
+		"""
+		Replaces the template-id attribute of a template-match/mismatch
+		event with the template it references,
+		so that the event is seen as it was logged without the template dictionary.
+		"""
+		templateId = unicode(domElement.attribute('template-id'))
+		template = self._templates.get(templateId)
+		if template is None:
+			log("Warning: reference to an undefined template (%s)" % templateId)
+			return
+		domElement.removeAttribute('template-id')
+		domElement.appendChild(domElement.ownerDocument().importNode(template, True))
 
 	def feedXmlEvent(self, xmlLog):
 		"""
@@ -383,6 +401,9 @@ class LogModel(QObject):
 
 		tag = domElement.tagName()
 
+		if domElement.hasAttribute('template-id'):
+			self._resolveTemplateReference(domElement)
+
 		if tag == "ats-started":
 			atsLogModel = AtsLogModel(domElement.attribute('id'))
 			atsLogModel._append(domElement)
@@ -435,6 +456,10 @@ class LogModel(QObject):
 			if self._currentTestCase:
 				self._currentTestCase._append(domElement)
 		
+		elif tag == "template-defined":
+			self._templates[unicode(domElement.attribute('id'))] = domElement.firstChildElement('template')
+			# Don't forward a template definition 'event'
+
 		elif tag == "include":
 			url = QUrl(domElement.attribute('url'))
 			self._containsIncludes = True
@@ -467,6 +492,9 @@ class LogModel(QObject):
 		(res, errormessage, errorline, errorcol) = xmlDoc.setContent(xmlLog, 0)
 		log("Included Logs parsed, DOM constructed")
 
+		# Template ids are only valid within their log file
+		templates = self._templates
+		self._templates = {}
 		element =  xmlDoc.documentElement().firstChildElement()
 		count = 0
 		while not element.isNull():
@@ -475,6 +503,7 @@ class LogModel(QObject):
 			if not (count % 50):
 				QApplication.instance().processEvents()
 			element = element.nextSiblingElement()
+		self._templates = templates
 
 	def getAtses(self):
 		"""
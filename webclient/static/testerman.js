@@ -220,4 +220,44 @@ function getJobUpdate(jobId, lastKnownState, onUpdate, onJobNotFound) {
  * miss events between two long polling attempt.
  */
 
+/**
+ * Gets the log events of a job from a log offset.
+ * onChunk(jobId, chunk) is called with chunk = { events: list of XML events, offset: next offset }
+ * onError(jobId, offset) is called if the log could not be retrieved for now
+ * (aborted or timed out request, server error): the caller may retry later.
+ */
+function getJobLogChunk(jobId, offset, onChunk, onJobNotFound, onError) {
+	var xhReq = createXMLHttpRequest();
+	xhReq.open("GET", "get_job_log_chunk?jobId=" + jobId + "&offset=" + offset, true);
+	var requestTimer = setTimeout(function() {
+		xhReq.abort();
+	}, MAXIMUM_WAITING_TIME);
+	xhReq.onreadystatechange = function() {
+		if (xhReq.readyState != 4)  {
+			return;
+		}
+		clearTimeout(requestTimer);
+		if (xhReq.status != 200)  {
+			console.log("error status", xhReq.status);
+			// Transport errors (status 0) and server errors are not final
+			if (xhReq.status == 0 || xhReq.status >= 500) {
+				onError(jobId, offset);
+			}
+			else {
+				onJobNotFound(jobId, offset);
+			}
+			return;
+		}
+		var chunk = eval('('+ xhReq.responseText + ')');
+		
+		if (chunk) {
+			onChunk(jobId, chunk);
+		}
+		else {
+			onJobNotFound(jobId, offset);
+		}
+	}
+	xhReq.send(null);
+}
+
 